@@ -1,17 +1,37 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, make_response
 from flask_cors import CORS
+import click
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 import bcrypt
 import jwt
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from calendar import monthrange
 from datetime import datetime, timedelta, date
-from functools import wraps
+from functools import lru_cache, wraps
+from operator import itemgetter
 import os
 import json
+import base64
+import hashlib
+import hmac
+import heapq
+import importlib
+import queue
+import select
+import threading
+import time
 
 
 
 from werkzeug.security import generate_password_hash, check_password_hash
 import re
+import unicodedata
 
 app = Flask(__name__)
 CORS(app, 
@@ -44,6 +64,26 @@ DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_HOST = os.getenv('DB_HOST')
 DB_PORT = os.getenv('DB_PORT')
 
+# Configuración del pool de conexiones (compartido por todos los hilos del proceso)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))  # Segundos máximos esperando una conexión libre
+DB_POOL_PING_INTERVAL = float(os.getenv('DB_POOL_PING_INTERVAL', 30))  # Ping a conexiones inactivas más de N segundos
+
+# Configuración de la caché de respuestas en memoria (por proceso)
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 300))  # Segundos que vive una respuesta cacheada
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 5000))  # Respuestas máximas antes de desalojar
+HABIT_NAME_INDEX_TTL = float(os.getenv('HABIT_NAME_INDEX_TTL', 300))  # Segundos que vive el índice de nombres de un usuario
+HABIT_NAME_INDEX_MAX_USERS = int(os.getenv('HABIT_NAME_INDEX_MAX_USERS', 10000))  # Usuarios indexados antes de desalojar
+
+# Configuración del registro de datos de referencia (categorías globales de hábitos y eventos)
+REFERENCE_DATA_REFRESH = float(os.getenv('REFERENCE_DATA_REFRESH', 600))  # Segundos entre recargas periódicas
+REFERENCE_DATA_LISTEN = os.getenv('REFERENCE_DATA_LISTEN', 'false').lower() in ('1', 'true', 'yes')  # Recargar al recibir NOTIFY
+REFERENCE_DATA_MAX_AGE = int(os.getenv('REFERENCE_DATA_MAX_AGE', 3600))  # max-age de Cache-Control en sus endpoints
+
+# Token que deben enviar los clientes de /api/metrics (Authorization: Bearer ...); sin él el endpoint está desactivado
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
 
 # Clave secreta para JWT
 JWT_SECRET = 'tu_secreto_jwt'  # En producción, usar una clave segura desde variable de entorno
@@ -56,20 +96,152 @@ DEFAULT_CATEGORIES = [
     ('Ahorro', 300, 'teal'),        # Presupuesto como en el mockup: $300
 ]
 
-# Función para conectar a la base de datos
+# Pool de conexiones a PostgreSQL seguro para workers WSGI con hilos.
+# Limita el número de conexiones abiertas, espera (con timeout) cuando todas
+# están ocupadas y valida las conexiones inactivas antes de entregarlas.
+class DatabasePool:
+    def __init__(self, minconn, maxconn, timeout, ping_interval, **conn_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.conn_kwargs = conn_kwargs
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self._stats = {
+            'checkouts': 0,
+            'in_use': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'exhausted': 0,
+            'discarded': 0
+        }
+
+    def _get_pool(self):
+        # El pool se crea de forma perezosa y se recrea tras un fork, para que
+        # cada proceso worker tenga sus propias conexiones
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.minconn, self.maxconn, **self.conn_kwargs
+                )
+                self._pid = os.getpid()
+                self._last_used = {}
+                self._slots = threading.BoundedSemaphore(self.maxconn)
+            return self._pool
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.ping_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        pool = self._get_pool()
+        slots = self._slots
+        start = time.monotonic()
+        acquired = slots.acquire(timeout=self.timeout)
+        waited = time.monotonic() - start
+        with self._lock:
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+            if not acquired:
+                self._stats['exhausted'] += 1
+        if not acquired:
+            raise psycopg2.pool.PoolError(
+                f'Pool de conexiones agotado tras esperar {self.timeout}s ({self.maxconn} conexiones en uso)'
+            )
+        try:
+            conn = pool.getconn()
+            if not self._is_healthy(conn):
+                # Descartar la conexión rota y abrir una nueva
+                pool.putconn(conn, close=True)
+                with self._lock:
+                    self._stats['discarded'] += 1
+                conn = pool.getconn()
+        except Exception:
+            slots.release()
+            raise
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+        return conn
+
+    def putconn(self, conn):
+        pool = self._pool
+        if pool is None or self._pid != os.getpid():
+            conn.close()
+            return
+        try:
+            # Conexiones cerradas o en estado desconocido no se reutilizan
+            broken = (conn.closed or conn.info.transaction_status
+                      == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN)
+            if broken:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            pool.putconn(conn, close=bool(broken))
+        finally:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['min'] = self.minconn
+        stats['max'] = self.maxconn
+        stats['wait_time_avg'] = stats['wait_time_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+db_pool = DatabasePool(
+    DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_PING_INTERVAL,
+    dbname=DB_NAME,
+    user=DB_USER,
+    password=DB_PASSWORD,
+    host=DB_HOST,
+    port=DB_PORT
+)
+
+# Función para obtener una conexión del pool (devolverla con release_db_connection)
 def get_db_connection():
     try:
-        return psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
+        return db_pool.getconn()
     except psycopg2.Error as e:
         print(f"Error al conectar a la base de datos: {e}")
         return None
 
+# Función para devolver una conexión al pool
+def release_db_connection(conn):
+    if conn is not None:
+        db_pool.putconn(conn)
+
+# Context manager para usar una conexión del pool:
+#     with db_connection() as conn:
+#         cur = conn.cursor()
+@contextmanager
+def db_connection():
+    conn = db_pool.getconn()
+    try:
+        yield conn
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+
 # Decorador para verificar token JWT
 def token_required(f):
     @wraps(f)
@@ -91,6 +263,311 @@ def token_required(f):
     
     return decorated
 
+# ===== VERSIONES DE RECURSOS Y GET CONDICIONAL ===== #
+
+# Recursos versionados por usuario. Cada endpoint de escritura incrementa la versión de lo
+# que modifica en la misma transacción; las lecturas derivan de ellas un ETag y responden
+# 304 a If-None-Match sin ejecutar sus consultas.
+RESOURCE_FINANCE = 'finance'  # transacciones, categorías y metas de ahorro
+RESOURCE_HABITS = 'habits'  # hábitos y sus completaciones
+RESOURCE_EVENTS = 'events'  # eventos y excepciones de eventos recurrentes
+
+# Caché de respuestas JSON por usuario con TTL y desalojo LRU. Guarda el cuerpo ya
+# serializado junto con el ETag con el que se generó: una entrada solo se sirve si su ETag
+# coincide con el actual, así que una escritura confirmada en otro proceso nunca devuelve
+# datos obsoletos. Las escrituras de este proceso además la invalidan explícitamente.
+class ResponseCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (user_id, ruta, query) -> (recursos, etag, cuerpo, caduca)
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0
+        }
+
+    def get(self, key, etag):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != etag:
+                self._stats['misses'] += 1
+                return None
+            if entry[3] < time.monotonic():
+                del self._entries[key]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[2]
+
+    def set(self, key, resources, etag, body):
+        with self._lock:
+            self._entries[key] = (resources, etag, body, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, user_id, resource):
+        with self._lock:
+            stale = [key for key, entry in self._entries.items()
+                     if key[0] == user_id and resource in entry[0]]
+            for key in stale:
+                del self._entries[key]
+            self._stats['invalidations'] += len(stale)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = sum(len(entry[2]) for entry in self._entries.values())
+        stats['max_entries'] = self.max_entries
+        stats['ttl'] = self.ttl
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+response_cache = ResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES)
+
+# Función para incrementar la versión de uno o varios recursos de un usuario
+# (dentro de la transacción actual, antes del commit) e invalidar sus respuestas cacheadas
+def bump_resource_version(cur, user_id, *resources):
+    for resource in resources:
+        response_cache.invalidate(user_id, resource)
+        cur.execute('''
+            INSERT INTO resource_versions (user_id, resource, version)
+            VALUES (%s, %s, 1)
+            ON CONFLICT (user_id, resource) DO UPDATE
+            SET version = resource_versions.version + 1
+        ''', (user_id, resource))
+
+# Función para obtener las versiones de varios recursos de un usuario, en el mismo orden
+def get_resource_versions(cur, user_id, resources):
+    cur.execute(
+        'SELECT resource, version FROM resource_versions WHERE user_id = %s AND resource = ANY(%s)',
+        (user_id, list(resources))
+    )
+    versions = dict(cur.fetchall())
+    return tuple(versions.get(resource, 0) for resource in resources)
+
+# Función para calcular el ETag de una lectura. Incluye la fecha de hoy (varias respuestas
+# dependen de ella) y los parámetros de la petición.
+def compute_resource_etag(user_id, resources, versions):
+    key = f'{user_id}|{",".join(resources)}|{versions}|{date.today()}|{request.path}?{request.query_string.decode()}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+# Decorador para lecturas condicionales y cacheadas: se aplica después de token_required y
+# recibe los recursos de los que depende la respuesta. Si el ETag del cliente coincide,
+# responde 304 con una sola consulta por clave primaria; si la caché tiene la respuesta
+# para ese ETag, devuelve los bytes guardados; si no, ejecuta el endpoint, añade el ETag y
+# guarda el cuerpo JSON.
+def conditional_get(*resources):
+    def decorator(f):
+        @wraps(f)
+        def decorated(user_id, *args, **kwargs):
+            conn = get_db_connection()
+            if conn is None:
+                return f(user_id, *args, **kwargs)
+            cur = conn.cursor()
+            try:
+                versions = get_resource_versions(cur, user_id, resources)
+            except psycopg2.Error as e:
+                print(f"Error al obtener versiones de recursos: {e}")
+                versions = None
+            finally:
+                cur.close()
+                release_db_connection(conn)
+            
+            if versions is None:
+                return f(user_id, *args, **kwargs)
+            
+            etag = compute_resource_etag(user_id, resources, versions)
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+                response.set_etag(etag, weak=True)
+                return response
+            
+            cache_key = (user_id, request.path, request.query_string)
+            body = response_cache.get(cache_key, etag)
+            if body is not None:
+                response = Response(body, mimetype='application/json')
+            else:
+                response = make_response(f(user_id, *args, **kwargs))
+                if response.status_code == 200 and response.is_json:
+                    response_cache.set(cache_key, resources, etag, response.get_data())
+            
+            if response.status_code == 200:
+                response.set_etag(etag, weak=True)
+                response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        
+        return decorated
+    return decorator
+
+# ===== DATOS DE REFERENCIA ===== #
+
+# Tablas globales de catálogo que solo cambian con el esquema
+REFERENCE_TABLES = ('habit_categories', 'event_categories')
+REFERENCE_DATA_CHANNEL = 'reference_data'
+
+# Registro en memoria de las tablas de referencia. Se carga con la primera petición de
+# cada proceso, se recarga cada REFERENCE_DATA_REFRESH segundos y, si REFERENCE_DATA_LISTEN
+# está activo, en cuanto un trigger de la base de datos avisa por NOTIFY. Cada tabla
+# guarda sus filas, índices por id y nombre y el cuerpo JSON ya serializado; la versión
+# es un hash del contenido, así que una recarga sin cambios no invalida los ETag.
+class ReferenceData:
+    def __init__(self, tables, refresh_interval, listen):
+        self.tables = tables
+        self.refresh_interval = refresh_interval
+        self.listen = listen
+        self._data = None
+        self._loaded_at = 0.0
+        self._stale = False
+        self._pid = None
+        self._loading = False
+        self._lock = threading.Lock()
+        self._load_done = threading.Condition(self._lock)
+        self._stats = {'loads': 0, 'notifications': 0, 'errors': 0}
+
+    def _load(self):
+        data = {}
+        with db_connection() as conn:
+            cur = conn.cursor()
+            for table in self.tables:
+                cur.execute(f'SELECT id, name, color FROM {table} ORDER BY id')
+                rows = tuple(cur.fetchall())
+                body = json.dumps([{'id': row[0], 'name': row[1], 'color': row[2]} for row in rows],
+                                  ensure_ascii=False).encode('utf-8')
+                data[table] = {
+                    'rows': rows,
+                    'by_id': {row[0]: row for row in rows},
+                    'by_name': {row[1].lower(): row for row in rows},
+                    'json': body,
+                    'version': hashlib.sha1(body).hexdigest()[:16]
+                }
+            cur.close()
+        return data
+
+    # Devuelve los datos vigentes. La recarga se hace fuera del lock y solo en un hilo a la
+    # vez: mientras tanto los demás siguen leyendo los datos anteriores (o, en la primera
+    # carga, esperan a que termine), así que una consulta lenta no bloquea las lecturas.
+    def _current(self):
+        with self._lock:
+            if self.listen and self._pid != os.getpid():
+                # El hilo de escucha no sobrevive a un fork: uno por proceso worker
+                self._pid = os.getpid()
+                threading.Thread(target=self._listen_forever, daemon=True).start()
+            
+            while True:
+                expired = time.monotonic() - self._loaded_at > self.refresh_interval
+                if self._data is not None and not self._stale and not expired:
+                    return self._data
+                if not self._loading:
+                    break
+                if self._data is not None:
+                    return self._data
+                self._load_done.wait()
+            
+            # Un aviso que llegue durante la carga vuelve a marcar los datos como obsoletos
+            self._loading = True
+            was_stale, self._stale = self._stale, False
+        
+        try:
+            data = self._load()
+        except psycopg2.Error as e:
+            print(f"Error al cargar datos de referencia: {e}")
+            with self._lock:
+                self._stats['errors'] += 1
+                self._stale = self._stale or was_stale
+                self._loaded_at = time.monotonic()
+                self._loading = False
+                self._load_done.notify_all()
+                # Con datos previos se siguen sirviendo; sin ellos el error llega al endpoint
+                if self._data is None:
+                    raise
+                return self._data
+        
+        with self._lock:
+            self._data = data
+            self._stats['loads'] += 1
+            self._loaded_at = time.monotonic()
+            self._loading = False
+            self._load_done.notify_all()
+            return data
+
+    def _listen_forever(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(**db_pool.conn_kwargs)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f'LISTEN {REFERENCE_DATA_CHANNEL}')
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        conn.notifies.clear()
+                        with self._lock:
+                            self._stale = True
+                            self._stats['notifications'] += 1
+            except psycopg2.Error as e:
+                print(f"Error escuchando cambios de datos de referencia: {e}")
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def table(self, table):
+        return self._current()[table]
+
+    def find_by_name(self, table, name):
+        return self.table(table)['by_name'].get(name.lower())
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            if self._data is not None:
+                stats['versions'] = {table: data['version'] for table, data in self._data.items()}
+        return stats
+
+reference_data = ReferenceData(REFERENCE_TABLES, REFERENCE_DATA_REFRESH, REFERENCE_DATA_LISTEN)
+
+# Función para responder con el JSON precalculado de una tabla de referencia, con caché
+# HTTP de larga duración y 304 si el cliente ya tiene la versión actual
+def reference_data_response(table):
+    data = reference_data.table(table)
+    if request.if_none_match.contains(data['version']):
+        response = make_response('', 304)
+    else:
+        response = Response(data['json'], mimetype='application/json')
+    response.set_etag(data['version'])
+    response.headers['Cache-Control'] = f'public, max-age={REFERENCE_DATA_MAX_AGE}'
+    return response
+
+# Endpoint con métricas internas del servidor (pool de conexiones y caché de respuestas).
+# Solo responde si METRICS_TOKEN está configurado y la petición lo incluye.
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    if not METRICS_TOKEN:
+        return jsonify({'message': 'Métricas desactivadas'}), 404
+    auth = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(auth.encode('utf-8'), f'Bearer {METRICS_TOKEN}'.encode('utf-8')):
+        return jsonify({'message': 'Token de métricas inválido'}), 401
+    
+    return jsonify({
+        'db_pool': db_pool.stats(),
+        'response_cache': response_cache.stats(),
+        'reference_data': reference_data.stats(),
+        'chatbot_generations': chatbot_generations.stats()
+    })
+
 # Endpoint de registro
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -132,23 +609,16 @@ def register():
             (user_id, user_id, user_id, user_id)
         )
         
-        # Crear categorías de hábitos para el usuario
-        # Obtener todas las categorías de hábitos predefinidas
-        cur.execute('SELECT id, name, color FROM habit_categories')
-        habit_categories = cur.fetchall()
-        
-        # Crear hábito predeterminado de ejemplo (opcional)
-        if habit_categories:
-            # Tomar la primera categoría (Bienestar) para crear un hábito predeterminado
-            bienestar_id = next((cat[0] for cat in habit_categories if cat[1] == 'Bienestar'), None)
-            if bienestar_id:
-                # Crear un hábito predeterminado: "Beber agua" (diario)
-                cur.execute(
-                    '''INSERT INTO habits 
-                        (user_id, name, category_id, frequency, start_date, status) 
-                       VALUES (%s, %s, %s, %s, %s, %s)''',
-                    (user_id, 'Beber 2 litros de agua', bienestar_id, 'daily', date.today(), 'active')
-                )
+        # Crear hábito predeterminado de ejemplo en la categoría Bienestar (si existe)
+        bienestar = reference_data.find_by_name('habit_categories', 'Bienestar')
+        if bienestar:
+            # Crear un hábito predeterminado: "Beber agua" (diario)
+            cur.execute(
+                '''INSERT INTO habits 
+                    (user_id, name, category_id, frequency, start_date, status) 
+                   VALUES (%s, %s, %s, %s, %s, %s)''',
+                (user_id, 'Beber 2 litros de agua', bienestar[0], 'daily', date.today(), 'active')
+            )
         
         conn.commit()
         
@@ -166,7 +636,7 @@ def register():
         return jsonify({'message': f'Error al registrar usuario: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint de login
 @app.route('/api/login', methods=['POST'])
@@ -204,11 +674,15 @@ def login():
         return jsonify({'message': f'Error al iniciar sesión: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+# Consulta de las categorías de presupuesto de un usuario
+CATEGORIES_SQL = 'SELECT id, name, budget, color FROM categories WHERE user_id = %(user_id)s'
 
 # Endpoint para obtener categorías de presupuesto
 @app.route('/api/categories', methods=['GET'])
 @token_required
+@conditional_get(RESOURCE_FINANCE)
 def get_categories(user_id):
     conn = get_db_connection()
     if conn is None:
@@ -226,10 +700,11 @@ def get_categories(user_id):
                     'INSERT INTO categories (user_id, name, budget, color) VALUES (%s, %s, %s, %s)',
                     (user_id, cat[0], cat[1], cat[2])
                 )
+            bump_resource_version(cur, user_id, RESOURCE_FINANCE)
             conn.commit()
         
         # Obtener las categorías del usuario
-        cur.execute('SELECT id, name, budget, color FROM categories WHERE user_id = %s', (user_id,))
+        cur.execute(CATEGORIES_SQL, {'user_id': user_id})
         categories = cur.fetchall()
         result = []
         for cat in categories:
@@ -246,7 +721,7 @@ def get_categories(user_id):
         return jsonify({'message': f'Error al obtener categorías: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para crear una nueva categoría
 @app.route('/api/categories', methods=['POST'])
@@ -267,6 +742,7 @@ def create_category(user_id):
             (user_id, name, budget, color)
         )
         category_id = cur.fetchone()[0]
+        bump_resource_version(cur, user_id, RESOURCE_FINANCE)
         conn.commit()
         return jsonify({'id': category_id, 'name': name, 'budget': float(budget), 'color': color}), 201
     except psycopg2.Error as e:
@@ -275,7 +751,62 @@ def create_category(user_id):
         return jsonify({'message': f'Error al crear categoría: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+# ===== RESÚMENES MENSUALES DE TRANSACCIONES ===== #
+
+# La tabla ledger_monthly_rollups guarda, por (usuario, categoría, mes, tipo), la suma
+# y el número de transacciones. Se mantiene en la misma transacción que cada escritura
+# sobre transactions, y los resúmenes la leen en lugar de agregar el historial completo.
+# Las transacciones sin categoría se acumulan con category_id = 0.
+
+# Función para sumar (sign=1) o restar (sign=-1) una transacción en los resúmenes mensuales.
+# Para una futura edición: restar la versión anterior y sumar la nueva.
+def apply_transaction_to_rollups(cur, transaction_id, sign=1):
+    cur.execute('''
+        INSERT INTO ledger_monthly_rollups (user_id, category_id, month, type, total, tx_count)
+        SELECT user_id, COALESCE(category_id, 0), date_trunc('month', date)::date, type,
+               %s * amount, %s
+        FROM transactions
+        WHERE id = %s
+        ON CONFLICT (user_id, category_id, month, type) DO UPDATE
+        SET total = ledger_monthly_rollups.total + EXCLUDED.total,
+            tx_count = ledger_monthly_rollups.tx_count + EXCLUDED.tx_count
+    ''', (sign, sign, transaction_id))
+
+# Función para reconstruir los resúmenes mensuales desde las transacciones
+# (de un usuario o de todos). Devuelve el número de filas generadas. El bloqueo de la
+# tabla espera a las escrituras en curso y detiene las nuevas hasta el commit, de modo
+# que ninguna transacción se cuela entre el DELETE y el INSERT (clave duplicada o
+# importe contado dos veces); las lecturas no se bloquean.
+def rebuild_ledger_rollups(cur, user_id=None):
+    cur.execute('LOCK TABLE ledger_monthly_rollups IN SHARE ROW EXCLUSIVE MODE')
+    if user_id is None:
+        cur.execute('DELETE FROM ledger_monthly_rollups')
+    else:
+        cur.execute('DELETE FROM ledger_monthly_rollups WHERE user_id = %s', (user_id,))
+    cur.execute('''
+        INSERT INTO ledger_monthly_rollups (user_id, category_id, month, type, total, tx_count)
+        SELECT user_id, COALESCE(category_id, 0), date_trunc('month', date)::date, type,
+               SUM(amount), COUNT(*)
+        FROM transactions
+        WHERE user_id IS NOT NULL
+        AND (%(user_id)s IS NULL OR user_id = %(user_id)s)
+        GROUP BY user_id, COALESCE(category_id, 0), date_trunc('month', date)::date, type
+    ''', {'user_id': user_id})
+    return cur.rowcount
+
+# Comando para rellenar o reparar los resúmenes mensuales:
+#     flask --app app rebuild-ledger-rollups [--user-id N]
+@app.cli.command('rebuild-ledger-rollups')
+@click.option('--user-id', type=int, default=None, help='Reconstruir solo los resúmenes de este usuario')
+def rebuild_ledger_rollups_command(user_id):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        rows = rebuild_ledger_rollups(cur, user_id)
+        conn.commit()
+        cur.close()
+    click.echo(f'Resúmenes mensuales reconstruidos: {rows} filas')
 
 # Endpoint para registrar una transacción
 @app.route('/api/transactions', methods=['POST'])
@@ -298,6 +829,8 @@ def create_transaction(user_id):
             (user_id, category_id, amount, description, transaction_type, transaction_date)
         )
         transaction_id = cur.fetchone()[0]
+        apply_transaction_to_rollups(cur, transaction_id)
+        bump_resource_version(cur, user_id, RESOURCE_FINANCE)
         conn.commit()
         return jsonify({
             'id': transaction_id,
@@ -313,25 +846,29 @@ def create_transaction(user_id):
         return jsonify({'message': f'Error al crear transacción: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+# Consulta de las últimas transacciones de un usuario
+RECENT_TRANSACTIONS_SQL = '''
+    SELECT t.id, t.amount, t.description, t.type, t.date, c.name as category_name
+    FROM transactions t
+    JOIN categories c ON t.category_id = c.id
+    WHERE t.user_id = %(user_id)s
+    ORDER BY t.date DESC
+    LIMIT 10
+'''
 
 # Endpoint para obtener transacciones recientes
 @app.route('/api/transactions/recent', methods=['GET'])
 @token_required
+@conditional_get(RESOURCE_FINANCE)
 def get_recent_transactions(user_id):
     conn = get_db_connection()
     if conn is None:
         return jsonify({'message': 'Error de conexión a la base de datos'}), 500
     cur = conn.cursor()
     try:
-        cur.execute('''
-            SELECT t.id, t.amount, t.description, t.type, t.date, c.name as category_name
-            FROM transactions t
-            JOIN categories c ON t.category_id = c.id
-            WHERE t.user_id = %s
-            ORDER BY t.date DESC
-            LIMIT 10
-        ''', (user_id,))
+        cur.execute(RECENT_TRANSACTIONS_SQL, {'user_id': user_id})
         transactions = cur.fetchall()
         result = []
         for t in transactions:
@@ -349,16 +886,70 @@ def get_recent_transactions(user_id):
         return jsonify({'message': f'Error al obtener transacciones: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+# Consulta del resumen financiero: un recorrido de los resúmenes mensuales del usuario
+# agregado por categoría con SUM ... FILTER para cada mes, más las categorías y metas de
+# ahorro como JSON. Con balance_until el balance se calcula hasta ese mes (excluido).
+FINANCE_SUMMARY_SQL = '''
+    WITH tx AS (
+        SELECT category_id,
+               SUM(total) FILTER (WHERE type = 'gasto' AND month = %(month_start)s) AS month_expenses,
+               SUM(total) FILTER (WHERE type = 'ingreso' AND month = %(month_start)s) AS month_income,
+               SUM(total) FILTER (WHERE type = 'gasto' AND month = %(last_month_start)s) AS last_month_expenses,
+               SUM(total) FILTER (WHERE type = 'ingreso' AND month = %(last_month_start)s) AS last_month_income,
+               SUM(CASE WHEN type = 'ingreso' THEN total WHEN type = 'gasto' THEN -total ELSE 0 END) AS balance
+        FROM ledger_monthly_rollups
+        WHERE user_id = %(user_id)s
+        AND (%(balance_until)s IS NULL OR month < %(balance_until)s)
+        GROUP BY category_id
+    )
+    SELECT
+        (SELECT COALESCE(SUM(month_expenses), 0) FROM tx),
+        (SELECT COALESCE(SUM(last_month_expenses), 0) FROM tx),
+        (SELECT COALESCE(SUM(month_income), 0) FROM tx),
+        (SELECT COALESCE(SUM(last_month_income), 0) FROM tx),
+        (SELECT COALESCE(SUM(balance), 0) FROM tx),
+        (SELECT COALESCE(json_agg(json_build_object(
+                    'id', c.id,
+                    'name', c.name,
+                    'budget', c.budget,
+                    'income', COALESCE(tx.month_income, 0),
+                    'expense', COALESCE(tx.month_expenses, 0)
+                ) ORDER BY c.id), '[]'::json)
+         FROM categories c
+         LEFT JOIN tx ON tx.category_id = c.id
+         WHERE c.user_id = %(user_id)s),
+        (SELECT COALESCE(json_agg(json_build_object(
+                    'id', g.id,
+                    'name', g.name,
+                    'target_amount', g.target_amount,
+                    'current_amount', g.current_amount,
+                    'target_date', to_char(g.target_date, 'YYYY-MM-DD')
+                ) ORDER BY g.id), '[]'::json)
+         FROM savings_goals g
+         WHERE g.user_id = %(user_id)s)
+'''
 
 # Endpoint para obtener resumen financiero
 @app.route('/api/finance/summary', methods=['GET'])
 @token_required
+@conditional_get(RESOURCE_FINANCE)
 def get_finance_summary(user_id):
-    # Obtener mes actual y mes anterior
-    today = date.today()
-    first_day_current_month = date(today.year, today.month, 1)
-    last_month = today.replace(day=1) - timedelta(days=1)
+    # Mes a resumir (YYYY-MM); por defecto el mes actual
+    month = request.args.get('month')
+    if month:
+        try:
+            first_day_current_month = datetime.strptime(month, '%Y-%m').date()
+        except ValueError:
+            return jsonify({'message': 'Formato de mes inválido. Use YYYY-MM'}), 400
+    else:
+        today = date.today()
+        first_day_current_month = date(today.year, today.month, 1)
+    
+    # Obtener inicio del mes siguiente y del mes anterior
+    first_day_next_month = (first_day_current_month + timedelta(days=32)).replace(day=1)
+    last_month = first_day_current_month - timedelta(days=1)
     first_day_last_month = date(last_month.year, last_month.month, 1)
     
     conn = get_db_connection()
@@ -366,93 +957,45 @@ def get_finance_summary(user_id):
         return jsonify({'message': 'Error de conexión a la base de datos'}), 500
     cur = conn.cursor()
     try:
-        # Obtener gastos del mes actual
-        cur.execute('''
-            SELECT COALESCE(SUM(amount), 0) 
-            FROM transactions 
-            WHERE user_id = %s AND type = 'gasto' AND date >= %s
-        ''', (user_id, first_day_current_month))
-        current_month_expenses = cur.fetchone()[0]
-        
-        # Obtener gastos del mes anterior
-        cur.execute('''
-            SELECT COALESCE(SUM(amount), 0) 
-            FROM transactions 
-            WHERE user_id = %s AND type = 'gasto' AND date >= %s AND date < %s
-        ''', (user_id, first_day_last_month, first_day_current_month))
-        last_month_expenses = cur.fetchone()[0]
-        
-        # Obtener ingresos del mes actual
-        cur.execute('''
-            SELECT COALESCE(SUM(amount), 0) 
-            FROM transactions 
-            WHERE user_id = %s AND type = 'ingreso' AND date >= %s
-        ''', (user_id, first_day_current_month))
-        current_month_income = cur.fetchone()[0]
-        
-        # Obtener ingresos del mes anterior
-        cur.execute('''
-            SELECT COALESCE(SUM(amount), 0) 
-            FROM transactions 
-            WHERE user_id = %s AND type = 'ingreso' AND date >= %s AND date < %s
-        ''', (user_id, first_day_last_month, first_day_current_month))
-        last_month_income = cur.fetchone()[0]
-        
-        # Calcular balance total (todos los ingresos - todos los gastos)
-        cur.execute('''
-            SELECT 
-                COALESCE(SUM(CASE WHEN type = 'ingreso' THEN amount ELSE 0 END), 0) - 
-                COALESCE(SUM(CASE WHEN type = 'gasto' THEN amount ELSE 0 END), 0) 
-            FROM transactions 
-            WHERE user_id = %s
-        ''', (user_id,))
-        total_balance = cur.fetchone()[0]
+        # Una sola consulta; para meses pasados el balance se calcula hasta el fin de ese mes
+        cur.execute(FINANCE_SUMMARY_SQL, {
+            'user_id': user_id,
+            'month_start': first_day_current_month,
+            'last_month_start': first_day_last_month,
+            'balance_until': first_day_next_month if month else None
+        })
+        (current_month_expenses, last_month_expenses, current_month_income,
+         last_month_income, total_balance, categories, goals) = cur.fetchone()
         
         # Obtener progreso por categoría
-        cur.execute('''
-            SELECT c.id, c.name, c.budget, 
-            COALESCE(SUM(CASE WHEN t.type = 'ingreso' THEN t.amount ELSE 0 END), 0) as income,
-            COALESCE(SUM(CASE WHEN t.type = 'gasto' THEN t.amount ELSE 0 END), 0) as expense
-            FROM categories c
-            LEFT JOIN transactions t ON c.id = t.category_id AND t.date >= %s
-            WHERE c.user_id = %s
-            GROUP BY c.id, c.name, c.budget
-        ''', (first_day_current_month, user_id))
-        
         categories_progress = []
-        for cat in cur.fetchall():
+        for cat in categories:
             # Para las categorías: los ingresos suman, los gastos restan
-            income = float(cat[3])
-            expense = float(cat[4])
+            income = float(cat['income'])
+            expense = float(cat['expense'])
             
             # Si es una categoría normal, los gastos consumen el presupuesto
             # El "spent" representa cuánto has gastado del presupuesto
             spent = expense
             
             categories_progress.append({
-                'id': cat[0],
-                'name': cat[1],
-                'budget': float(cat[2]),
+                'id': cat['id'],
+                'name': cat['name'],
+                'budget': float(cat['budget']),
                 'spent': spent,
                 'income': income,  # Añadir ingresos por separado
-                'color': getCategoryColor(cat[1])
+                'color': getCategoryColor(cat['name'])
             })
         
         # Obtener metas de ahorro
-        cur.execute('''
-            SELECT id, name, target_amount, current_amount, target_date
-            FROM savings_goals
-            WHERE user_id = %s
-        ''', (user_id,))
-        
         savings_goals = []
-        for goal in cur.fetchall():
+        for goal in goals:
             savings_goals.append({
-                'id': goal[0],
-                'name': goal[1],
-                'target_amount': float(goal[2]),
-                'current_amount': float(goal[3]),
-                'target_date': goal[4].strftime('%Y-%m-%d') if goal[4] else None
+                'id': goal['id'],
+                'name': goal['name'],
+                'target_amount': float(goal['target_amount']),
+                'current_amount': float(goal['current_amount']),
+                'target_date': goal['target_date']
             })
         
         # Calcular variación porcentual de gastos e ingresos
@@ -471,14 +1014,15 @@ def get_finance_summary(user_id):
             'variacion_gastos': float(expense_variation),
             'variacion_ingresos': float(income_variation),
             'categorias': categories_progress,
-            'metas_ahorro': savings_goals
+            'metas_ahorro': savings_goals,
+            'mes': first_day_current_month.strftime('%Y-%m')
         })
     except psycopg2.Error as e:
         print(f"Error al obtener resumen financiero: {e}")
         return jsonify({'message': f'Error al obtener resumen financiero: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para crear o actualizar una meta de ahorro
 @app.route('/api/savings/goals', methods=['POST'])
@@ -500,6 +1044,7 @@ def create_savings_goal(user_id):
             (user_id, name, target_amount, current_amount, target_date)
         )
         goal_id = cur.fetchone()[0]
+        bump_resource_version(cur, user_id, RESOURCE_FINANCE)
         conn.commit()
         return jsonify({
             'id': goal_id,
@@ -514,7 +1059,7 @@ def create_savings_goal(user_id):
         return jsonify({'message': f'Error al crear meta de ahorro: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para actualizar una meta de ahorro
 @app.route('/api/savings/goals/<int:goal_id>', methods=['PUT'])
@@ -536,6 +1081,7 @@ def update_savings_goal(user_id, goal_id):
         if not goal:
             return jsonify({'message': 'Meta de ahorro no encontrada'}), 404
             
+        bump_resource_version(cur, user_id, RESOURCE_FINANCE)
         conn.commit()
         return jsonify({
             'id': goal[0],
@@ -550,7 +1096,7 @@ def update_savings_goal(user_id, goal_id):
         return jsonify({'message': f'Error al actualizar meta de ahorro: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para asegurar que el usuario tenga categoría de ingreso
 @app.route('/api/categories/ensure-income', methods=['POST'])
@@ -572,6 +1118,7 @@ def ensure_income_category(user_id):
                     'INSERT INTO categories (user_id, name, budget, color) VALUES (%s, %s, %s, %s)',
                     (user_id, cat[0], cat[1], cat[2])
                 )
+            bump_resource_version(cur, user_id, RESOURCE_FINANCE)
             conn.commit()
         
         # Devolver la primera categoría como predeterminada
@@ -585,7 +1132,7 @@ def ensure_income_category(user_id):
         return jsonify({'message': f'Error: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para obtener categorías por tipo (ingresos o gastos)
 @app.route('/api/categories/by-type/<string:type_name>', methods=['GET'])
@@ -597,7 +1144,7 @@ def get_categories_by_type(user_id, type_name):
     cur = conn.cursor()
     try:
         # Para ambos tipos (ingreso y gasto) devolver todas las categorías principales
-        cur.execute('SELECT id, name, budget, color FROM categories WHERE user_id = %s', (user_id,))
+        cur.execute(CATEGORIES_SQL, {'user_id': user_id})
         categories = cur.fetchall()
         result = []
         for cat in categories:
@@ -613,7 +1160,7 @@ def get_categories_by_type(user_id, type_name):
         return jsonify({'message': f'Error: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para actualizar el presupuesto de una categoría (solo el presupuesto, no el nombre)
 @app.route('/api/categories/<int:category_id>', methods=['PUT'])
@@ -639,6 +1186,7 @@ def update_category(user_id, category_id):
         if not category:
             return jsonify({'message': 'Categoría no encontrada o no pertenece al usuario'}), 404
             
+        bump_resource_version(cur, user_id, RESOURCE_FINANCE)
         conn.commit()
         return jsonify({
             'id': category[0],
@@ -652,43 +1200,108 @@ def update_category(user_id, category_id):
         return jsonify({'message': f'Error al actualizar categoría: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+# Funciones para codificar/decodificar el cursor opaco de paginación de transacciones,
+# que apunta a la última fila devuelta por (date, id)
+def encode_transaction_cursor(tx_date, tx_id):
+    payload = json.dumps({'d': tx_date.isoformat(), 'i': tx_id}).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+def decode_transaction_cursor(cursor):
+    payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return datetime.fromisoformat(payload['d']), int(payload['i'])
 
-# Endpoint para obtener transacciones con detalles completos
+# Consulta de transacciones con detalles de categoría. get_transactions_with_details le
+# añade sus filtros, TRANSACTIONS_AFTER_CURSOR_SQL para continuar tras una página y
+# TRANSACTIONS_PAGE_SQL para el orden y el límite.
+TRANSACTIONS_WITH_DETAILS_SQL = '''
+    SELECT 
+        t.id, 
+        t.amount, 
+        t.description, 
+        t.type, 
+        t.date, 
+        c.name as category_name,
+        c.id as category_id,
+        c.color as category_color
+    FROM transactions t
+    JOIN categories c ON t.category_id = c.id
+    WHERE t.user_id = %(user_id)s
+'''
+TRANSACTIONS_AFTER_CURSOR_SQL = " AND (t.date, t.id) < (%(after_date)s, %(after_id)s)"
+TRANSACTIONS_PAGE_SQL = " ORDER BY t.date DESC, t.id DESC LIMIT %(limit)s"
+
+# Endpoint para obtener transacciones con detalles completos.
+# Paginación por cursor sobre (date, id): cada página usa el índice y cuesta lo mismo
+# sin importar lo profunda que sea. Filtros opcionales: type, category_id, from y to
+# (YYYY-MM-DD, ambos incluidos). El total solo se calcula con include_total=true.
 @app.route('/api/transactions', methods=['GET'])
 @token_required
+@conditional_get(RESOURCE_FINANCE)
 def get_transactions_with_details(user_id):
-    limit = request.args.get('limit', default=10, type=int)
-    offset = request.args.get('offset', default=0, type=int)
+    limit = max(1, min(request.args.get('limit', default=10, type=int), 100))
+    cursor = request.args.get('cursor')
+    transaction_type = request.args.get('type')
+    category_id = request.args.get('category_id', type=int)
+    include_total = request.args.get('include_total', default='false').lower() in ('1', 'true', 'yes')
+    
+    try:
+        date_from = datetime.strptime(request.args['from'], '%Y-%m-%d').date() if request.args.get('from') else None
+        date_to = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if request.args.get('to') else None
+    except ValueError:
+        return jsonify({'message': 'Formato de fecha inválido. Use YYYY-MM-DD'}), 400
+    
+    after = None
+    if cursor:
+        try:
+            after = decode_transaction_cursor(cursor)
+        except (ValueError, KeyError, TypeError):
+            return jsonify({'message': 'Cursor inválido'}), 400
     
     conn = get_db_connection()
     if conn is None:
         return jsonify({'message': 'Error de conexión a la base de datos'}), 500
     cur = conn.cursor()
     try:
-        # Obtener el total de transacciones para paginación
-        cur.execute('SELECT COUNT(*) FROM transactions WHERE user_id = %s', (user_id,))
-        total = cur.fetchone()[0]
-        
         # Obtener transacciones con detalles de categoría
-        cur.execute('''
-            SELECT 
-                t.id, 
-                t.amount, 
-                t.description, 
-                t.type, 
-                t.date, 
-                c.name as category_name,
-                c.id as category_id,
-                c.color as category_color
-            FROM transactions t
-            JOIN categories c ON t.category_id = c.id
-            WHERE t.user_id = %s
-            ORDER BY t.date DESC
-            LIMIT %s OFFSET %s
-        ''', (user_id, limit, offset))
+        query = TRANSACTIONS_WITH_DETAILS_SQL
+        params = {'user_id': user_id}
+        
+        # Agregar filtros si se proporcionaron
+        if transaction_type:
+            query += " AND t.type = %(type)s"
+            params['type'] = transaction_type
+        
+        if category_id:
+            query += " AND t.category_id = %(category_id)s"
+            params['category_id'] = category_id
+        
+        if date_from:
+            query += " AND t.date >= %(date_from)s"
+            params['date_from'] = date_from
         
+        if date_to:
+            query += " AND t.date < %(date_to)s"
+            params['date_to'] = date_to + timedelta(days=1)
+        
+        # Continuar después de la última fila de la página anterior
+        if after:
+            query += TRANSACTIONS_AFTER_CURSOR_SQL
+            params['after_date'], params['after_id'] = after
+        
+        # Pedir una fila de más para saber si hay otra página
+        query += TRANSACTIONS_PAGE_SQL
+        params['limit'] = limit + 1
+        
+        cur.execute(query, params)
         transactions = cur.fetchall()
+        
+        next_cursor = None
+        if len(transactions) > limit:
+            transactions = transactions[:limit]
+            next_cursor = encode_transaction_cursor(transactions[-1][4], transactions[-1][0])
+        
         result = []
         
         for t in transactions:
@@ -708,28 +1321,47 @@ def get_transactions_with_details(user_id):
                 'category_color': t[7] or getCategoryColor(t[5])
             })
         
-        return jsonify({
+        response = {
             'transactions': result,
-            'total': total,
             'limit': limit,
-            'offset': offset
-        })
+            'next_cursor': next_cursor
+        }
+        
+        # Total aproximado a partir de los resúmenes mensuales (sin contar filas).
+        # Con filtro de fechas se cuentan los meses completos que tocan el rango.
+        if include_total:
+            total_query = 'SELECT COALESCE(SUM(tx_count), 0) FROM ledger_monthly_rollups WHERE user_id = %s'
+            total_params = [user_id]
+            if transaction_type:
+                total_query += ' AND type = %s'
+                total_params.append(transaction_type)
+            if category_id:
+                total_query += ' AND category_id = %s'
+                total_params.append(category_id)
+            if date_from:
+                total_query += ' AND month >= %s'
+                total_params.append(date_from.replace(day=1))
+            if date_to:
+                total_query += ' AND month <= %s'
+                total_params.append(date_to.replace(day=1))
+            cur.execute(total_query, total_params)
+            response['total'] = int(cur.fetchone()[0])
+            response['total_is_approximate'] = bool(date_from or date_to)
+        
+        return jsonify(response)
     except psycopg2.Error as e:
         print(f"Error al obtener transacciones: {e}")
         return jsonify({'message': f'Error al obtener transacciones: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+# Colores predeterminados de las categorías financieras, calculados una vez al cargar
+DEFAULT_CATEGORY_COLORS = {name: color for name, _, color in DEFAULT_CATEGORIES}
 
 # Función para obtener el color predeterminado de una categoría
 def getCategoryColor(category_name):
-    category_colors = {
-        'Comida': 'green',
-        'Transporte': 'blue',
-        'Entretenimiento': 'purple',
-        'Ahorro': 'teal'
-    }
-    return category_colors.get(category_name, 'gray')
+    return DEFAULT_CATEGORY_COLORS.get(category_name, 'gray')
 
 # ===== ENDPOINTS PARA EL MÓDULO DE HÁBITOS ===== #
 
@@ -737,31 +1369,17 @@ def getCategoryColor(category_name):
 @app.route('/api/habits/categories', methods=['GET'])
 @token_required
 def get_habit_categories(user_id):
-    conn = get_db_connection()
-    if conn is None:
-        return jsonify({'message': 'Error de conexión a la base de datos'}), 500
-    cur = conn.cursor()
+    # Catálogo global: se sirve desde el registro de datos de referencia
     try:
-        cur.execute('SELECT id, name, color FROM habit_categories')
-        categories = cur.fetchall()
-        result = []
-        for cat in categories:
-            result.append({
-                'id': cat[0],
-                'name': cat[1],
-                'color': cat[2]
-            })
-        return jsonify(result)
+        return reference_data_response('habit_categories')
     except psycopg2.Error as e:
         print(f"Error al obtener categorías de hábitos: {e}")
         return jsonify({'message': f'Error: {e}'}), 500
-    finally:
-        cur.close()
-        conn.close()
 
 # Endpoint para obtener hábitos por estado (activos, archivados)
 @app.route('/api/habits', methods=['GET'])
 @token_required
+@conditional_get(RESOURCE_HABITS)
 def get_habits(user_id):
     status = request.args.get('status', default='active')
     
@@ -770,69 +1388,38 @@ def get_habits(user_id):
         return jsonify({'message': 'Error de conexión a la base de datos'}), 500
     cur = conn.cursor()
     try:
-        # Obtener hábitos del usuario con detalles de categoría
-        cur.execute('''
-            SELECT h.id, h.name, h.frequency, h.days_of_week, h.days_of_month, 
-                   h.start_date, h.end_date, h.current_streak, h.status,
-                   c.id as category_id, c.name as category_name, c.color as category_color,
-                   h.start_time, h.end_time
-            FROM habits h
-            JOIN habit_categories c ON h.category_id = c.id
-            WHERE h.user_id = %s AND h.status = %s
-            ORDER BY h.created_at DESC
-        ''', (user_id, status))
-        
-        habits = cur.fetchall()
-        result = []
-        
         today = date.today()
         
+        # Obtener hábitos del usuario con sus completaciones de los últimos 7 días
+        habits = load_habit_states(cur, user_id, today - timedelta(days=6), today, status=status)
+        result = []
+        
         for h in habits:
-            # Verificar si el hábito está programado para hoy
-            scheduled_today = is_habit_scheduled_for_date(h[2], h[3], h[4], today)
-            
-            # Verificar si ya se completó hoy
-            cur.execute('''
-                SELECT COUNT(*) FROM habit_completions 
-                WHERE habit_id = %s AND completion_date = %s
-            ''', (h[0], today))
-            completed_today = cur.fetchone()[0] > 0
-            
-            # Obtener las últimas 7 completaciones para mostrar la racha semanal
-            cur.execute('''
-                SELECT completion_date FROM habit_completions 
-                WHERE habit_id = %s
-                ORDER BY completion_date DESC
-                LIMIT 7
-            ''', (h[0],))
-            recent_completions = [completion[0] for completion in cur.fetchall()]
-            
             # Calcular progreso semanal (cuántos días completó de los últimos 7 días programados)
-            week_progress = []
-            for i in range(7):
-                check_date = today - timedelta(days=i)
-                day_scheduled = is_habit_scheduled_for_date(h[2], h[3], h[4], check_date)
-                day_completed = check_date in recent_completions
-                if day_scheduled:
-                    week_progress.append(day_completed)
+            week_dates = list(h.schedule.scheduled_dates(today - timedelta(days=6), today))
+            week_progress = [check_date in h.completions for check_date in reversed(week_dates)]
+            
+            # Verificar si el hábito está programado para hoy y si ya se completó
+            scheduled_today = h.schedule.is_scheduled(today)
+            completed_today = today in h.completions
                 
             result.append({
-                'id': h[0],
-                'name': h[1],
-                'frequency': h[2],
-                'days_of_week': h[3].split(',') if h[3] else None,
-                'days_of_month': h[4].split(',') if h[4] else None,
-                'start_date': h[5].strftime('%Y-%m-%d'),
-                'end_date': h[6].strftime('%Y-%m-%d') if h[6] else None,
-                'current_streak': h[7],
-                'status': h[8],
+                'id': h.id,
+                'name': h.name,
+                'frequency': h.frequency,
+                'days_of_week': h.days_of_week.split(',') if h.days_of_week else None,
+                'days_of_month': h.days_of_month.split(',') if h.days_of_month else None,
+                'start_date': h.start_date.strftime('%Y-%m-%d'),
+                'end_date': h.end_date.strftime('%Y-%m-%d') if h.end_date else None,
+                'current_streak': h.current_streak,
+                'status': h.status,
                 'category': {
-                    'id': h[9],
-                    'name': h[10],
-                    'color': h[11]
+                    'id': h.category_id,
+                    'name': h.category_name,
+                    'color': h.category_color
                 },
-                'start_time': h[12].strftime('%H:%M') if h[12] else '00:00',
-                'end_time': h[13].strftime('%H:%M') if h[13] else '23:59',
+                'start_time': h.start_time.strftime('%H:%M') if h.start_time else '00:00',
+                'end_time': h.end_time.strftime('%H:%M') if h.end_time else '23:59',
                 'scheduled_today': scheduled_today,
                 'completed_today': completed_today,
                 'week_progress': week_progress
@@ -844,64 +1431,47 @@ def get_habits(user_id):
         return jsonify({'message': f'Error: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para obtener hábitos programados para hoy
 @app.route('/api/habits/today', methods=['GET'])
 @token_required
+@conditional_get(RESOURCE_HABITS)
 def get_habits_for_today(user_id):
     conn = get_db_connection()
     if conn is None:
         return jsonify({'message': 'Error de conexión a la base de datos'}), 500
     cur = conn.cursor()
     try:
-        # Obtener todos los hábitos activos del usuario
-        cur.execute('''
-            SELECT h.id, h.name, h.frequency, h.days_of_week, h.days_of_month, 
-                   h.current_streak, h.status,
-                   c.id as category_id, c.name as category_name, c.color as category_color,
-                   h.start_time, h.end_time
-            FROM habits h
-            JOIN habit_categories c ON h.category_id = c.id
-            WHERE h.user_id = %s AND h.status = 'active'
-            ORDER BY h.created_at DESC
-        ''', (user_id,))
-        
-        habits = cur.fetchall()
-        result = []
-        
         today = date.today()
         
+        # Obtener todos los hábitos activos del usuario con sus completaciones de hoy
+        habits = load_habit_states(cur, user_id, today)
+        result = []
+        
         for h in habits:
             # Verificar si el hábito está programado para hoy
-            scheduled_today = is_habit_scheduled_for_date(h[2], h[3], h[4], today)
+            scheduled_today = h.schedule.is_scheduled(today)
             
             if not scheduled_today:
                 continue  # Saltar hábitos no programados para hoy
             
-            # Verificar si ya se completó hoy
-            cur.execute('''
-                SELECT COUNT(*) FROM habit_completions 
-                WHERE habit_id = %s AND completion_date = %s
-            ''', (h[0], today))
-            completed_today = cur.fetchone()[0] > 0
-            
             result.append({
-                'id': h[0],
-                'name': h[1],
-                'frequency': h[2],
-                'days_of_week': h[3].split(',') if h[3] else None,
-                'days_of_month': h[4].split(',') if h[4] else None,
-                'current_streak': h[5],
-                'status': h[6],
+                'id': h.id,
+                'name': h.name,
+                'frequency': h.frequency,
+                'days_of_week': h.days_of_week.split(',') if h.days_of_week else None,
+                'days_of_month': h.days_of_month.split(',') if h.days_of_month else None,
+                'current_streak': h.current_streak,
+                'status': h.status,
                 'category': {
-                    'id': h[7],
-                    'name': h[8],
-                    'color': h[9]
+                    'id': h.category_id,
+                    'name': h.category_name,
+                    'color': h.category_color
                 },
-                'start_time': h[10].strftime('%H:%M') if h[10] else '00:00',
-                'end_time': h[11].strftime('%H:%M') if h[11] else '23:59',
-                'completed_today': completed_today
+                'start_time': h.start_time.strftime('%H:%M') if h.start_time else '00:00',
+                'end_time': h.end_time.strftime('%H:%M') if h.end_time else '23:59',
+                'completed_today': today in h.completions
             })
             
         return jsonify(result)
@@ -910,7 +1480,7 @@ def get_habits_for_today(user_id):
         return jsonify({'message': f'Error: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para crear un nuevo hábito
 @app.route('/api/habits', methods=['POST'])
@@ -922,6 +1492,8 @@ def create_habit(user_id):
     frequency = data.get('frequency')
     days_of_week = ','.join(data.get('days_of_week', [])) if data.get('days_of_week') else None
     days_of_month = ','.join(map(str, data.get('days_of_month', []))) if data.get('days_of_month') else None
+    days_of_week_mask = days_of_week_to_mask(days_of_week)
+    days_of_month_mask = days_of_month_to_mask(days_of_month)
     start_date = data.get('start_date', date.today().strftime('%Y-%m-%d'))
     end_date = data.get('end_date')
     start_time = data.get('start_time', '00:00')
@@ -934,13 +1506,17 @@ def create_habit(user_id):
     try:
         cur.execute(
             '''INSERT INTO habits 
-                (user_id, name, category_id, frequency, days_of_week, days_of_month, start_date, end_date, start_time, end_time) 
-               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) 
+                (user_id, name, category_id, frequency, days_of_week, days_of_month,
+                 days_of_week_mask, days_of_month_mask, start_date, end_date, start_time, end_time) 
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) 
                RETURNING id''',
-            (user_id, name, category_id, frequency, days_of_week, days_of_month, start_date, end_date, start_time, end_time)
+            (user_id, name, category_id, frequency, days_of_week, days_of_month,
+             days_of_week_mask, days_of_month_mask, start_date, end_date, start_time, end_time)
         )
         habit_id = cur.fetchone()[0]
+        bump_resource_version(cur, user_id, RESOURCE_HABITS)
         conn.commit()
+        habit_name_index.invalidate(user_id)
         
         return jsonify({
             'id': habit_id,
@@ -962,7 +1538,7 @@ def create_habit(user_id):
         return jsonify({'message': f'Error al crear hábito: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para marcar un hábito como completado
 @app.route('/api/habits/<int:habit_id>/complete', methods=['POST'])
@@ -978,7 +1554,7 @@ def complete_habit(user_id, habit_id):
     
     try:
         # Verificar que el hábito pertenece al usuario
-        cur.execute('SELECT id, frequency, days_of_week, days_of_month, current_streak FROM habits WHERE id = %s AND user_id = %s', (habit_id, user_id))
+        cur.execute('SELECT id FROM habits WHERE id = %s AND user_id = %s', (habit_id, user_id))
         habit = cur.fetchone()
         
         if not habit:
@@ -999,30 +1575,10 @@ def complete_habit(user_id, habit_id):
         completion_id = cur.fetchone()[0]
         
         # Actualizar la racha (streak)
-        current_streak = habit[4]
-        
-        # Verificar si se mantuvo la racha o se debe incrementar
         completion_date_obj = datetime.strptime(completion_date, '%Y-%m-%d').date()
-        yesterday = completion_date_obj - timedelta(days=1)
-        
-        # Verificar si había completado el hábito el día anterior (si estaba programado)
-        if is_habit_scheduled_for_date(habit[1], habit[2], habit[3], yesterday):
-            cur.execute('SELECT id FROM habit_completions WHERE habit_id = %s AND completion_date = %s', (habit_id, yesterday))
-            completed_yesterday = cur.fetchone() is not None
-            
-            if completed_yesterday:
-                # Incrementar la racha
-                current_streak += 1
-            else:
-                # Reiniciar la racha si estaba programado ayer y no se completó
-                current_streak = 1
-        else:
-            # Si el hábito no estaba programado ayer, simplemente incrementamos
-            current_streak += 1
-        
-        # Actualizar la racha en la base de datos
-        cur.execute('UPDATE habits SET current_streak = %s WHERE id = %s', (current_streak, habit_id))
+        current_streak = update_streak_on_completion(cur, habit_id, completion_date_obj)
         
+        bump_resource_version(cur, user_id, RESOURCE_HABITS)
         conn.commit()
         
         return jsonify({
@@ -1037,7 +1593,7 @@ def complete_habit(user_id, habit_id):
         return jsonify({'message': f'Error al completar hábito: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para desmarcar un hábito como completado
 @app.route('/api/habits/<int:habit_id>/uncomplete', methods=['POST'])
@@ -1066,15 +1622,13 @@ def uncomplete_habit(user_id, habit_id):
         if not deleted:
             return jsonify({'message': 'No se encontró completación para esta fecha'}), 404
         
-        # Recalcular la racha actual
-        recalculate_streak(cur, habit_id)
+        # Actualizar la racha actual
+        completion_date_obj = datetime.strptime(completion_date, '%Y-%m-%d').date()
+        current_streak = update_streak_on_uncompletion(cur, habit_id, completion_date_obj)
         
+        bump_resource_version(cur, user_id, RESOURCE_HABITS)
         conn.commit()
         
-        # Obtener la racha actualizada
-        cur.execute('SELECT current_streak FROM habits WHERE id = %s', (habit_id,))
-        current_streak = cur.fetchone()[0]
-        
         return jsonify({
             'habit_id': habit_id,
             'current_streak': current_streak,
@@ -1086,7 +1640,7 @@ def uncomplete_habit(user_id, habit_id):
         return jsonify({'message': f'Error al desmarcar hábito: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para archivar o desarchivar un hábito
 @app.route('/api/habits/<int:habit_id>/status', methods=['PUT'])
@@ -1115,7 +1669,9 @@ def update_habit_status(user_id, habit_id):
         cur.execute('UPDATE habits SET status = %s WHERE id = %s RETURNING id, name, status', (status, habit_id))
         updated = cur.fetchone()
         
+        bump_resource_version(cur, user_id, RESOURCE_HABITS)
         conn.commit()
+        habit_name_index.invalidate(user_id)
         
         return jsonify({
             'id': updated[0],
@@ -1129,7 +1685,7 @@ def update_habit_status(user_id, habit_id):
         return jsonify({'message': f'Error al actualizar estado: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para actualizar un hábito existente
 @app.route('/api/habits/<int:habit_id>', methods=['PUT'])
@@ -1141,6 +1697,8 @@ def update_habit(user_id, habit_id):
     frequency = data.get('frequency')
     days_of_week = ','.join(data.get('days_of_week', [])) if data.get('days_of_week') else None
     days_of_month = ','.join(map(str, data.get('days_of_month', []))) if data.get('days_of_month') else None
+    days_of_week_mask = days_of_week_to_mask(days_of_week)
+    days_of_month_mask = days_of_month_to_mask(days_of_month)
     start_date = data.get('start_date', date.today().strftime('%Y-%m-%d'))
     end_date = data.get('end_date')
     start_time = data.get('start_time', '00:00')
@@ -1163,15 +1721,23 @@ def update_habit(user_id, habit_id):
             '''UPDATE habits 
                SET name = %s, category_id = %s, frequency = %s, 
                    days_of_week = %s, days_of_month = %s, 
+                   days_of_week_mask = %s, days_of_month_mask = %s,
                    start_date = %s, end_date = %s,
                    start_time = %s, end_time = %s
                WHERE id = %s AND user_id = %s
                RETURNING id''',
             (name, category_id, frequency, days_of_week, days_of_month, 
+             days_of_week_mask, days_of_month_mask,
              start_date, end_date, start_time, end_time, habit_id, user_id)
         )
         updated = cur.fetchone()
+        
+        # La programación pudo cambiar, por lo que la racha guardada ya no es válida
+        recalculate_streak(cur, habit_id)
+        
+        bump_resource_version(cur, user_id, RESOURCE_HABITS)
         conn.commit()
+        habit_name_index.invalidate(user_id)
         
         return jsonify({
             'id': updated[0],
@@ -1192,7 +1758,7 @@ def update_habit(user_id, habit_id):
         return jsonify({'message': f'Error al actualizar hábito: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para eliminar un hábito
 @app.route('/api/habits/<int:habit_id>', methods=['DELETE'])
@@ -1216,7 +1782,9 @@ def delete_habit(user_id, habit_id):
         # Luego eliminar el hábito
         cur.execute('DELETE FROM habits WHERE id = %s AND user_id = %s', (habit_id, user_id))
         
+        bump_resource_version(cur, user_id, RESOURCE_HABITS)
         conn.commit()
+        habit_name_index.invalidate(user_id)
         
         return jsonify({
             'id': habit_id,
@@ -1229,74 +1797,345 @@ def delete_habit(user_id, habit_id):
         return jsonify({'message': f'Error al eliminar hábito: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # ===== FUNCIONES AUXILIARES PARA HÁBITOS ===== #
 
+# Abreviaturas usadas en habits.days_of_week (mismo formato que strftime('%a'))
+WEEKDAY_ABBREVIATIONS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+# Función para convertir 'Mon,Wed,Fri' en una máscara de bits (bit 0 = lunes ... bit 6 = domingo)
+def days_of_week_to_mask(days_of_week):
+    mask = 0
+    if days_of_week:
+        for day in days_of_week.split(','):
+            day = day.strip()
+            if day in WEEKDAY_ABBREVIATIONS:
+                mask |= 1 << WEEKDAY_ABBREVIATIONS.index(day)
+    return mask
+
+# Función para convertir '1,15,30' en una máscara de bits (bit 0 = día 1 ... bit 30 = día 31)
+def days_of_month_to_mask(days_of_month):
+    mask = 0
+    if days_of_month:
+        for day in days_of_month.split(','):
+            day = day.strip()
+            if day.isdigit() and 1 <= int(day) <= 31:
+                mask |= 1 << (int(day) - 1)
+    return mask
+
+# Programación compilada de un hábito: la frecuencia más las máscaras de días,
+# para no volver a partir las cadenas de days_of_week/days_of_month en cada consulta
+class HabitSchedule:
+    __slots__ = ('frequency', 'weekday_mask', 'month_day_mask')
+    
+    def __init__(self, frequency, weekday_mask=0, month_day_mask=0):
+        self.frequency = frequency
+        self.weekday_mask = weekday_mask or 0
+        self.month_day_mask = month_day_mask or 0
+    
+    def is_scheduled(self, check_date):
+        if self.frequency == 'daily':
+            return True
+        if self.frequency == 'weekly':
+            return bool(self.weekday_mask >> check_date.weekday() & 1)
+        if self.frequency == 'monthly':
+            return bool(self.month_day_mask >> (check_date.day - 1) & 1)
+        return False
+    
+    # Devuelve la fecha programada inmediatamente anterior a check_date (o None si
+    # el hábito no tiene días programados), sin recorrer los días intermedios
+    def previous_scheduled_date(self, check_date):
+        if self.frequency == 'daily':
+            return check_date - timedelta(days=1)
+        
+        if self.frequency == 'weekly' and self.weekday_mask:
+            weekday = check_date.weekday()
+            for back in range(1, 8):
+                if self.weekday_mask >> ((weekday - back) % 7) & 1:
+                    return check_date - timedelta(days=back)
+        
+        if self.frequency == 'monthly' and self.month_day_mask:
+            year, month, limit = check_date.year, check_date.month, check_date.day - 1
+            # Cualquier máscara no vacía tiene un día válido en menos de un año
+            for _ in range(13):
+                limit = min(limit, monthrange(year, month)[1])
+                days = self.month_day_mask & ((1 << limit) - 1)
+                if days:
+                    return date(year, month, days.bit_length())
+                year, month, limit = (year - 1, 12, 31) if month == 1 else (year, month - 1, 31)
+        
+        return None
+    
+    # Genera en orden ascendente las fechas programadas entre range_start y range_end (ambas incluidas)
+    # saltando directamente de una fecha programada a la siguiente
+    def scheduled_dates(self, range_start, range_end):
+        if self.frequency == 'daily':
+            current = range_start
+            while current <= range_end:
+                yield current
+                current += timedelta(days=1)
+        
+        elif self.frequency == 'weekly' and self.weekday_mask:
+            offsets = [i for i in range(7) if self.weekday_mask >> i & 1]
+            week_start = range_start - timedelta(days=range_start.weekday())
+            while week_start <= range_end:
+                for offset in offsets:
+                    current = week_start + timedelta(days=offset)
+                    if current > range_end:
+                        break
+                    if current >= range_start:
+                        yield current
+                week_start += timedelta(days=7)
+        
+        elif self.frequency == 'monthly' and self.month_day_mask:
+            days = [i + 1 for i in range(31) if self.month_day_mask >> i & 1]
+            year, month = range_start.year, range_start.month
+            while date(year, month, 1) <= range_end:
+                last_day = monthrange(year, month)[1]
+                for day in days:
+                    if day > last_day:
+                        break
+                    current = date(year, month, day)
+                    if current > range_end:
+                        break
+                    if current >= range_start:
+                        yield current
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+# Función para compilar la programación de un hábito. Usa las máscaras guardadas
+# en la fila si existen y solo parsea las cadenas para filas antiguas sin máscara.
+# El resultado se cachea, por lo que las filas repetidas no se vuelven a compilar.
+@lru_cache(maxsize=4096)
+def compile_habit_schedule(frequency, days_of_week, days_of_month, weekday_mask=None, month_day_mask=None):
+    if weekday_mask is None:
+        weekday_mask = days_of_week_to_mask(days_of_week)
+    if month_day_mask is None:
+        month_day_mask = days_of_month_to_mask(days_of_month)
+    return HabitSchedule(frequency, weekday_mask, month_day_mask)
+
 # Función para verificar si un hábito está programado para una fecha específica
 def is_habit_scheduled_for_date(frequency, days_of_week, days_of_month, check_date):
-    if frequency == 'daily':
-        return True
-    
-    if frequency == 'weekly' and days_of_week:
-        # Convertir el día de la semana a formato abreviado (Mon, Tue, etc.)
-        day_name = check_date.strftime('%a')
-        return day_name in days_of_week.split(',')
+    return compile_habit_schedule(frequency, days_of_week, days_of_month).is_scheduled(check_date)
+
+# ===== MOTOR DE RACHAS ===== #
+
+# Función para calcular la racha a partir de las fechas de completación ordenadas
+# de la más reciente a la más antigua. La racha empieza en la última completación y
+# se mantiene mientras cada fecha programada anterior esté completada. Las
+# completaciones en días no programados se ignoran. Solo consume del iterable las
+# fechas que necesita, por lo que el historial antiguo no se lee.
+# Devuelve (racha, fecha de inicio de la racha, última completación).
+def compute_streak(schedule, completions_desc):
+    completions = iter(completions_desc)
+    last_completion = next(completions, None)
+    if last_completion is None:
+        return 0, None, None
     
-    if frequency == 'monthly' and days_of_month:
-        # Verificar si el día del mes está en la lista
-        day_of_month = str(check_date.day)
-        return day_of_month in days_of_month.split(',')
+    streak = 1
+    streak_start = last_completion
+    expected = schedule.previous_scheduled_date(last_completion)
+    for completion in completions:
+        if expected is None:
+            break
+        if completion > expected:
+            # Completado en un día no programado: no suma ni rompe la racha
+            continue
+        if completion < expected:
+            # La fecha programada esperada no se completó: se rompió la racha
+            break
+        streak += 1
+        streak_start = expected
+        expected = schedule.previous_scheduled_date(expected)
     
-    return False
+    return streak, streak_start, last_completion
+
+# Consultas de una página de completaciones de un hábito, de la más reciente a la más
+# antigua (la primera página y las siguientes, que continúan antes de una fecha)
+COMPLETION_DATES_DESC_SQL = '''
+    SELECT completion_date FROM habit_completions
+    WHERE habit_id = %(habit_id)s
+    ORDER BY completion_date DESC
+    LIMIT %(limit)s
+'''
+COMPLETION_DATES_BEFORE_SQL = '''
+    SELECT completion_date FROM habit_completions
+    WHERE habit_id = %(habit_id)s AND completion_date < %(before)s
+    ORDER BY completion_date DESC
+    LIMIT %(limit)s
+'''
+
+# Función para leer las completaciones de un hábito de la más reciente a la más
+# antigua, por páginas de tamaño creciente, para no cargar todo el historial
+def iter_completion_dates_desc(cur, habit_id, page_size=32, max_page_size=1024):
+    before = None
+    while True:
+        if before is None:
+            cur.execute(COMPLETION_DATES_DESC_SQL, {'habit_id': habit_id, 'limit': page_size})
+        else:
+            cur.execute(COMPLETION_DATES_BEFORE_SQL,
+                        {'habit_id': habit_id, 'before': before, 'limit': page_size})
+        rows = cur.fetchall()
+        for row in rows:
+            yield row[0]
+        if len(rows) < page_size:
+            return
+        before = rows[-1][0]
+        page_size = min(page_size * 2, max_page_size)
+
+# Función para guardar el estado de la racha en el hábito
+def save_streak_state(cur, habit_id, streak, streak_start, last_completion):
+    cur.execute('''
+        UPDATE habits
+        SET current_streak = %s, streak_start_date = %s, last_completion_date = %s
+        WHERE id = %s
+    ''', (streak, streak_start, last_completion, habit_id))
 
-# Función para recalcular la racha de un hábito
+# Función para recalcular la racha de un hábito desde su historial; guarda y devuelve el nuevo valor
 def recalculate_streak(cur, habit_id):
     # Obtener información del hábito
-    cur.execute('SELECT frequency, days_of_week, days_of_month FROM habits WHERE id = %s', (habit_id,))
+    cur.execute('''
+        SELECT frequency, days_of_week, days_of_month, days_of_week_mask, days_of_month_mask
+        FROM habits WHERE id = %s
+    ''', (habit_id,))
     habit = cur.fetchone()
     
     if not habit:
-        return
+        return None
     
-    frequency, days_of_week, days_of_month = habit
+    schedule = compile_habit_schedule(*habit)
+    streak, streak_start, last_completion = compute_streak(schedule, iter_completion_dates_desc(cur, habit_id))
     
-    # Obtener todas las completaciones ordenadas por fecha (más reciente primero)
-    cur.execute('SELECT completion_date FROM habit_completions WHERE habit_id = %s ORDER BY completion_date DESC', (habit_id,))
-    completions = [c[0] for c in cur.fetchall()]
+    # Actualizar la racha en la base de datos
+    save_streak_state(cur, habit_id, streak, streak_start, last_completion)
+    return streak
+
+# Función para leer (y bloquear hasta el commit) el estado de racha guardado en un hábito
+def lock_streak_state(cur, habit_id):
+    cur.execute('''
+        SELECT frequency, days_of_week, days_of_month, days_of_week_mask, days_of_month_mask,
+               current_streak, streak_start_date, last_completion_date
+        FROM habits WHERE id = %s
+        FOR UPDATE
+    ''', (habit_id,))
+    habit = cur.fetchone()
+    if not habit:
+        return None
+    return compile_habit_schedule(*habit[:5]), habit[5] or 0, habit[6], habit[7]
+
+# Función para actualizar la racha tras registrar una completación. El caso habitual
+# (completar una fecha posterior a la última completación) se resuelve en O(1) con el
+# estado guardado en habits; las completaciones hacia atrás recalculan desde el historial.
+def update_streak_on_completion(cur, habit_id, completion_date):
+    state = lock_streak_state(cur, habit_id)
+    if state is None:
+        return None
+    schedule, streak, streak_start, last_completion = state
     
-    if not completions:
-        # No hay completaciones, racha es 0
-        cur.execute('UPDATE habits SET current_streak = 0 WHERE id = %s', (habit_id,))
-        return
+    if last_completion is None:
+        if streak:
+            # Hábito anterior al estado incremental: reconstruirlo una vez
+            return recalculate_streak(cur, habit_id)
+        streak, streak_start = 1, completion_date
+    elif completion_date > last_completion:
+        previous = schedule.previous_scheduled_date(completion_date)
+        if previous == last_completion:
+            # Se completó la fecha programada siguiente: la racha continúa
+            streak += 1
+        elif previous is None or previous > last_completion:
+            # Quedó sin completar al menos una fecha programada: nueva racha
+            streak, streak_start = 1, completion_date
+        else:
+            # La última completación fue en un día no programado
+            return recalculate_streak(cur, habit_id)
+    else:
+        return recalculate_streak(cur, habit_id)
     
-    # La fecha de completación más reciente
-    last_completion = completions[0]
+    save_streak_state(cur, habit_id, streak, streak_start, completion_date)
+    return streak
+
+# Función para actualizar la racha tras eliminar una completación. Quitar una fecha
+# anterior a la racha actual no la cambia, y quitar una fecha dentro de la racha la
+# corta sin consultar el historial; solo quitar la última completación recalcula.
+def update_streak_on_uncompletion(cur, habit_id, completion_date):
+    state = lock_streak_state(cur, habit_id)
+    if state is None:
+        return None
+    schedule, streak, streak_start, last_completion = state
     
-    # Inicializar racha y contador
-    streak = 1
-    current_date = last_completion
+    if last_completion is None or streak_start is None or completion_date >= last_completion:
+        return recalculate_streak(cur, habit_id)
     
-    # Iterar hacia atrás desde la completación más reciente
-    while True:
-        # Verificar el día anterior
-        previous_date = current_date - timedelta(days=1)
-        
-        # Si el hábito estaba programado para el día anterior
-        if is_habit_scheduled_for_date(frequency, days_of_week, days_of_month, previous_date):
-            # Verificar si se completó
-            if previous_date in completions:
-                streak += 1
-                current_date = previous_date
-            else:
-                # Se rompió la racha
-                break
-        else:
-            # Si el hábito no estaba programado para ese día, seguimos hacia atrás
-            current_date = previous_date
+    if completion_date < streak_start or not schedule.is_scheduled(completion_date):
+        # La completación eliminada no formaba parte de la racha actual
+        return streak
     
-    # Actualizar la racha en la base de datos
-    cur.execute('UPDATE habits SET current_streak = %s WHERE id = %s', (streak, habit_id))
+    # La racha pasa a empezar en la primera fecha programada posterior a la eliminada
+    chain = list(schedule.scheduled_dates(completion_date + timedelta(days=1), last_completion))
+    if not schedule.is_scheduled(last_completion):
+        chain.append(last_completion)
+    save_streak_state(cur, habit_id, len(chain), chain[0], last_completion)
+    return len(chain)
+
+# ===== CARGA EN BLOQUE DEL ESTADO DE HÁBITOS ===== #
+
+# Registro con los datos de un hábito y sus completaciones dentro del rango pedido
+HabitState = namedtuple('HabitState', [
+    'id', 'name', 'frequency', 'days_of_week', 'days_of_month',
+    'start_date', 'end_date', 'start_time', 'end_time',
+    'current_streak', 'status',
+    'category_id', 'category_name', 'category_color',
+    'schedule',  # HabitSchedule compilado
+    'completions'  # frozenset de fechas completadas dentro del rango consultado
+])
+
+# Consultas de load_habit_states: los hábitos del usuario con un estado y las
+# completaciones de varios hábitos entre dos fechas (incluidas)
+HABIT_STATES_SQL = '''
+    SELECT h.id, h.name, h.frequency, h.days_of_week, h.days_of_month,
+           h.start_date, h.end_date, h.start_time, h.end_time,
+           h.current_streak, h.status,
+           c.id as category_id, c.name as category_name, c.color as category_color,
+           h.days_of_week_mask, h.days_of_month_mask
+    FROM habits h
+    JOIN habit_categories c ON h.category_id = c.id
+    WHERE h.user_id = %(user_id)s AND h.status = %(status)s
+    ORDER BY h.created_at DESC
+'''
+HABIT_COMPLETIONS_IN_RANGE_SQL = '''
+    SELECT habit_id, completion_date FROM habit_completions
+    WHERE habit_id = ANY(%(habit_ids)s) AND completion_date BETWEEN %(date_from)s AND %(date_to)s
+'''
+
+# Función para cargar los hábitos de un usuario junto con sus completaciones en
+# un rango de fechas. Usa siempre dos consultas, sin importar cuántos hábitos haya.
+def load_habit_states(cur, user_id, range_start, range_end=None, status='active'):
+    if range_end is None:
+        range_end = range_start
+    
+    cur.execute(HABIT_STATES_SQL, {'user_id': user_id, 'status': status})
+    rows = cur.fetchall()
+    if not rows:
+        return []
+    
+    # Obtener las completaciones de todos los hábitos en una sola consulta
+    cur.execute(HABIT_COMPLETIONS_IN_RANGE_SQL, {
+        'habit_ids': [row[0] for row in rows],
+        'date_from': range_start,
+        'date_to': range_end
+    })
+    completions = {}
+    for habit_id, completion_date in cur.fetchall():
+        completions.setdefault(habit_id, set()).add(completion_date)
+    
+    return [
+        HabitState(
+            *row[:14],
+            schedule=compile_habit_schedule(row[2], row[3], row[4], row[14], row[15]),
+            completions=frozenset(completions.get(row[0], ()))
+        )
+        for row in rows
+    ]
 
 # ===== ENDPOINTS PARA EL MÓDULO DE CALENDARIO ===== #
 
@@ -1304,27 +2143,22 @@ def recalculate_streak(cur, habit_id):
 @app.route('/api/events/categories', methods=['GET'])
 @token_required
 def get_event_categories(user_id):
-    conn = get_db_connection()
-    if conn is None:
-        return jsonify({'message': 'Error de conexión a la base de datos'}), 500
-    cur = conn.cursor()
+    # Catálogo global: se sirve desde el registro de datos de referencia
     try:
-        cur.execute('SELECT id, name, color FROM event_categories')
-        categories = cur.fetchall()
-        result = []
-        for cat in categories:
-            result.append({
-                'id': cat[0],
-                'name': cat[1],
-                'color': cat[2]
-            })
-        return jsonify(result)
+        return reference_data_response('event_categories')
     except psycopg2.Error as e:
         print(f"Error al obtener categorías de eventos: {e}")
         return jsonify({'message': f'Error: {e}'}), 500
-    finally:
-        cur.close()
-        conn.close()
+
+# Función para validar que un evento no termine antes de empezar. Si las fechas no
+# se pueden interpretar, la validación queda a cargo de la base de datos.
+def is_valid_event_period(start_datetime, end_datetime):
+    try:
+        start = datetime.fromisoformat(str(start_datetime).replace('Z', '+00:00'))
+        end = datetime.fromisoformat(str(end_datetime).replace('Z', '+00:00'))
+        return end >= start
+    except (TypeError, ValueError):
+        return True
 
 # Endpoint para crear un nuevo evento
 @app.route('/api/events', methods=['POST'])
@@ -1339,10 +2173,19 @@ def create_event(user_id):
     location = data.get('location', '')
     is_all_day = data.get('is_all_day', False)
     google_event_id = data.get('google_event_id', None)
+    recurrence_rule = data.get('recurrence_rule')
     
     if not title or not start_datetime or not end_datetime or not category_id:
         return jsonify({'message': 'Faltan campos obligatorios'}), 400
     
+    if not is_valid_event_period(start_datetime, end_datetime):
+        return jsonify({'message': 'La fecha de fin debe ser igual o posterior a la de inicio'}), 400
+    
+    try:
+        recurrence_rule, recurrence_end = prepare_event_recurrence(recurrence_rule, start_datetime, end_datetime)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+    
     conn = get_db_connection()
     if conn is None:
         return jsonify({'message': 'Error de conexión a la base de datos'}), 500
@@ -1351,13 +2194,14 @@ def create_event(user_id):
         cur.execute(
             '''INSERT INTO events 
                 (user_id, title, description, category_id, start_datetime, end_datetime, 
-                location, is_all_day, google_event_id) 
-               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) 
+                location, is_all_day, google_event_id, recurrence_rule, recurrence_end) 
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) 
                RETURNING id''',
             (user_id, title, description, category_id, start_datetime, end_datetime, 
-             location, is_all_day, google_event_id)
+             location, is_all_day, google_event_id, recurrence_rule, recurrence_end)
         )
         event_id = cur.fetchone()[0]
+        bump_resource_version(cur, user_id, RESOURCE_EVENTS)
         conn.commit()
         
         return jsonify({
@@ -1370,19 +2214,37 @@ def create_event(user_id):
             'location': location,
             'is_all_day': is_all_day,
             'google_event_id': google_event_id,
+            'recurrence_rule': recurrence_rule,
             'message': 'Evento creado correctamente'
         }), 201
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        return jsonify({'message': 'Ya existe un evento con ese google_event_id'}), 409
     except psycopg2.Error as e:
         conn.rollback()
         print(f"Error al crear evento: {e}")
         return jsonify({'message': f'Error al crear evento: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+# Consulta de los eventos no eliminados de un usuario; get_events le añade sus filtros
+# y EVENTS_ORDER_SQL
+EVENTS_SQL = '''
+    SELECT e.id, e.title, e.description, e.category_id, e.start_datetime, 
+           e.end_datetime, e.location, e.is_all_day, e.google_event_id, 
+           e.status, c.name as category_name, c.color as category_color,
+           e.recurrence_rule
+    FROM events e
+    JOIN event_categories c ON e.category_id = c.id
+    WHERE e.user_id = %(user_id)s AND e.status <> 'deleted'
+'''
+EVENTS_ORDER_SQL = " ORDER BY e.start_datetime"
 
 # Endpoint para obtener eventos de un usuario
 @app.route('/api/events', methods=['GET'])
 @token_required
+@conditional_get(RESOURCE_EVENTS)
 def get_events(user_id):
     # Parámetros opcionales para filtrar
     start_date = request.args.get('start_date')
@@ -1395,30 +2257,23 @@ def get_events(user_id):
     cur = conn.cursor()
     
     try:
-        query = '''
-            SELECT e.id, e.title, e.description, e.category_id, e.start_datetime, 
-                   e.end_datetime, e.location, e.is_all_day, e.google_event_id, 
-                   e.status, c.name as category_name, c.color as category_color
-            FROM events e
-            JOIN event_categories c ON e.category_id = c.id
-            WHERE e.user_id = %s
-        '''
-        params = [user_id]
+        query = EVENTS_SQL
+        params = {'user_id': user_id}
         
         # Agregar filtros si se proporcionaron
         if start_date:
-            query += " AND e.start_datetime >= %s"
-            params.append(start_date)
+            query += " AND e.start_datetime >= %(start_date)s"
+            params['start_date'] = start_date
         
         if end_date:
-            query += " AND e.end_datetime <= %s"
-            params.append(end_date)
+            query += " AND e.end_datetime <= %(end_date)s"
+            params['end_date'] = end_date
         
         if category_id:
-            query += " AND e.category_id = %s"
-            params.append(category_id)
+            query += " AND e.category_id = %(category_id)s"
+            params['category_id'] = category_id
         
-        query += " ORDER BY e.start_datetime"
+        query += EVENTS_ORDER_SQL
         
         cur.execute(query, params)
         events = cur.fetchall()
@@ -1439,7 +2294,8 @@ def get_events(user_id):
                 'category': {
                     'name': e[10],
                     'color': e[11]
-                }
+                },
+                'recurrence_rule': e[12]
             })
         
         return jsonify(result)
@@ -1448,7 +2304,7 @@ def get_events(user_id):
         return jsonify({'message': f'Error: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para actualizar un evento
 @app.route('/api/events/<int:event_id>', methods=['PUT'])
@@ -1463,10 +2319,22 @@ def update_event(user_id, event_id):
     location = data.get('location', '')
     is_all_day = data.get('is_all_day', False)
     google_event_id = data.get('google_event_id')
+    # Sin la clave recurrence_rule se conserva la regla guardada; null la elimina
+    keep_recurrence = 'recurrence_rule' not in data
     
     if not title or not start_datetime or not end_datetime or not category_id:
         return jsonify({'message': 'Faltan campos obligatorios'}), 400
     
+    if not is_valid_event_period(start_datetime, end_datetime):
+        return jsonify({'message': 'La fecha de fin debe ser igual o posterior a la de inicio'}), 400
+    
+    if not keep_recurrence:
+        try:
+            recurrence_rule, recurrence_end = prepare_event_recurrence(
+                data['recurrence_rule'], start_datetime, end_datetime)
+        except ValueError as e:
+            return jsonify({'message': str(e)}), 400
+    
     conn = get_db_connection()
     if conn is None:
         return jsonify({'message': 'Error de conexión a la base de datos'}), 500
@@ -1474,24 +2342,41 @@ def update_event(user_id, event_id):
     
     try:
         # Verificar que el evento pertenece al usuario
-        cur.execute('SELECT id FROM events WHERE id = %s AND user_id = %s', (event_id, user_id))
+        cur.execute('''SELECT id, start_datetime, recurrence_rule FROM events
+                       WHERE id = %s AND user_id = %s AND status <> 'deleted' ''',
+                    (event_id, user_id))
         event = cur.fetchone()
         
         if not event:
             return jsonify({'message': 'Evento no encontrado o no pertenece al usuario'}), 404
         
+        # Con la regla guardada, su fin se recalcula para las nuevas fechas
+        if keep_recurrence:
+            try:
+                recurrence_rule, recurrence_end = prepare_event_recurrence(event[2], start_datetime, end_datetime)
+            except ValueError as e:
+                return jsonify({'message': str(e)}), 400
+        
         # Actualizar evento
         cur.execute(
             '''UPDATE events 
                SET title = %s, description = %s, category_id = %s, 
                    start_datetime = %s, end_datetime = %s, location = %s, 
-                   is_all_day = %s, google_event_id = %s, updated_at = CURRENT_TIMESTAMP
+                   is_all_day = %s, google_event_id = %s, recurrence_rule = %s,
+                   recurrence_end = %s, updated_at = CURRENT_TIMESTAMP
                WHERE id = %s AND user_id = %s
-               RETURNING id''',
+               RETURNING start_datetime''',
             (title, description, category_id, start_datetime, end_datetime, 
-             location, is_all_day, google_event_id, event_id, user_id)
+             location, is_all_day, google_event_id, recurrence_rule, recurrence_end, event_id, user_id)
         )
+        new_start = cur.fetchone()[0]
+        
+        # Si cambia la regla o el inicio de la serie, las excepciones ya no
+        # corresponden a ninguna ocurrencia
+        if event[2] and (recurrence_rule != event[2] or new_start != event[1]):
+            cur.execute('DELETE FROM event_exceptions WHERE event_id = %s', (event_id,))
         
+        bump_resource_version(cur, user_id, RESOURCE_EVENTS)
         conn.commit()
         
         return jsonify({
@@ -1504,15 +2389,19 @@ def update_event(user_id, event_id):
             'location': location,
             'is_all_day': is_all_day,
             'google_event_id': google_event_id,
+            'recurrence_rule': recurrence_rule,
             'message': 'Evento actualizado correctamente'
         })
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        return jsonify({'message': 'Ya existe un evento con ese google_event_id'}), 409
     except psycopg2.Error as e:
         conn.rollback()
         print(f"Error al actualizar evento: {e}")
         return jsonify({'message': f'Error al actualizar evento: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 # Endpoint para eliminar un evento
 @app.route('/api/events/<int:event_id>', methods=['DELETE'])
@@ -1525,14 +2414,20 @@ def delete_event(user_id, event_id):
     
     try:
         # Verificar que el evento pertenece al usuario
-        cur.execute('SELECT id, title FROM events WHERE id = %s AND user_id = %s', (event_id, user_id))
+        cur.execute('''SELECT id, title FROM events
+                       WHERE id = %s AND user_id = %s AND status <> 'deleted' ''', (event_id, user_id))
         event = cur.fetchone()
         
         if not event:
             return jsonify({'message': 'Evento no encontrado o no pertenece al usuario'}), 404
         
-        # Eliminar evento
-        cur.execute('DELETE FROM events WHERE id = %s AND user_id = %s', (event_id, user_id))
+        # Eliminar evento: queda como marca de borrado para la sincronización incremental
+        cur.execute(
+            '''UPDATE events SET status = 'deleted', updated_at = CURRENT_TIMESTAMP
+               WHERE id = %s AND user_id = %s''',
+            (event_id, user_id)
+        )
+        bump_resource_version(cur, user_id, RESOURCE_EVENTS)
         conn.commit()
         
         return jsonify({
@@ -1546,11 +2441,485 @@ def delete_event(user_id, event_id):
         return jsonify({'message': f'Error al eliminar evento: {e}'}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+# Función para interpretar el inicio de una ocurrencia (texto ISO). Si trae zona horaria
+# ('...Z' o '+00:00', como las de toISOString() en JS) se descarta sin convertir, igual que
+# al crear, editar o importar eventos y que hace una columna TIMESTAMP de Postgres.
+def parse_occurrence_start(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+
+# Función para comprobar que occurrence_start (texto ISO) es una ocurrencia de la serie;
+# devuelve el datetime de la ocurrencia o None
+def find_series_occurrence(cur, user_id, event_id, occurrence_start):
+    try:
+        occurrence = parse_occurrence_start(occurrence_start)
+    except ValueError:
+        return None
+    cur.execute('''
+        SELECT start_datetime, end_datetime, recurrence_rule
+        FROM events
+        WHERE id = %s AND user_id = %s AND recurrence_rule IS NOT NULL AND status <> 'deleted'
+    ''', (event_id, user_id))
+    series = cur.fetchone()
+    if not series:
+        return None
+    duration = series[1] - series[0]
+    if occurrence not in expand_recurrence(series[2], series[0], duration, occurrence + duration, occurrence):
+        return None
+    return occurrence
+
+# Función para marcar una serie como modificada cuando cambian sus excepciones, para
+# que la sincronización incremental la vuelva a enviar
+def touch_event(cur, event_id):
+    cur.execute('UPDATE events SET updated_at = CURRENT_TIMESTAMP WHERE id = %s', (event_id,))
+
+# Endpoint para modificar una sola ocurrencia de un evento recurrente
+@app.route('/api/events/<int:event_id>/occurrences/<occurrence_start>', methods=['PUT'])
+@token_required
+def update_event_occurrence(user_id, event_id, occurrence_start):
+    data = request.get_json()
+    start_datetime = data.get('start_datetime')
+    end_datetime = data.get('end_datetime')
+    
+    if not start_datetime or not end_datetime:
+        return jsonify({'message': 'Faltan campos obligatorios'}), 400
+    
+    if not is_valid_event_period(start_datetime, end_datetime):
+        return jsonify({'message': 'La fecha de fin debe ser igual o posterior a la de inicio'}), 400
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'message': 'Error de conexión a la base de datos'}), 500
+    cur = conn.cursor()
+    
+    try:
+        occurrence = find_series_occurrence(cur, user_id, event_id, occurrence_start)
+        if occurrence is None:
+            return jsonify({'message': 'Ocurrencia no encontrada'}), 404
+        
+        cur.execute(
+            '''INSERT INTO event_exceptions
+                (event_id, occurrence_start, is_cancelled, title, description,
+                 start_datetime, end_datetime, location)
+               VALUES (%s, %s, false, %s, %s, %s, %s, %s)
+               ON CONFLICT (event_id, occurrence_start) DO UPDATE
+               SET is_cancelled = false, title = EXCLUDED.title, description = EXCLUDED.description,
+                   start_datetime = EXCLUDED.start_datetime, end_datetime = EXCLUDED.end_datetime,
+                   location = EXCLUDED.location, updated_at = CURRENT_TIMESTAMP''',
+            (event_id, occurrence, data.get('title'), data.get('description'),
+             start_datetime, end_datetime, data.get('location'))
+        )
+        touch_event(cur, event_id)
+        bump_resource_version(cur, user_id, RESOURCE_EVENTS)
+        conn.commit()
+        
+        return jsonify({
+            'id': event_id,
+            'occurrence_start': occurrence.strftime('%Y-%m-%dT%H:%M:%S'),
+            'start_datetime': start_datetime,
+            'end_datetime': end_datetime,
+            'message': 'Ocurrencia actualizada correctamente'
+        })
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al actualizar ocurrencia: {e}")
+        return jsonify({'message': f'Error al actualizar ocurrencia: {e}'}), 500
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+# Endpoint para cancelar una sola ocurrencia de un evento recurrente
+@app.route('/api/events/<int:event_id>/occurrences/<occurrence_start>', methods=['DELETE'])
+@token_required
+def cancel_event_occurrence(user_id, event_id, occurrence_start):
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'message': 'Error de conexión a la base de datos'}), 500
+    cur = conn.cursor()
+    
+    try:
+        occurrence = find_series_occurrence(cur, user_id, event_id, occurrence_start)
+        if occurrence is None:
+            return jsonify({'message': 'Ocurrencia no encontrada'}), 404
+        
+        cur.execute(
+            '''INSERT INTO event_exceptions (event_id, occurrence_start, is_cancelled)
+               VALUES (%s, %s, true)
+               ON CONFLICT (event_id, occurrence_start) DO UPDATE
+               SET is_cancelled = true, updated_at = CURRENT_TIMESTAMP''',
+            (event_id, occurrence)
+        )
+        touch_event(cur, event_id)
+        bump_resource_version(cur, user_id, RESOURCE_EVENTS)
+        conn.commit()
+        
+        return jsonify({
+            'id': event_id,
+            'occurrence_start': occurrence.strftime('%Y-%m-%dT%H:%M:%S'),
+            'message': 'Ocurrencia cancelada correctamente'
+        })
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al cancelar ocurrencia: {e}")
+        return jsonify({'message': f'Error al cancelar ocurrencia: {e}'}), 500
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+# ===== EVENTOS RECURRENTES ===== #
+
+# Una serie recurrente es una sola fila de events con recurrence_rule, un subconjunto
+# de RRULE (RFC 5545): FREQ=DAILY|WEEKLY|MONTHLY|YEARLY, INTERVAL, BYDAY (semanal),
+# BYMONTHDAY (mensual), COUNT y UNTIL. Las ocurrencias solo se generan dentro de la
+# ventana consultada; las canceladas o modificadas se guardan en event_exceptions.
+RRULE_FREQUENCIES = ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY')
+RRULE_WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+RRULE_MAX_COUNT = 5000
+# Periodos seguidos sin ocurrencias tras los que una regla se considera agotada
+# (p. ej. BYMONTHDAY=31 con INTERVAL=12 empezando en un mes de 30 días)
+RRULE_MAX_EMPTY_PERIODS = 1000
+
+RecurrenceRule = namedtuple('RecurrenceRule', ['freq', 'interval', 'by_weekday', 'by_month_day', 'count', 'until'])
+
+# Función para interpretar una regla de recurrencia; lanza ValueError si no es válida
+@lru_cache(maxsize=1024)
+def parse_recurrence_rule(rule):
+    parts = {}
+    text = rule.strip().upper()
+    if text.startswith('RRULE:'):
+        text = text[len('RRULE:'):]
+    for part in text.split(';'):
+        if not part:
+            continue
+        key, separator, value = part.partition('=')
+        if not separator or not value:
+            raise ValueError(f'Parte inválida en la regla de recurrencia: {part}')
+        parts[key] = value
+    
+    freq = parts.pop('FREQ', None)
+    if freq not in RRULE_FREQUENCIES:
+        raise ValueError('FREQ debe ser DAILY, WEEKLY, MONTHLY o YEARLY')
+    
+    interval = int(parts.pop('INTERVAL', '1'))
+    if interval < 1:
+        raise ValueError('INTERVAL debe ser mayor que 0')
+    
+    by_weekday = ()
+    if 'BYDAY' in parts:
+        if freq != 'WEEKLY':
+            raise ValueError('BYDAY solo se admite con FREQ=WEEKLY')
+        days = parts.pop('BYDAY').split(',')
+        if any(day not in RRULE_WEEKDAYS for day in days):
+            raise ValueError('BYDAY solo admite MO, TU, WE, TH, FR, SA y SU')
+        by_weekday = tuple(sorted({RRULE_WEEKDAYS.index(day) for day in days}))
+    
+    by_month_day = ()
+    if 'BYMONTHDAY' in parts:
+        if freq != 'MONTHLY':
+            raise ValueError('BYMONTHDAY solo se admite con FREQ=MONTHLY')
+        by_month_day = tuple(sorted({int(day) for day in parts.pop('BYMONTHDAY').split(',')}))
+        if any(day < 1 or day > 31 for day in by_month_day):
+            raise ValueError('BYMONTHDAY debe estar entre 1 y 31')
+    
+    count = None
+    if 'COUNT' in parts:
+        count = int(parts.pop('COUNT'))
+        if count < 1 or count > RRULE_MAX_COUNT:
+            raise ValueError(f'COUNT debe estar entre 1 y {RRULE_MAX_COUNT}')
+    
+    until = None
+    if 'UNTIL' in parts:
+        value = parts.pop('UNTIL').rstrip('Z')
+        if 'T' in value:
+            until = datetime.strptime(value, '%Y%m%dT%H%M%S')
+        else:
+            until = datetime.combine(datetime.strptime(value, '%Y%m%d').date(), datetime.max.time())
+    
+    if count is not None and until is not None:
+        raise ValueError('COUNT y UNTIL no pueden usarse a la vez')
+    if parts:
+        raise ValueError(f"Parámetros de recurrencia no admitidos: {', '.join(sorted(parts))}")
+    
+    return RecurrenceRule(freq, interval, by_weekday, by_month_day, count, until)
+
+# Función para calcular el primer periodo (día, semana, mes o año según FREQ) que
+# puede contener ocurrencias a partir de not_before, para no recorrer los anteriores
+def _first_recurrence_period(rule, dtstart, not_before):
+    if not_before is None or not_before <= dtstart:
+        return 0
+    if rule.freq == 'DAILY':
+        elapsed = (not_before.date() - dtstart.date()).days
+    elif rule.freq == 'WEEKLY':
+        week_start = dtstart.date() - timedelta(days=dtstart.weekday())
+        elapsed = (not_before.date() - week_start).days // 7
+    elif rule.freq == 'MONTHLY':
+        elapsed = (not_before.year - dtstart.year) * 12 + not_before.month - dtstart.month
+    else:
+        elapsed = not_before.year - dtstart.year
+    return max(0, elapsed // rule.interval)
+
+# Función con los inicios de ocurrencia candidatos de un periodo, en orden
+def _recurrence_period_starts(rule, dtstart, period):
+    step = period * rule.interval
+    if rule.freq == 'DAILY':
+        return [dtstart + timedelta(days=step)]
+    
+    if rule.freq == 'WEEKLY':
+        week_start = dtstart.date() - timedelta(days=dtstart.weekday()) + timedelta(weeks=step)
+        return [datetime.combine(week_start + timedelta(days=weekday), dtstart.time())
+                for weekday in rule.by_weekday or (dtstart.weekday(),)]
+    
+    if rule.freq == 'MONTHLY':
+        months = dtstart.month - 1 + step
+        year, month = dtstart.year + months // 12, months % 12 + 1
+        last_day = monthrange(year, month)[1]
+        return [datetime.combine(date(year, month, day), dtstart.time())
+                for day in rule.by_month_day or (dtstart.day,) if day <= last_day]
+    
+    try:
+        return [dtstart.replace(year=dtstart.year + step)]
+    except ValueError:
+        return []  # 29 de febrero en un año no bisiesto
+
+# Genera en orden ascendente los inicios de las ocurrencias de una regla (sin aplicar
+# COUNT ni UNTIL). Con not_before, salta directamente al periodo que lo contiene.
+def iter_recurrence_starts(rule, dtstart, not_before=None):
+    period = _first_recurrence_period(rule, dtstart, not_before)
+    empty_periods = 0
+    while empty_periods < RRULE_MAX_EMPTY_PERIODS:
+        try:
+            starts = [start for start in _recurrence_period_starts(rule, dtstart, period) if start >= dtstart]
+        except (OverflowError, ValueError):
+            return  # fuera del rango de fechas representable
+        empty_periods = 0 if starts else empty_periods + 1
+        yield from starts
+        period += 1
+
+# Función para obtener los inicios de las ocurrencias de una serie que se solapan con
+# [window_start, window_end]. La expansión se cachea por (regla, inicio, duración, ventana),
+# así que las vistas repetidas de la misma ventana no vuelven a expandir la serie.
+@lru_cache(maxsize=2048)
+def expand_recurrence(rule_text, dtstart, duration, window_start, window_end):
+    rule = parse_recurrence_rule(rule_text)
+    not_before = window_start - duration
+    # Con COUNT hay que contar desde el principio; si no, se salta hasta la ventana
+    starts = iter_recurrence_starts(rule, dtstart, None if rule.count else not_before)
+    
+    result = []
+    for index, start in enumerate(starts):
+        if rule.count is not None and index >= rule.count:
+            break
+        if rule.until is not None and start > rule.until:
+            break
+        if start > window_end:
+            break
+        if start >= not_before:
+            result.append(start)
+    return tuple(result)
+
+# Función para calcular el fin de la última ocurrencia de una serie (None si no termina);
+# lanza ValueError si la regla no es válida o no genera ninguna ocurrencia
+def compute_recurrence_end(rule_text, dtstart, duration):
+    rule = parse_recurrence_rule(rule_text)
+    if rule.count is None and rule.until is None:
+        return None
+    
+    last_start = None
+    for index, start in enumerate(iter_recurrence_starts(rule, dtstart)):
+        if rule.count is not None and index >= rule.count:
+            break
+        if rule.until is not None and start > rule.until:
+            break
+        last_start = start
+    
+    if last_start is None:
+        raise ValueError('La regla de recurrencia no genera ninguna ocurrencia')
+    return last_start + duration
+
+# Función para validar los datos de recurrencia de un evento y calcular recurrence_end.
+# Lanza ValueError con un mensaje para el usuario si no son válidos.
+def prepare_event_recurrence(recurrence_rule, start_datetime, end_datetime):
+    if not recurrence_rule:
+        return None, None
+    try:
+        start = datetime.fromisoformat(str(start_datetime).replace('Z', '+00:00')).replace(tzinfo=None)
+        end = datetime.fromisoformat(str(end_datetime).replace('Z', '+00:00')).replace(tzinfo=None)
+        recurrence_end = compute_recurrence_end(recurrence_rule, start, end - start)
+    except ValueError as e:
+        raise ValueError(f'Regla de recurrencia inválida: {e}')
+    return recurrence_rule.strip().upper(), recurrence_end
+
+# Función para cargar las excepciones de varias series que afectan a una ventana: las
+# de ocurrencias originales de la ventana y las modificadas que caen dentro de ella.
+# Devuelve {event_id: {occurrence_start: fila}}.
+def load_event_exceptions(cur, event_ids, window_start, window_end, max_duration):
+    cur.execute('''
+        SELECT event_id, occurrence_start, is_cancelled, title, description,
+               start_datetime, end_datetime, location
+        FROM event_exceptions
+        WHERE event_id = ANY(%s)
+        AND (
+            occurrence_start BETWEEN %s AND %s
+            OR (NOT is_cancelled AND tsrange(start_datetime, end_datetime, '[]') && tsrange(%s, %s, '[]'))
+        )
+    ''', (event_ids, window_start - max_duration, window_end, window_start, window_end))
+    exceptions = {}
+    for row in cur.fetchall():
+        exceptions.setdefault(row[0], {})[row[1]] = row
+    return exceptions
+
+# Genera las ocurrencias sin excepción de una serie dentro de la ventana, en orden de
+# inicio, con la misma forma que las filas de fetch_events_overlapping
+def iter_series_occurrences(row, exceptions, window_start, window_end):
+    duration = row[5] - row[4]
+    for start in expand_recurrence(row[11], row[4], duration, window_start, window_end):
+        if start not in exceptions:
+            yield row[:4] + (start, start + duration) + row[6:12] + (start,)
+
+# Función con las ocurrencias modificadas de una serie que caen en la ventana, en orden
+def series_overridden_occurrences(row, exceptions, window_start, window_end):
+    occurrences = []
+    for exception in exceptions.values():
+        _, occurrence_start, is_cancelled, title, description, start, end, location = exception
+        if is_cancelled or end < window_start or start > window_end:
+            continue
+        occurrences.append(row[:1] + (title or row[1], description if description is not None else row[2], row[3],
+                                      start, end, location if location is not None else row[6])
+                           + row[7:12] + (occurrence_start,))
+    occurrences.sort(key=itemgetter(4))
+    return occurrences
+
+# ===== CONSULTAS DE CALENDARIO POR RANGO ===== #
+
+# Máximo de días que puede abarcar una consulta de calendario por rango
+MAX_CALENDAR_RANGE_DAYS = 92
+
+# Periodo completo de un evento: de inicio a fin, o del primer inicio al fin de la última
+# ocurrencia para una serie (sin límite si no termina). Coincide con idx_events_user_span.
+EVENT_SPAN_SQL = "tsrange(e.start_datetime, CASE WHEN e.recurrence_rule IS NULL THEN e.end_datetime ELSE e.recurrence_end END, '[]')"
+
+# Consulta de los eventos activos (sin expandir) cuyo periodo se solapa con un rango
+EVENTS_OVERLAPPING_SQL = f'''
+    SELECT e.id, e.title, e.description, e.category_id, e.start_datetime, 
+           e.end_datetime, e.location, e.is_all_day, e.google_event_id,
+           c.name as category_name, c.color as category_color, e.recurrence_rule
+    FROM events e
+    JOIN event_categories c ON e.category_id = c.id
+    WHERE e.user_id = %(user_id)s
+    AND {EVENT_SPAN_SQL} && tsrange(%(range_start)s, %(range_end)s, '[]')
+    AND e.status = 'active'
+    ORDER BY e.start_datetime
+'''
+
+# Función para obtener las ocurrencias de eventos activos que se solapan con
+# [range_start, range_end], en orden de inicio. Las series recurrentes se expanden solo
+# dentro de la ventana, por lo que el coste depende del número de series y no de ocurrencias.
+# Cada fila: (id, title, description, category_id, start, end, location, is_all_day,
+# google_event_id, category_name, category_color, recurrence_rule, occurrence_start)
+def fetch_events_overlapping(cur, user_id, range_start, range_end):
+    cur.execute(EVENTS_OVERLAPPING_SQL,
+                {'user_id': user_id, 'range_start': range_start, 'range_end': range_end})
+    rows = cur.fetchall()
+    
+    series = [row for row in rows if row[11]]
+    exceptions = {}
+    if series:
+        max_duration = max(row[5] - row[4] for row in series)
+        exceptions = load_event_exceptions(cur, [row[0] for row in series], range_start, range_end, max_duration)
+    return merge_event_occurrences(rows, exceptions, range_start, range_end)
+
+# Función para combinar en orden de inicio las filas de eventos simples con las
+# ocurrencias expandidas de las series (rows ordenadas por inicio, exceptions como las
+# devuelve load_event_exceptions)
+def merge_event_occurrences(rows, exceptions, range_start, range_end):
+    single_events = [row + (None,) for row in rows if not row[11]]
+    series = [row for row in rows if row[11]]
+    if not series:
+        return single_events
+    
+    streams = [single_events]
+    for row in series:
+        series_exceptions = exceptions.get(row[0], {})
+        streams.append(iter_series_occurrences(row, series_exceptions, range_start, range_end))
+        if series_exceptions:
+            streams.append(series_overridden_occurrences(row, series_exceptions, range_start, range_end))
+    return heapq.merge(*streams, key=itemgetter(4))
+
+# Función para convertir una fila de fetch_events_overlapping en la respuesta JSON
+def event_row_to_dict(e):
+    event = {
+        'id': e[0],
+        'title': e[1],
+        'description': e[2],
+        'category_id': e[3],
+        'start_datetime': e[4].strftime('%Y-%m-%dT%H:%M:%S'),
+        'end_datetime': e[5].strftime('%Y-%m-%dT%H:%M:%S'),
+        'location': e[6],
+        'is_all_day': e[7],
+        'google_event_id': e[8],
+        'category': {
+            'name': e[9],
+            'color': e[10]
+        }
+    }
+    # Las ocurrencias de una serie llevan el id de la serie y su inicio original
+    if e[11]:
+        event['recurrence_rule'] = e[11]
+        event['occurrence_start'] = e[12].strftime('%Y-%m-%dT%H:%M:%S')
+    return event
+
+# Genera perezosamente las ocurrencias de un hábito con horario dentro del rango,
+# en orden de inicio, como (inicio, fin, 'habit', (hábito, día))
+def iter_habit_occurrences(h, date_from, date_to):
+    for day in h.schedule.scheduled_dates(date_from, date_to):
+        yield datetime.combine(day, h.start_time), datetime.combine(day, h.end_time), 'habit', (h, day)
+
+# Genera las ocurrencias del calendario (eventos y hábitos) del rango en orden de inicio.
+# events son filas de fetch_events_overlapping (ya ordenadas por inicio) y habit_states
+# registros de load_habit_states (con sus completaciones del rango ya cargadas). Cada
+# flujo está ordenado, así que se mezclan con un heap sin ordenar la lista completa.
+def iter_calendar_occurrences(events, habit_states, date_from, date_to):
+    event_stream = ((e[4], e[5], 'event', e) for e in events)
+    habit_streams = [iter_habit_occurrences(h, date_from, date_to)
+                     for h in habit_states if h.start_time and h.end_time]
+    return heapq.merge(event_stream, *habit_streams, key=itemgetter(0))
+
+# Función para convertir una ocurrencia de iter_calendar_occurrences en la respuesta JSON
+def occurrence_to_dict(occurrence):
+    _, _, kind, source = occurrence
+    if kind == 'habit':
+        return habit_occurrence_to_dict(*source)
+    return event_row_to_dict(source)
+
+# Función para representar la ocurrencia de un hábito en un día como un evento
+def habit_occurrence_to_dict(h, day):
+    # Crear fechas completas con la hora
+    habit_start = datetime.combine(day, h.start_time)
+    habit_end = datetime.combine(day, h.end_time)
+    
+    return {
+        'id': f"habit_{h.id}",  # Añadir prefijo para distinguir de eventos
+        'title': h.name,
+        'description': f"Hábito: {h.name}",
+        'category_id': 5,  # Usar la categoría de Hábitos
+        'start_datetime': habit_start.strftime('%Y-%m-%dT%H:%M:%S'),
+        'end_datetime': habit_end.strftime('%Y-%m-%dT%H:%M:%S'),
+        'location': '',
+        'is_all_day': False,
+        'google_event_id': None,
+        'category': {
+            'name': 'Hábitos',
+            'color': 'green'
+        },
+        'is_habit': True,  # Marcar como hábito para UI
+        'completed': day in h.completions
+    }
 
 # Endpoint para obtener eventos para un día específico
 @app.route('/api/events/day', methods=['GET'])
 @token_required
+@conditional_get(RESOURCE_EVENTS, RESOURCE_HABITS)
 def get_events_for_day(user_id):
     date_str = request.args.get('date')
     
@@ -1570,115 +2939,1263 @@ def get_events_for_day(user_id):
             return jsonify({'message': 'Error de conexión a la base de datos'}), 500
         cur = conn.cursor()
         
-        # Obtener eventos del día
-        cur.execute('''
-            SELECT e.id, e.title, e.description, e.category_id, e.start_datetime, 
-                   e.end_datetime, e.location, e.is_all_day, e.google_event_id,
-                   c.name as category_name, c.color as category_color
-            FROM events e
-            JOIN event_categories c ON e.category_id = c.id
-            WHERE e.user_id = %s 
-            AND (
-                (e.start_datetime BETWEEN %s AND %s) OR 
-                (e.end_datetime BETWEEN %s AND %s) OR
-                (e.start_datetime <= %s AND e.end_datetime >= %s)
-            )
-            AND e.status = 'active'
-            ORDER BY e.start_datetime
-        ''', (user_id, day_start, day_end, day_start, day_end, day_start, day_end))
+        # Obtener eventos del día y hábitos programados para este día
+        # (solo los que tienen hora de inicio y fin), ya en orden de inicio
+        events = fetch_events_overlapping(cur, user_id, day_start, day_end)
+        habits = load_habit_states(cur, user_id, target_date)
+        result = [occurrence_to_dict(occurrence)
+                  for occurrence in iter_calendar_occurrences(events, habits, target_date, target_date)]
         
-        events = cur.fetchall()
-        result = []
+        return jsonify(result)
+    except Exception as e:
+        print(f"Error al obtener eventos del día: {e}")
+        return jsonify({'message': f'Error: {e}'}), 500
+    finally:
+        if 'conn' in locals() and conn:
+            cur.close()
+            release_db_connection(conn)
+
+# Endpoint para obtener los eventos y hábitos de un rango de días (vista semana/mes)
+# agrupados por día, en una sola petición: /api/events/range?from=YYYY-MM-DD&to=YYYY-MM-DD
+@app.route('/api/events/range', methods=['GET'])
+@token_required
+@conditional_get(RESOURCE_EVENTS, RESOURCE_HABITS)
+def get_events_for_range(user_id):
+    try:
+        date_from = datetime.strptime(request.args.get('from', ''), '%Y-%m-%d').date()
+        date_to = datetime.strptime(request.args.get('to', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'message': 'Los parámetros from y to son obligatorios (YYYY-MM-DD)'}), 400
+    
+    if date_to < date_from:
+        return jsonify({'message': 'La fecha "to" debe ser igual o posterior a "from"'}), 400
+    
+    if (date_to - date_from).days + 1 > MAX_CALENDAR_RANGE_DAYS:
+        return jsonify({'message': f'El rango no puede superar {MAX_CALENDAR_RANGE_DAYS} días'}), 400
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'message': 'Error de conexión a la base de datos'}), 500
+    cur = conn.cursor()
+    try:
+        range_start = datetime.combine(date_from, datetime.min.time())
+        range_end = datetime.combine(date_to, datetime.max.time())
         
-        for e in events:
+        days = {}
+        for i in range((date_to - date_from).days + 1):
+            days[date_from + timedelta(days=i)] = []
+        
+        events = fetch_events_overlapping(cur, user_id, range_start, range_end)
+        habits = load_habit_states(cur, user_id, date_from, date_to)
+        
+        # Las ocurrencias llegan en orden de inicio, así que cada día queda ordenado.
+        # Los eventos de varios días aparecen en cada día que abarcan dentro del rango.
+        for occurrence in iter_calendar_occurrences(events, habits, date_from, date_to):
+            item = occurrence_to_dict(occurrence)
+            day = max(occurrence[0].date(), date_from)
+            last_day = min(occurrence[1].date(), date_to)
+            while day <= last_day:
+                days[day].append(item)
+                day += timedelta(days=1)
+        
+        result = []
+        for day, items in days.items():
             result.append({
-                'id': e[0],
-                'title': e[1],
-                'description': e[2],
-                'category_id': e[3],
-                'start_datetime': e[4].strftime('%Y-%m-%dT%H:%M:%S'),
-                'end_datetime': e[5].strftime('%Y-%m-%dT%H:%M:%S'),
-                'location': e[6],
-                'is_all_day': e[7],
-                'google_event_id': e[8],
-                'category': {
-                    'name': e[9],
-                    'color': e[10]
-                }
+                'date': day.strftime('%Y-%m-%d'),
+                'events': items
             })
         
-        # Obtener hábitos programados para este día
-        # Solo incluirlos si tienen hora de inicio y fin
+        return jsonify({
+            'from': date_from.strftime('%Y-%m-%d'),
+            'to': date_to.strftime('%Y-%m-%d'),
+            'days': result
+        })
+    except psycopg2.Error as e:
+        print(f"Error al obtener eventos del rango: {e}")
+        return jsonify({'message': f'Error: {e}'}), 500
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+# ===== CONFLICTOS Y HUECOS LIBRES ===== #
+
+# Los eventos de esta categoría marcan tiempo libre, no ocupado
+FREE_BLOCK_CATEGORY = 'Bloques libres'
+# Máximo de conflictos devueltos por consulta (un día muy solapado puede generar muchos pares)
+MAX_CONFLICTS = 500
+
+# Horario que create_habit/update_habit asignan a un hábito sin hora concreta
+UNTIMED_HABIT_HOURS = ('00:00', '23:59')
+
+# Función para saber si un hábito no tiene hora concreta (sin horas o de 00:00 a 23:59)
+def is_untimed_habit(h):
+    if not h.start_time or not h.end_time:
+        return True
+    return (h.start_time.strftime('%H:%M'), h.end_time.strftime('%H:%M')) == UNTIMED_HABIT_HOURS
+
+# Función para saber si una ocurrencia ocupa tiempo. Los eventos de todo el día, los
+# hábitos sin hora concreta y los bloques libres no cuentan como ocupados ni generan conflictos.
+def is_busy_occurrence(occurrence):
+    _, _, kind, source = occurrence
+    if kind == 'habit':
+        return not is_untimed_habit(source[0])
+    return not source[7] and source[9] != FREE_BLOCK_CATEGORY
+
+# Función para encontrar conflictos y huecos libres con un barrido sobre ocurrencias
+# ordenadas por inicio. Mantiene en un heap las ocurrencias activas (ordenadas por fin),
+# así que cada ocurrencia solo se compara con las que siguen abiertas al empezar, y a la
+# vez fusiona los intervalos ocupados. windows son los tramos (ordenados y disjuntos) en
+# los que se buscan huecos de al menos min_slot.
+# Devuelve (conflictos [(ocurrencia, ocurrencia)], truncado, huecos [(inicio, fin)]).
+def find_conflicts_and_free_slots(occurrences, windows, min_slot, max_conflicts=MAX_CONFLICTS):
+    conflicts = []
+    truncated = False
+    active = []
+    busy = []
+    for seq, occurrence in enumerate(occurrences):
+        start, end = occurrence[0], occurrence[1]
+        
+        # Las que terminan justo cuando empieza esta no se solapan
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for _, _, other in active:
+            if len(conflicts) >= max_conflicts:
+                truncated = True
+                break
+            conflicts.append((other, occurrence))
+        heapq.heappush(active, (end, seq, occurrence))
+        
+        if busy and start <= busy[-1][1]:
+            busy[-1][1] = max(busy[-1][1], end)
+        else:
+            busy.append([start, end])
+    
+    free_slots = []
+    first = 0
+    for window_start, window_end in windows:
+        # Los intervalos que terminan antes de esta ventana tampoco afectan a las siguientes
+        while first < len(busy) and busy[first][1] <= window_start:
+            first += 1
+        cursor = window_start
+        i = first
+        while i < len(busy) and busy[i][0] < window_end:
+            if busy[i][0] - cursor >= min_slot:
+                free_slots.append((cursor, busy[i][0]))
+            cursor = max(cursor, busy[i][1])
+            i += 1
+        if window_end - cursor >= min_slot:
+            free_slots.append((cursor, window_end))
+    
+    return conflicts, truncated, free_slots
+
+# Endpoint para detectar conflictos y huecos libres en un rango de fechas:
+# /api/events/availability?from=YYYY-MM-DD&to=YYYY-MM-DD&min_slot=30&day_start=08:00&day_end=22:00
+# min_slot está en minutos; day_start y day_end limitan la búsqueda de huecos a esas horas de cada día
+@app.route('/api/events/availability', methods=['GET'])
+@token_required
+@conditional_get(RESOURCE_EVENTS, RESOURCE_HABITS)
+def get_events_availability(user_id):
+    try:
+        date_from = datetime.strptime(request.args.get('from', ''), '%Y-%m-%d').date()
+        date_to = datetime.strptime(request.args.get('to', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'message': 'Los parámetros from y to son obligatorios (YYYY-MM-DD)'}), 400
+    
+    try:
+        min_slot_minutes = int(request.args.get('min_slot', 30))
+        day_start = datetime.strptime(request.args.get('day_start', '00:00'), '%H:%M').time()
+        day_end = datetime.strptime(request.args.get('day_end', '23:59'), '%H:%M').time()
+    except ValueError:
+        return jsonify({'message': 'min_slot debe ser un número de minutos y day_start/day_end tener formato HH:MM'}), 400
+    
+    if date_to < date_from:
+        return jsonify({'message': 'La fecha "to" debe ser igual o posterior a "from"'}), 400
+    
+    if (date_to - date_from).days + 1 > MAX_CALENDAR_RANGE_DAYS:
+        return jsonify({'message': f'El rango no puede superar {MAX_CALENDAR_RANGE_DAYS} días'}), 400
+    
+    if min_slot_minutes < 1 or day_end <= day_start:
+        return jsonify({'message': 'min_slot debe ser positivo y day_end posterior a day_start'}), 400
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'message': 'Error de conexión a la base de datos'}), 500
+    cur = conn.cursor()
+    try:
+        range_start = datetime.combine(date_from, datetime.min.time())
+        range_end = datetime.combine(date_to, datetime.max.time())
+        
+        events = fetch_events_overlapping(cur, user_id, range_start, range_end)
+        habits = load_habit_states(cur, user_id, date_from, date_to)
+        occurrences = (occurrence for occurrence in iter_calendar_occurrences(events, habits, date_from, date_to)
+                       if is_busy_occurrence(occurrence))
+        
+        windows = []
+        for i in range((date_to - date_from).days + 1):
+            day = date_from + timedelta(days=i)
+            windows.append((datetime.combine(day, day_start), datetime.combine(day, day_end)))
+        
+        conflicts, truncated, free_slots = find_conflicts_and_free_slots(
+            occurrences, windows, timedelta(minutes=min_slot_minutes))
+        
+        # Una misma ocurrencia puede aparecer en varios conflictos; se serializa una vez
+        serialized = {}
+        def to_dict(occurrence):
+            key = id(occurrence)
+            if key not in serialized:
+                serialized[key] = occurrence_to_dict(occurrence)
+            return serialized[key]
+        
+        conflict_list = []
+        for first, second in conflicts:
+            conflict_list.append({
+                'items': [to_dict(first), to_dict(second)],
+                'overlap_start': second[0].strftime('%Y-%m-%dT%H:%M:%S'),
+                'overlap_end': min(first[1], second[1]).strftime('%Y-%m-%dT%H:%M:%S')
+            })
+        
+        free_list = []
+        for start, end in free_slots:
+            free_list.append({
+                'start_datetime': start.strftime('%Y-%m-%dT%H:%M:%S'),
+                'end_datetime': end.strftime('%Y-%m-%dT%H:%M:%S'),
+                'minutes': int((end - start).total_seconds() // 60)
+            })
+        
+        return jsonify({
+            'from': date_from.strftime('%Y-%m-%d'),
+            'to': date_to.strftime('%Y-%m-%d'),
+            'min_slot': min_slot_minutes,
+            'conflicts': conflict_list,
+            'conflicts_truncated': truncated,
+            'free_slots': free_list
+        })
+    except psycopg2.Error as e:
+        print(f"Error al calcular la disponibilidad: {e}")
+        return jsonify({'message': f'Error: {e}'}), 500
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+# ===== SINCRONIZACIÓN INCREMENTAL DE EVENTOS ===== #
+
+# Cambios por página de sincronización
+SYNC_PAGE_SIZE = 500
+# Segundos que debe tener un cambio para entrar en una respuesta. updated_at es la hora
+# de inicio de la transacción que lo escribió, así que una transacción lenta puede
+# confirmar un updated_at anterior al último ya enviado; esperar a que los cambios se
+# asienten evita que el cliente se los salte. Límite conocido: una transacción que tarde
+# más que este margen en confirmarse (p. ej. una importación masiva grande, que se
+# confirma de una vez) puede quedar por detrás de un token ya entregado y el cliente no
+# verá esos cambios hasta una resincronización completa. Si hay importaciones largas,
+# subir SYNC_SETTLE_SECONDS por encima de su duración.
+SYNC_SETTLE_SECONDS = int(os.getenv('SYNC_SETTLE_SECONDS', 2))
+# Días que se conservan las marcas de borrado; un token emitido hace más tiempo obliga a
+# resincronizar
+EVENT_TOMBSTONE_RETENTION_DAYS = 90
+
+# Funciones para codificar/decodificar el token de sincronización, que apunta al último
+# cambio enviado por (updated_at, id) y guarda cuándo se emitió: la caducidad depende de
+# la antigüedad del token, no de la del último cambio (que puede ser de hace meses)
+def encode_sync_token(updated_at, event_id):
+    payload = json.dumps({'u': updated_at.isoformat(), 'i': event_id,
+                          't': datetime.now().isoformat()}).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+# Devuelve (updated_at, id, emitido); los tokens sin 't' se consideran emitidos en updated_at
+def decode_sync_token(token):
+    payload = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+    return (datetime.fromisoformat(payload['u']), int(payload['i']),
+            datetime.fromisoformat(payload.get('t', payload['u'])))
+
+# Función para cargar las excepciones de varias series como {event_id: [excepción JSON]}
+def load_series_exceptions_json(cur, event_ids):
+    if not event_ids:
+        return {}
+    cur.execute('''
+        SELECT event_id, occurrence_start, is_cancelled, title, description,
+               start_datetime, end_datetime, location
+        FROM event_exceptions
+        WHERE event_id = ANY(%s)
+        ORDER BY event_id, occurrence_start
+    ''', (event_ids,))
+    exceptions = {}
+    for row in cur.fetchall():
+        exceptions.setdefault(row[0], []).append({
+            'occurrence_start': row[1].strftime('%Y-%m-%dT%H:%M:%S'),
+            'is_cancelled': row[2],
+            'title': row[3],
+            'description': row[4],
+            'start_datetime': row[5].strftime('%Y-%m-%dT%H:%M:%S') if row[5] else None,
+            'end_datetime': row[6].strftime('%Y-%m-%dT%H:%M:%S') if row[6] else None,
+            'location': row[7]
+        })
+    return exceptions
+
+# Consulta de una página de cambios de eventos posteriores a (since, since_id) y ya
+# asentados; sin include_deleted (sincronización inicial) se omiten las marcas de borrado
+SYNC_EVENTS_SQL = f'''
+    SELECT e.id, e.title, e.description, e.category_id, e.start_datetime,
+           e.end_datetime, e.location, e.is_all_day, e.google_event_id,
+           c.name, c.color, e.recurrence_rule, e.status, e.updated_at
+    FROM events e
+    JOIN event_categories c ON e.category_id = c.id
+    WHERE e.user_id = %(user_id)s
+    AND (e.updated_at, e.id) > (%(since)s, %(since_id)s)
+    AND e.updated_at <= LOCALTIMESTAMP - interval '{SYNC_SETTLE_SECONDS} seconds'
+    AND (%(include_deleted)s OR e.status <> 'deleted')
+    ORDER BY e.updated_at, e.id
+    LIMIT %(limit)s
+'''
+
+# Endpoint de sincronización incremental de eventos: /api/events/sync?token=...
+# Sin token devuelve todos los eventos vigentes; con token, solo los creados, modificados
+# o eliminados desde entonces (los eliminados como {id, deleted: true}). Si has_more es
+# true, el cliente debe volver a pedir con next_token inmediatamente; si no, guardarlo
+# para la próxima sincronización. Cada página lee el índice (user_id, updated_at, id).
+@app.route('/api/events/sync', methods=['GET'])
+@token_required
+def sync_events(user_id):
+    token = request.args.get('token')
+    if token:
+        try:
+            since, since_id, issued_at = decode_sync_token(token)
+        except (ValueError, KeyError, TypeError):
+            return jsonify({'message': 'Token de sincronización inválido'}), 400
+        if issued_at < datetime.now() - timedelta(days=EVENT_TOMBSTONE_RETENTION_DAYS):
+            return jsonify({'message': 'El token ha caducado, es necesario sincronizar de nuevo'}), 410
+    else:
+        since, since_id = datetime.min, 0
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'message': 'Error de conexión a la base de datos'}), 500
+    cur = conn.cursor()
+    
+    try:
+        cur.execute(SYNC_EVENTS_SQL, {
+            'user_id': user_id,
+            'since': since,
+            'since_id': since_id,
+            'include_deleted': bool(token),
+            'limit': SYNC_PAGE_SIZE + 1
+        })
+        rows = cur.fetchall()
+        
+        has_more = len(rows) > SYNC_PAGE_SIZE
+        rows = rows[:SYNC_PAGE_SIZE]
+        exceptions = load_series_exceptions_json(
+            cur, [row[0] for row in rows if row[11] and row[12] != 'deleted'])
+        
+        changes = []
+        for row in rows:
+            if row[12] == 'deleted':
+                changes.append({'id': row[0], 'deleted': True})
+                continue
+            event = event_row_to_dict(row[:11] + (None, None))
+            event['status'] = row[12]
+            event['recurrence_rule'] = row[11]
+            if row[11]:
+                event['exceptions'] = exceptions.get(row[0], [])
+            changes.append(event)
+        
+        if has_more:
+            next_token = encode_sync_token(rows[-1][13], rows[-1][0])
+        else:
+            # Última página: todo lo asentado hasta este momento ya está entregado, así que
+            # el cursor avanza hasta la marca de agua aunque el último cambio sea antiguo
+            # (LOCALTIMESTAMP es el de la transacción, el mismo que usó la consulta)
+            cur.execute(f"SELECT LOCALTIMESTAMP - interval '{SYNC_SETTLE_SECONDS} seconds'")
+            cursor = max((since, since_id), (cur.fetchone()[0], 0))
+            if rows:
+                cursor = max(cursor, (rows[-1][13], rows[-1][0]))
+            next_token = encode_sync_token(*cursor)
+        
+        return jsonify({
+            'changes': changes,
+            'next_token': next_token,
+            'has_more': has_more
+        })
+    except psycopg2.Error as e:
+        print(f"Error al sincronizar eventos: {e}")
+        return jsonify({'message': f'Error: {e}'}), 500
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+# Comando para purgar las marcas de borrado antiguas: flask purge-event-tombstones
+@app.cli.command('purge-event-tombstones')
+@click.option('--days', type=int, default=EVENT_TOMBSTONE_RETENTION_DAYS,
+              help='Antigüedad mínima en días de las marcas a purgar')
+def purge_event_tombstones_command(days):
+    with db_connection() as conn:
+        cur = conn.cursor()
         cur.execute('''
-            SELECT h.id, h.name, h.frequency, h.days_of_week, h.days_of_month,
-                   h.start_time, h.end_time, h.category_id,
-                   c.name as category_name, c.color as category_color
-            FROM habits h
-            JOIN habit_categories c ON h.category_id = c.id
-            WHERE h.user_id = %s AND h.status = 'active'
-        ''', (user_id,))
+            DELETE FROM events
+            WHERE status = 'deleted' AND updated_at < LOCALTIMESTAMP - %s * interval '1 day'
+        ''', (days,))
+        purged = cur.rowcount
+        conn.commit()
+        cur.close()
+    click.echo(f'Marcas de borrado purgadas: {purged}')
+
+# ===== IMPORTACIÓN Y EXPORTACIÓN DE EVENTOS ===== #
+
+# Filas por sentencia INSERT en la importación masiva
+IMPORT_CHUNK_SIZE = 500
+# Longitud máxima de los campos de texto de events (VARCHAR en schema.sql)
+EVENT_FIELD_MAX_LENGTHS = {'title': 255, 'location': 255, 'google_event_id': 255, 'recurrence_rule': 255}
+# Errores de validación que se devuelven como máximo (el resto solo se cuentan)
+MAX_IMPORT_ERRORS = 100
+# Filas que el cursor de servidor trae por viaje en la exportación
+EXPORT_FETCH_SIZE = 1000
+
+ICS_TEXT_ESCAPES = (('\\', '\\\\'), (';', '\\;'), (',', '\\,'), ('\n', '\\n'))
+
+# Función para interpretar un texto escapado de ICS
+def unescape_ics_text(value):
+    return re.sub(r'\\([\;,nN])', lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
+
+# Función para escapar un texto para ICS
+def escape_ics_text(value):
+    for raw, escaped in ICS_TEXT_ESCAPES:
+        value = value.replace(raw, escaped)
+    return value
+
+# Función para interpretar DTSTART/DTEND/EXDATE; devuelve (datetime, es_fecha_sin_hora).
+# Los valores con zona horaria (TZID o Z) se guardan tal cual, como hora local sin zona.
+def parse_ics_datetime(value, params):
+    value = value.strip()
+    if 'VALUE=DATE' in params or len(value) == 8:
+        return datetime.strptime(value, '%Y%m%d'), True
+    return datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S'), False
+
+# Genera las líneas lógicas de un ICS (deshaciendo los pliegues) con su número de línea
+def iter_ics_lines(lines):
+    pending, pending_no = None, 0
+    for line_no, raw in enumerate(lines, 1):
+        try:
+            line = raw.decode('utf-8-sig') if isinstance(raw, bytes) else raw
+        except UnicodeDecodeError:
+            # Las líneas que no son UTF-8 se señalan con None para informar de ellas
+            if pending:
+                yield pending_no, pending
+            pending = None
+            yield line_no, None
+            continue
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and pending is not None:
+            pending += line[1:]
+            continue
+        if pending:
+            yield pending_no, pending
+        pending, pending_no = line, line_no
+    if pending:
+        yield pending_no, pending
+
+# Genera los eventos de un fichero ICS a medida que se leen, como (línea, campos)
+def iter_ics_events(lines):
+    item = None
+    for line_no, line in iter_ics_lines(lines):
+        if line is None:
+            error = f'La línea {line_no} no es UTF-8 válido'
+            if item is not None:
+                item.setdefault('error', error)
+            else:
+                yield line_no, {'error': error, 'exdates': []}
+            continue
+        head, _, value = line.partition(':')
+        name, _, params = head.partition(';')
+        name = name.upper()
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            item = {'line': line_no, 'exdates': []}
+        elif name == 'END' and value.upper() == 'VEVENT' and item is not None:
+            yield item['line'], item
+            item = None
+        elif item is None:
+            continue
+        elif name == 'UID':
+            item['google_event_id'] = value
+        elif name == 'SUMMARY':
+            item['title'] = unescape_ics_text(value)
+        elif name == 'DESCRIPTION':
+            item['description'] = unescape_ics_text(value)
+        elif name == 'LOCATION':
+            item['location'] = unescape_ics_text(value)
+        elif name == 'CATEGORIES':
+            item['category'] = unescape_ics_text(value.split(',')[0])
+        elif name == 'RRULE':
+            item['recurrence_rule'] = value
+        elif name in ('DTSTART', 'DTEND', 'EXDATE'):
+            try:
+                if name == 'EXDATE':
+                    item['exdates'].extend(parse_ics_datetime(v, params.upper())[0] for v in value.split(','))
+                else:
+                    item[name.lower()] = parse_ics_datetime(value, params.upper())
+            except ValueError:
+                item['error'] = f'Fecha inválida en {name}: {value}'
+
+# Función para convertir un evento leído de ICS en los campos comunes de importación
+def ics_event_to_import(item):
+    if 'error' in item:
+        raise ValueError(item['error'])
+    if 'dtstart' not in item:
+        raise ValueError('Falta DTSTART')
+    start, is_all_day = item['dtstart']
+    if 'dtend' in item:
+        end = item['dtend'][0]
+    else:
+        end = start + timedelta(days=1) if is_all_day else start
+    if is_all_day:
+        # En ICS el fin de un evento de todo el día es exclusivo
+        end = max(start, end - timedelta(seconds=1))
+    return {
+        'title': item.get('title'),
+        'description': item.get('description', ''),
+        'category': item.get('category'),
+        'start_datetime': start,
+        'end_datetime': end,
+        'location': item.get('location', ''),
+        'is_all_day': is_all_day,
+        'google_event_id': item.get('google_event_id'),
+        'recurrence_rule': item.get('recurrence_rule'),
+        'exdates': item['exdates']
+    }
+
+# Genera los eventos de un fichero NDJSON (un objeto JSON por línea) como (línea, campos)
+def iter_ndjson_events(lines):
+    for line_no, raw in enumerate(lines, 1):
+        if raw.strip():
+            yield line_no, raw
+
+# Función para convertir una línea NDJSON en los campos comunes de importación
+def ndjson_event_to_import(line):
+    try:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ValueError('La línea no es UTF-8 válido')
+    try:
+        data = json.loads(line)
+        start = datetime.fromisoformat(str(data['start_datetime']).replace('Z', '+00:00')).replace(tzinfo=None)
+        end = datetime.fromisoformat(str(data['end_datetime']).replace('Z', '+00:00')).replace(tzinfo=None)
+        exdates = [datetime.fromisoformat(value) for value in data.get('exdates') or []]
+    except (ValueError, TypeError, AttributeError) as e:
+        raise ValueError(f'JSON o fecha inválidos: {e}')
+    except KeyError as e:
+        raise ValueError(f'Falta el campo {e}')
+    category = data.get('category')
+    return {
+        'title': data.get('title'),
+        'description': data.get('description', ''),
+        'category_id': data.get('category_id'),
+        'category': category.get('name') if isinstance(category, dict) else category,
+        'start_datetime': start,
+        'end_datetime': end,
+        'location': data.get('location', ''),
+        'is_all_day': data.get('is_all_day', False),
+        'google_event_id': data.get('google_event_id'),
+        'recurrence_rule': data.get('recurrence_rule'),
+        'exdates': exdates
+    }
+
+# Función para validar un evento importado y convertirlo en la fila a insertar.
+# categories es {nombre en minúsculas: id}; lanza ValueError si el evento no es válido.
+def build_import_row(user_id, item, categories, default_category_id):
+    if not item['title']:
+        raise ValueError('Falta el título')
+    for field, max_length in EVENT_FIELD_MAX_LENGTHS.items():
+        value = item.get(field)
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            raise ValueError(f'El campo {field} debe ser texto')
+        if len(value) > max_length:
+            raise ValueError(f'El campo {field} supera los {max_length} caracteres')
+    for field in ('description', 'category'):
+        if item.get(field) is not None and not isinstance(item[field], str):
+            raise ValueError(f'El campo {field} debe ser texto')
+    if not isinstance(item['is_all_day'], bool):
+        raise ValueError('El campo is_all_day debe ser true o false')
+    if item['end_datetime'] < item['start_datetime']:
+        raise ValueError('La fecha de fin debe ser igual o posterior a la de inicio')
+    
+    category_id = item.get('category_id')
+    if category_id not in categories.values():
+        category_id = categories.get((item.get('category') or '').lower(), default_category_id)
+    if category_id is None:
+        raise ValueError('Categoría desconocida y sin category_id por defecto')
+    
+    recurrence_rule, recurrence_end = prepare_event_recurrence(
+        item['recurrence_rule'], item['start_datetime'], item['end_datetime'])
+    if recurrence_rule and len(recurrence_rule) > EVENT_FIELD_MAX_LENGTHS['recurrence_rule']:
+        raise ValueError(f"La regla de recurrencia supera los {EVENT_FIELD_MAX_LENGTHS['recurrence_rule']} caracteres")
+    return (user_id, item['title'], item['description'], category_id, item['start_datetime'],
+            item['end_datetime'], item['location'], item['is_all_day'],
+            item['google_event_id'] or None, recurrence_rule, recurrence_end)
+
+# Función para insertar o actualizar un bloque de eventos importados en una sentencia.
+# Se insertan con upsert sobre (user_id, google_event_id); si el mismo identificador
+# aparece dos veces en el bloque, gana la última aparición. exdates es
+# {google_event_id: [inicios cancelados]} y se guarda como excepciones de la serie.
+def upsert_event_chunk(cur, rows, exdates):
+    unique_rows = {}
+    for index, row in enumerate(rows):
+        unique_rows[row[8] or ('sin-id', index)] = row
+    
+    returned = psycopg2.extras.execute_values(cur, '''
+        INSERT INTO events
+            (user_id, title, description, category_id, start_datetime, end_datetime,
+             location, is_all_day, google_event_id, recurrence_rule, recurrence_end)
+        VALUES %s
+        ON CONFLICT (user_id, google_event_id) WHERE google_event_id IS NOT NULL DO UPDATE
+        SET title = EXCLUDED.title, description = EXCLUDED.description,
+            category_id = EXCLUDED.category_id, start_datetime = EXCLUDED.start_datetime,
+            end_datetime = EXCLUDED.end_datetime, location = EXCLUDED.location,
+            is_all_day = EXCLUDED.is_all_day, recurrence_rule = EXCLUDED.recurrence_rule,
+            recurrence_end = EXCLUDED.recurrence_end, status = 'active',
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING id, google_event_id
+    ''', list(unique_rows.values()), page_size=IMPORT_CHUNK_SIZE, fetch=True)
+    
+    exceptions = [(event_id, occurrence)
+                  for event_id, external_id in returned
+                  for occurrence in exdates.get(external_id, ())]
+    if exceptions:
+        psycopg2.extras.execute_values(cur, '''
+            INSERT INTO event_exceptions (event_id, occurrence_start, is_cancelled)
+            VALUES %s
+            ON CONFLICT (event_id, occurrence_start) DO UPDATE SET is_cancelled = true
+        ''', exceptions, template='(%s, %s, true)', page_size=IMPORT_CHUNK_SIZE)
+    return len(unique_rows)
+
+# Endpoint para importar eventos en bloque desde un fichero ICS o NDJSON (campo "file" de
+# un formulario multipart o el cuerpo de la petición). El fichero se lee y valida línea a
+# línea y se inserta por bloques, así que la memoria no depende de su tamaño.
+# Parámetros: format=ics|ndjson (por defecto según la extensión) y category_id para los
+# eventos cuya categoría no coincida con ninguna existente.
+@app.route('/api/events/import', methods=['POST'])
+@token_required
+def import_events(user_id):
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    filename = (upload.filename or '') if upload else ''
+    file_format = request.args.get('format') or ('ndjson' if filename.endswith(('.ndjson', '.jsonl')) else 'ics')
+    if file_format not in ('ics', 'ndjson'):
+        return jsonify({'message': 'El formato debe ser ics o ndjson'}), 400
+    
+    default_category_id = request.args.get('category_id', type=int)
+    if file_format == 'ics':
+        items, to_import = iter_ics_events(stream), ics_event_to_import
+    else:
+        items, to_import = iter_ndjson_events(stream), ndjson_event_to_import
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'message': 'Error de conexión a la base de datos'}), 500
+    cur = conn.cursor()
+    
+    try:
+        categories = {name.lower(): category_id
+                      for category_id, name, _ in reference_data.table('event_categories')['rows']}
+        if default_category_id is not None and default_category_id not in categories.values():
+            return jsonify({'message': 'category_id no existe'}), 400
         
-        habits = cur.fetchall()
+        imported = 0
+        error_count = 0
+        errors = []
+        rows, exdates = [], {}
+        for line_no, raw in items:
+            try:
+                item = to_import(raw)
+                rows.append(build_import_row(user_id, item, categories, default_category_id))
+            except ValueError as e:
+                error_count += 1
+                if len(errors) < MAX_IMPORT_ERRORS:
+                    errors.append({'line': line_no, 'message': str(e)})
+                continue
+            if item['exdates'] and item['google_event_id']:
+                exdates[item['google_event_id']] = item['exdates']
+            
+            if len(rows) >= IMPORT_CHUNK_SIZE:
+                imported += upsert_event_chunk(cur, rows, exdates)
+                rows, exdates = [], {}
         
-        for h in habits:
-            # Verificar si el hábito está programado para hoy
-            habit_frequency = h[2]
-            habit_days_of_week = h[3]
-            habit_days_of_month = h[4]
+        if rows:
+            imported += upsert_event_chunk(cur, rows, exdates)
+        bump_resource_version(cur, user_id, RESOURCE_EVENTS)
+        conn.commit()
+        
+        return jsonify({
+            'imported': imported,
+            'error_count': error_count,
+            'errors': errors,
+            'message': 'Importación completada'
+        })
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Error al importar eventos: {e}")
+        return jsonify({'message': f'Error al importar eventos: {e}'}), 500
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+# Función para plegar una línea ICS en trozos de como máximo 75 octetos
+def fold_ics_line(line):
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    parts = []
+    while encoded:
+        size = 75 if not parts else 74
+        # No cortar en medio de un carácter multibyte
+        while size < len(encoded) and (encoded[size] & 0xC0) == 0x80:
+            size -= 1
+        parts.append(encoded[:size].decode('utf-8'))
+        encoded = encoded[size:]
+    return '\r\n '.join(parts) + '\r\n'
+
+# Función para convertir una fila de exportación en un VEVENT
+def event_row_to_ics(row):
+    event_id, title, description, _, start, end, location, is_all_day, external_id, category, _, rule, cancelled = row
+    lines = ['BEGIN:VEVENT', f'UID:{external_id or f"{event_id}@agentia"}']
+    if is_all_day:
+        lines.append(f"DTSTART;VALUE=DATE:{start.strftime('%Y%m%d')}")
+        lines.append(f"DTEND;VALUE=DATE:{(end.date() + timedelta(days=1)).strftime('%Y%m%d')}")
+    else:
+        lines.append(f"DTSTART:{start.strftime('%Y%m%dT%H%M%S')}")
+        lines.append(f"DTEND:{end.strftime('%Y%m%dT%H%M%S')}")
+    lines.append(f'SUMMARY:{escape_ics_text(title)}')
+    if description:
+        lines.append(f'DESCRIPTION:{escape_ics_text(description)}')
+    if location:
+        lines.append(f'LOCATION:{escape_ics_text(location)}')
+    lines.append(f'CATEGORIES:{escape_ics_text(category)}')
+    if rule:
+        lines.append(f'RRULE:{rule}')
+    if cancelled:
+        lines.append('EXDATE:' + ','.join(occurrence.strftime('%Y%m%dT%H%M%S') for occurrence in cancelled))
+    lines.append('END:VEVENT')
+    return ''.join(fold_ics_line(line) for line in lines)
+
+# Función para convertir una fila de exportación en una línea NDJSON
+def event_row_to_ndjson(row):
+    event = event_row_to_dict(row[:11] + (None, None))
+    event['recurrence_rule'] = row[11]
+    event['exdates'] = [occurrence.strftime('%Y-%m-%dT%H:%M:%S') for occurrence in row[12]]
+    return json.dumps(event, ensure_ascii=False) + '\n'
+
+# Endpoint para exportar todos los eventos activos del usuario en ICS o NDJSON
+# (?format=ics|ndjson). Las filas se leen con un cursor de servidor y se envían a medida
+# que llegan, así que la memoria no depende del número de eventos.
+@app.route('/api/events/export', methods=['GET'])
+@token_required
+def export_events(user_id):
+    file_format = request.args.get('format', 'ics')
+    if file_format not in ('ics', 'ndjson'):
+        return jsonify({'message': 'El formato debe ser ics o ndjson'}), 400
+    
+    conn = get_db_connection()
+    if conn is None:
+        return jsonify({'message': 'Error de conexión a la base de datos'}), 500
+    
+    def generate():
+        cur = conn.cursor(name='events_export')
+        cur.itersize = EXPORT_FETCH_SIZE
+        try:
+            cur.execute('''
+                SELECT e.id, e.title, e.description, e.category_id, e.start_datetime,
+                       e.end_datetime, e.location, e.is_all_day, e.google_event_id,
+                       c.name, c.color, e.recurrence_rule,
+                       ARRAY(SELECT x.occurrence_start FROM event_exceptions x
+                             WHERE x.event_id = e.id AND x.is_cancelled
+                             ORDER BY x.occurrence_start)
+                FROM events e
+                JOIN event_categories c ON e.category_id = c.id
+                WHERE e.user_id = %s AND e.status = 'active'
+                ORDER BY e.start_datetime, e.id
+            ''', (user_id,))
+            if file_format == 'ics':
+                yield 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Agentia//Calendario//ES\r\n'
+                for row in cur:
+                    yield event_row_to_ics(row)
+                yield 'END:VCALENDAR\r\n'
+            else:
+                for row in cur:
+                    yield event_row_to_ndjson(row)
+        except psycopg2.Error as e:
+            # Las cabeceras ya se enviaron: solo queda cortar la respuesta
+            print(f"Error al exportar eventos: {e}")
+        finally:
+            cur.close()
+    
+    if file_format == 'ics':
+        mimetype, filename = 'text/calendar', 'eventos.ics'
+    else:
+        mimetype, filename = 'application/x-ndjson', 'eventos.ndjson'
+    try:
+        response = Response(generate(), mimetype=mimetype,
+                            headers={'Content-Disposition': f'attachment; filename={filename}'})
+    except Exception:
+        release_db_connection(conn)
+        raise
+    # La conexión vuelve al pool al cerrar la respuesta, aunque el generador no llegue a
+    # ejecutarse (HEAD, cliente desconectado antes del primer fragmento)
+    response.call_on_close(lambda: release_db_connection(conn))
+    return response
+
+# Endpoint para obtener todos los datos del usuario para el chatbot
+@app.route('/api/chatbot/user-data', methods=['GET'])
+@token_required
+@conditional_get(RESOURCE_FINANCE, RESOURCE_HABITS, RESOURCE_EVENTS)
+def get_chatbot_user_data(user_id):
+    try:
+        # Usar la función interna y convertir la respuesta a JSON
+        user_data = get_chatbot_user_data_internal(user_id)
+        return jsonify(user_data)
+    
+    except Exception as e:
+        print(f"Error al obtener datos del usuario para chatbot: {e}")
+        return jsonify({'message': f'Error: {e}'}), 500
+
+# ===== CLASIFICACIÓN DE INTENCIONES DEL CHATBOT ===== #
+
+# Función para normalizar un texto para comparar: minúsculas y sin acentos
+def fold_text(text):
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+# Comando explícito para completar un hábito; el grupo 1 es el nombre del hábito. "marcar"
+# es más genérico que "completar" ("marcar gasto de 20 en comida"), así que solo cuenta
+# si va seguido de "hábito" o termina en "como completado/terminado/hecho".
+COMPLETE_HABIT_PATTERN = re.compile(
+    r'(?i)^\s*(?:por\s+favor\s+)?'
+    r'(?:completar|completa|(?:marcar|marca)(?=(?:\s+el)?\s+h[áa]bito\b|.*\s+como\s+(?:completado|terminado|hecho)\s*[.!]?$))'
+    r'(?:\s+el)?(?:\s+h[áa]bito)?(?:\s*:)?\s+(.+?)'
+    r'(?:\s+como\s+(?:completado|terminado|hecho))?\s*[.!]?$'
+)
+
+# Nombres (normalizados) que no identifican ningún hábito: "completar hábito" no es un comando
+GENERIC_HABIT_NAMES = frozenset({'habito', 'habitos', 'el habito', 'mi habito', 'mis habitos', 'un habito'})
+
+# Palabras clave de cada intención con su peso, sobre el texto normalizado
+INTENT_KEYWORDS = {
+    'habits_today': {
+        'habito': 3, 'habitos': 3, 'rutina': 2, 'rutinas': 2, 'pendiente': 2, 'pendientes': 2,
+        'debo hacer': 2, 'me toca': 2, 'toca hoy': 2
+    },
+    'finance': {
+        'finanzas': 3, 'financiero': 3, 'financiera': 3, 'gasto': 3, 'gastos': 3, 'gastado': 3,
+        'ingreso': 3, 'ingresos': 3, 'balance': 3, 'dinero': 3, 'presupuesto': 3, 'saldo': 3,
+        'transaccion': 3, 'transacciones': 3, 'ahorro': 2, 'ahorros': 2, 'ahorrado': 2,
+        'meta de ahorro': 3, 'cuanto': 1, 'pagar': 1, 'pague': 1
+    },
+    'events': {
+        'evento': 3, 'eventos': 3, 'cita': 3, 'citas': 3, 'reunion': 3, 'reuniones': 3,
+        'agenda': 3, 'calendario': 3, 'compromiso': 2, 'compromisos': 2, 'proximo': 1,
+        'proximos': 1, 'hoy': 1, 'manana': 1, 'a que hora': 2
+    },
+    'progress': {
+        'progreso': 3, 'avance': 3, 'avances': 3, 'evolucion': 3, 'racha': 3, 'rachas': 3,
+        'como voy': 3, 'como me va': 3, 'estadisticas': 2, 'desarrollo': 2, 'mejorado': 2,
+        'como va': 2, 'ha sido': 1
+    }
+}
+# Orden de preferencia en caso de empate
+INTENT_PRIORITY = ('habits_today', 'finance', 'events', 'progress')
+# Puntuación mínima para no caer en la respuesta genérica
+INTENT_MIN_SCORE = 2
+
+# Una sola expresión con un grupo con nombre por intención: cada coincidencia indica su
+# intención con lastgroup, así que el mensaje se recorre una única vez. Dentro de cada
+# grupo las palabras más largas van primero para que "habitos" no se quede en "habito".
+INTENT_PATTERN = re.compile(r'\b(?:' + '|'.join(
+    f"(?P<{intent}>{'|'.join(re.escape(k) for k in sorted(keywords, key=len, reverse=True))})"
+    for intent, keywords in INTENT_KEYWORDS.items()
+) + r')\b')
+
+# Resultado de la clasificación: intención, puntuación, confianza (0-1, proporción de la
+# puntuación total que se lleva la intención ganadora) y el match del comando, si lo hay
+Intent = namedtuple('Intent', ['name', 'score', 'confidence', 'match'])
+
+# Función para clasificar un mensaje del chatbot en una intención
+def classify_intent(message):
+    command = COMPLETE_HABIT_PATTERN.match(message)
+    if command and fold_text(command.group(1)).strip() not in GENERIC_HABIT_NAMES:
+        return Intent('complete_habit', INTENT_MIN_SCORE, 1.0, command)
+    
+    scores = dict.fromkeys(INTENT_PRIORITY, 0)
+    for match in INTENT_PATTERN.finditer(fold_text(message)):
+        intent = match.lastgroup
+        scores[intent] += INTENT_KEYWORDS[intent][match.group()]
+    
+    best = max(INTENT_PRIORITY, key=lambda intent: scores[intent])  # max conserva el primero en empate
+    total = sum(scores.values())
+    if scores[best] < INTENT_MIN_SCORE:
+        return Intent('fallback', scores[best], 0.0, None)
+    return Intent(best, scores[best], scores[best] / total, None)
+
+# Corpus etiquetado de mensajes en español para medir la clasificación
+INTENT_CORPUS = (
+    ('Completar hábito: leer 20 páginas', 'complete_habit'),
+    ('marcar el hábito meditar como completado', 'complete_habit'),
+    ('Marca Beber 2 litros de agua como hecho', 'complete_habit'),
+    ('completar mis ejercicios de la mañana', 'complete_habit'),
+    ('Por favor completa el hábito correr', 'complete_habit'),
+    ('Marcar gasto de 20 en comida', 'finance'),
+    ('marca un ingreso de 500', 'finance'),
+    ('completar hábito', 'habits_today'),
+    ('¿Qué hábitos tengo hoy?', 'habits_today'),
+    ('que habitos debo hacer hoy', 'habits_today'),
+    ('¿Cuáles son mis hábitos pendientes?', 'habits_today'),
+    ('¿Qué me toca hoy de mi rutina?', 'habits_today'),
+    ('hábitos para hoy', 'habits_today'),
+    ('¿Tengo algo pendiente?', 'habits_today'),
+    ('¿Cómo van mis finanzas?', 'finance'),
+    ('¿Cuánto he gastado este mes?', 'finance'),
+    ('cual es mi balance', 'finance'),
+    ('¿Cuáles son mis ingresos?', 'finance'),
+    ('¿Cuánto dinero tengo?', 'finance'),
+    ('muéstrame mis últimas transacciones', 'finance'),
+    ('¿Cómo va mi meta de ahorro?', 'finance'),
+    ('¿Me alcanza el presupuesto?', 'finance'),
+    ('¿Qué eventos tengo hoy?', 'events'),
+    ('¿Tengo alguna reunión mañana?', 'events'),
+    ('¿Cuáles son mis próximas citas?', 'events'),
+    ('muéstrame mi agenda', 'events'),
+    ('¿Qué hay en mi calendario?', 'events'),
+    ('¿A qué hora es mi cita con el médico?', 'events'),
+    ('¿Cuáles son mis próximos compromisos?', 'events'),
+    ('¿Cómo va mi progreso?', 'progress'),
+    ('¿Cómo voy con mis rachas?', 'progress'),
+    ('quiero ver mi evolución', 'progress'),
+    ('¿Cuál es mi racha más larga?', 'progress'),
+    ('¿Cómo me va esta semana?', 'progress'),
+    ('muéstrame mis estadísticas', 'progress'),
+    ('¿He mejorado este mes?', 'progress'),
+    ('Hola', 'fallback'),
+    ('gracias!', 'fallback'),
+    ('¿Quién eres?', 'fallback'),
+    ('cuéntame un chiste', 'fallback'),
+    ('¿Qué puedes hacer?', 'fallback'),
+)
+
+# Comando para medir la precisión y la velocidad del clasificador de intenciones:
+#     flask --app app benchmark-intents
+@app.cli.command('benchmark-intents')
+@click.option('--rounds', type=int, default=2000, help='Veces que se clasifica el corpus completo')
+def benchmark_intents_command(rounds):
+    errors = []
+    for message, expected in INTENT_CORPUS:
+        intent = classify_intent(message)
+        if intent.name != expected:
+            errors.append((message, expected, intent))
+    for message, expected, intent in errors:
+        click.echo(f'FALLO: {message!r}: esperado {expected}, obtenido {intent.name} ({intent.score})')
+    correct = len(INTENT_CORPUS) - len(errors)
+    click.echo(f'Precisión: {correct}/{len(INTENT_CORPUS)} ({correct / len(INTENT_CORPUS):.1%})')
+    
+    messages = [message for message, _ in INTENT_CORPUS]
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            classify_intent(message)
+    elapsed = time.perf_counter() - started
+    click.echo(f'Velocidad: {rounds * len(messages) / elapsed:,.0f} mensajes/segundo')
+
+# ===== SESIONES DE CONVERSACIÓN DEL CHATBOT ===== #
+
+CHATBOT_WINDOW_MESSAGES = int(os.getenv('CHATBOT_WINDOW_MESSAGES', 20))  # Mensajes recientes que se conservan literales
+CHATBOT_SUMMARY_BATCH = 10  # Mensajes que se acumulan fuera de la ventana antes de resumirlos
+CHATBOT_SUMMARY_MAX_CHARS = 2000  # Longitud máxima del resumen (se descartan las líneas más antiguas)
+CHATBOT_SUMMARY_LINE_CHARS = 120  # Caracteres que se conservan de cada mensaje resumido
+CHATBOT_MESSAGE_MAX_CHARS = 4000  # Longitud máxima de un mensaje del usuario
+CHATBOT_HISTORY_PAGE_SIZE = 100  # Mensajes por página en el historial de una sesión
+CHATBOT_SESSION_RETENTION_DAYS = 30  # Días sin actividad tras los que se purga una sesión
+
+# Función para convertir una fila de chatbot_messages al formato de mensajes del cliente
+def chatbot_message_to_dict(seq, role, content):
+    return {'seq': seq, 'role': role, 'parts': [content]}
+
+# Función para obtener la sesión de un usuario bloqueando su fila hasta el commit, de modo
+# que los turnos simultáneos de una misma sesión se numeran uno detrás de otro.
+# Devuelve (summary, summarized_seq, last_seq) o None si no existe o es de otro usuario.
+def lock_chatbot_session(cur, user_id, session_id):
+    cur.execute('''
+        SELECT summary, summarized_seq, last_seq FROM chatbot_sessions
+        WHERE id = %s AND user_id = %s
+        FOR UPDATE
+    ''', (session_id, user_id))
+    return cur.fetchone()
+
+# Función para crear una sesión vacía; devuelve su id
+def create_chatbot_session(cur, user_id):
+    cur.execute('INSERT INTO chatbot_sessions (user_id) VALUES (%s) RETURNING id', (user_id,))
+    return cur.fetchone()[0]
+
+# Función para condensar un mensaje en una línea del resumen
+def chatbot_summary_line(role, content):
+    text = ' '.join(content.split())
+    if len(text) > CHATBOT_SUMMARY_LINE_CHARS:
+        text = text[:CHATBOT_SUMMARY_LINE_CHARS - 1] + '…'
+    return f"{'Usuario' if role == 'user' else 'Asistente'}: {text}"
+
+# Función para añadir líneas al resumen sin pasar de CHATBOT_SUMMARY_MAX_CHARS
+def extend_chatbot_summary(summary, lines):
+    kept = summary.splitlines() + lines
+    while kept and sum(len(line) + 1 for line in kept) > CHATBOT_SUMMARY_MAX_CHARS:
+        kept.pop(0)
+    return '\n'.join(kept)
+
+# Función para añadir un turno (mensaje del usuario y respuesta) al final de una sesión ya
+# bloqueada. Cuando quedan más de CHATBOT_WINDOW_MESSAGES + CHATBOT_SUMMARY_BATCH mensajes
+# sin resumir, los que salen de la ventana se condensan en el resumen de una vez; los
+# mensajes nunca se modifican. Devuelve los mensajes añadidos.
+def append_chatbot_turn(cur, session_id, session, user_message, response):
+    summary, summarized_seq, last_seq = session
+    delta = [(last_seq + 1, 'user', user_message), (last_seq + 2, 'model', response)]
+    psycopg2.extras.execute_values(cur, '''
+        INSERT INTO chatbot_messages (session_id, seq, role, content) VALUES %s
+    ''', [(session_id, seq, role, content) for seq, role, content in delta])
+    last_seq += 2
+    
+    if last_seq - summarized_seq > CHATBOT_WINDOW_MESSAGES + CHATBOT_SUMMARY_BATCH:
+        new_summarized_seq = last_seq - CHATBOT_WINDOW_MESSAGES
+        cur.execute('''
+            SELECT role, content FROM chatbot_messages
+            WHERE session_id = %s AND seq > %s AND seq <= %s
+            ORDER BY seq
+        ''', (session_id, summarized_seq, new_summarized_seq))
+        lines = [chatbot_summary_line(role, content) for role, content in cur.fetchall()]
+        summary = extend_chatbot_summary(summary, lines)
+        summarized_seq = new_summarized_seq
+    
+    cur.execute('''
+        UPDATE chatbot_sessions
+        SET last_seq = %s, summarized_seq = %s, summary = %s, updated_at = NOW()
+        WHERE id = %s
+    ''', (last_seq, summarized_seq, summary, session_id))
+    return [chatbot_message_to_dict(*message) for message in delta]
+
+# Función para guardar un turno en la sesión indicada; si no se indicó o se purgó mientras
+# se procesaba el mensaje, en una sesión nueva. Devuelve (session_id, mensajes añadidos).
+def save_chatbot_turn(cur, user_id, session_id, user_message, response):
+    session = lock_chatbot_session(cur, user_id, session_id) if session_id is not None else None
+    if session is None:
+        session_id = create_chatbot_session(cur, user_id)
+        session = lock_chatbot_session(cur, user_id, session_id)
+    return session_id, append_chatbot_turn(cur, session_id, session, user_message, response)
+
+# Función para cargar los mensajes de la ventana de una sesión (los posteriores al resumen)
+# en el formato role/parts que reciben los backends de generación
+def load_chatbot_window(cur, session_id, summarized_seq):
+    cur.execute('''
+        SELECT role, content FROM chatbot_messages
+        WHERE session_id = %s AND seq > %s
+        ORDER BY seq
+    ''', (session_id, summarized_seq))
+    return [{'role': role, 'parts': [content]} for role, content in cur.fetchall()]
+
+# ===== GENERACIÓN DE RESPUESTAS CON MODELOS DE LENGUAJE ===== #
+
+CHATBOT_BACKEND = os.getenv('CHATBOT_BACKEND', '')  # '' desactiva, 'stub' o 'paquete.modulo:Clase'
+CHATBOT_LLM_MAX_CONCURRENCY = int(os.getenv('CHATBOT_LLM_MAX_CONCURRENCY', 4))  # Generaciones simultáneas
+CHATBOT_LLM_TIMEOUT = float(os.getenv('CHATBOT_LLM_TIMEOUT', 60))  # Segundos máximos por generación
+CHATBOT_LLM_IDLE_TIMEOUT = float(os.getenv('CHATBOT_LLM_IDLE_TIMEOUT', 15))  # Segundos máximos entre dos fragmentos
+CHATBOT_STUB_TOKEN_DELAY = float(os.getenv('CHATBOT_STUB_TOKEN_DELAY', 0))  # Pausa del stub entre fragmentos
+
+# Interfaz de los backends de generación. generate() recibe el prompt de sistema (contexto
+# del usuario y resumen de la sesión), el historial en formato role/parts terminado en el
+# mensaje nuevo, el instante límite (time.monotonic()) y un threading.Event que se activa
+# si hay que abandonar la generación; produce la respuesta fragmento a fragmento.
+class ChatbotBackend:
+    name = None
+
+    def generate(self, prompt, history, deadline, cancelled):
+        raise NotImplementedError
+
+CHATBOT_BACKENDS = {}
+
+# Decorador para registrar un backend bajo el nombre que se usa en CHATBOT_BACKEND
+def register_chatbot_backend(cls):
+    CHATBOT_BACKENDS[cls.name] = cls
+    return cls
+
+# Backend local y determinista para pruebas: la misma entrada produce siempre la misma
+# respuesta, palabra a palabra, sin llamar a ningún servicio externo
+@register_chatbot_backend
+class StubChatbotBackend(ChatbotBackend):
+    name = 'stub'
+
+    def __init__(self, token_delay=CHATBOT_STUB_TOKEN_DELAY):
+        self.token_delay = token_delay
+
+    def generate(self, prompt, history, deadline, cancelled):
+        message = history[-1]['parts'][0]
+        digest = hashlib.sha1(f'{prompt}\n{message}'.encode('utf-8')).hexdigest()[:8]
+        reply = (f"[stub {digest}] Recibí tu mensaje: «{' '.join(message.split())}». "
+                 f"Contexto de {len(prompt)} caracteres y {len(history) - 1} mensajes previos.")
+        for token in re.findall(r'\S+\s*', reply):
+            if cancelled.is_set():
+                return
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            yield token
+
+# Función para obtener el backend configurado (se crea una sola vez); None si no hay
+@lru_cache(maxsize=None)
+def get_chatbot_backend():
+    if not CHATBOT_BACKEND:
+        return None
+    if CHATBOT_BACKEND in CHATBOT_BACKENDS:
+        return CHATBOT_BACKENDS[CHATBOT_BACKEND]()
+    module_name, _, class_name = CHATBOT_BACKEND.partition(':')
+    if not class_name:
+        raise ValueError(f'Backend de chatbot desconocido: {CHATBOT_BACKEND}')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+# Función para construir el prompt de sistema: contexto del usuario más el resumen de la
+# parte de la conversación que ya salió de la ventana
+def build_chatbot_prompt(user_data, summary):
+    prompt = format_user_data_for_chatbot(user_data)
+    if summary:
+        prompt += f"\n\nRESUMEN DE LA CONVERSACIÓN ANTERIOR:\n{summary}\n"
+    return prompt
+
+# Respuesta que se guarda en la sesión cuando la generación falla o se agota el tiempo,
+# para que el historial (y quien lo consulta esperando la respuesta) no quede a medias
+CHATBOT_GENERATION_FALLBACK = "Lo siento, no he podido generar una respuesta ahora. Por favor, intenta de nuevo."
+
+# Generación en curso. Con stream, el hilo del pool deja en la cola ('token', texto), y al
+# final ('done', mensajes añadidos a la sesión) o ('error', {'code', 'message'}), y quien
+# atiende la petición la consume. La petición puede terminar antes (cliente desconectado)
+# sin cortar la generación: el resultado se guarda igualmente en la sesión.
+class ChatbotGeneration:
+    def __init__(self, user_id, session_id, user_message, stream):
+        self.user_id = user_id
+        self.session_id = session_id
+        self.user_message = user_message
+        self.stream = stream
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+        self.deadline = time.monotonic() + CHATBOT_LLM_TIMEOUT
+
+    def emit(self, kind, value):
+        if self.stream:
+            self.events.put((kind, value))
+
+    # Itera los eventos de la cola aplicando los límites de tiempo; al agotarse cancela la
+    # generación y produce un último ('error', ...) con code 'timeout'
+    def iter_events(self):
+        while True:
+            timeout = min(CHATBOT_LLM_IDLE_TIMEOUT, self.deadline - time.monotonic())
+            try:
+                kind, value = self.events.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                self.cancelled.set()
+                yield 'error', {'code': 'timeout', 'message': 'La generación de la respuesta tardó demasiado'}
+                return
+            yield kind, value
+            if kind != 'token':
+                return
+
+# Pool acotado de generaciones: el hueco se reserva antes de crear nada y, si todos están
+# ocupados, la petición se rechaza al momento en vez de esperar en una cola
+class ChatbotGenerationPool:
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='chatbot-llm')
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._stats = {'started': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'timeouts': 0, 'active': 0}
+
+    def record(self, counter, delta=1):
+        with self._lock:
+            self._stats[counter] += delta
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['max_concurrency'] = self.max_concurrency
+        return stats
+
+    # Reserva un hueco; devuelve False si no queda capacidad. Tras reservar hay que llamar
+    # a start() o a release()
+    def reserve(self):
+        if not self._slots.acquire(blocking=False):
+            self.record('rejected')
+            return False
+        return True
+
+    def release(self):
+        self._slots.release()
+
+    # Lanza la generación en el hueco reservado (si falla, el hueco sigue reservado)
+    def start(self, backend, generation, prompt, history):
+        self.record('started')
+        self.record('active')
+        try:
+            self._executor.submit(self._run, backend, generation, prompt, history)
+        except Exception:
+            self.record('active', -1)
+            raise
+
+    def _run(self, backend, generation, prompt, history):
+        try:
+            parts = []
+            error = None
+            try:
+                for token in backend.generate(prompt, history, generation.deadline, generation.cancelled):
+                    if generation.cancelled.is_set() or time.monotonic() > generation.deadline:
+                        error = {'code': 'timeout', 'message': 'La generación de la respuesta tardó demasiado'}
+                        break
+                    parts.append(token)
+                    generation.emit('token', token)
+                else:
+                    if generation.cancelled.is_set():
+                        error = {'code': 'timeout', 'message': 'La generación de la respuesta tardó demasiado'}
+            except Exception as e:
+                print(f"Error en la generación del chatbot: {e}")
+                error = {'code': 'generation_failed', 'message': 'No se pudo generar la respuesta'}
             
-            scheduled_today = is_habit_scheduled_for_date(habit_frequency, habit_days_of_week, 
-                                                         habit_days_of_month, target_date)
+            response = CHATBOT_GENERATION_FALLBACK if error else ''.join(parts).strip()
+            with db_connection() as conn:
+                cur = conn.cursor()
+                session_id, messages = save_chatbot_turn(cur, generation.user_id, generation.session_id,
+                                                         generation.user_message, response)
+                conn.commit()
+                cur.close()
             
-            if scheduled_today and h[5] and h[6]:  # Si está programado hoy y tiene hora inicio/fin
-                start_time = h[5]
-                end_time = h[6]
-                
-                # Crear fechas completas con la hora
-                habit_start = datetime.combine(target_date, start_time)
-                habit_end = datetime.combine(target_date, end_time)
-                
-                result.append({
-                    'id': f"habit_{h[0]}",  # Añadir prefijo para distinguir de eventos
-                    'title': h[1],
-                    'description': f"Hábito: {h[1]}",
-                    'category_id': 5,  # Usar la categoría de Hábitos
-                    'start_datetime': habit_start.strftime('%Y-%m-%dT%H:%M:%S'),
-                    'end_datetime': habit_end.strftime('%Y-%m-%dT%H:%M:%S'),
-                    'location': '',
-                    'is_all_day': False,
-                    'google_event_id': None,
-                    'category': {
-                        'name': 'Hábitos',
-                        'color': 'green'
-                    },
-                    'is_habit': True,  # Marcar como hábito para UI
-                    'completed': False  # Marcar como no completado
-                })
-        
-        # Ordenar por hora de inicio
-        result.sort(key=lambda x: x['start_datetime'])
-        
-        return jsonify(result)
-    except Exception as e:
-        print(f"Error al obtener eventos del día: {e}")
-        return jsonify({'message': f'Error: {e}'}), 500
-    finally:
-        if 'conn' in locals() and conn:
-            cur.close()
-            conn.close()
+            if error:
+                self.record('timeouts' if error['code'] == 'timeout' else 'failed')
+                generation.emit('error', error)
+            else:
+                self.record('completed')
+                generation.emit('done', {'response': response, 'session_id': session_id, 'messages': messages})
+        except Exception as e:
+            print(f"Error al guardar la respuesta del chatbot: {e}")
+            self.record('failed')
+            generation.emit('error', {'code': 'generation_failed', 'message': 'No se pudo generar la respuesta'})
+        finally:
+            self.record('active', -1)
+            self.release()
 
-# Endpoint para obtener todos los datos del usuario para el chatbot
-@app.route('/api/chatbot/user-data', methods=['GET'])
-@token_required
-def get_chatbot_user_data(user_id):
-    try:
-        # Usar la función interna y convertir la respuesta a JSON
-        user_data = get_chatbot_user_data_internal(user_id)
-        return jsonify(user_data)
+chatbot_generations = ChatbotGenerationPool(CHATBOT_LLM_MAX_CONCURRENCY)
+
+# Función para formatear un evento Server-Sent Events
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# Función para responder con un stream SSE: 'session' con el id de la sesión, un 'token'
+# por fragmento y al final 'done' (mismo cuerpo que la respuesta JSON) o 'error'
+def chatbot_sse_response(session_id, events):
+    def generate():
+        yield format_sse('session', {'session_id': session_id})
+        for kind, value in events:
+            yield format_sse(kind, value)
     
-    except Exception as e:
-        print(f"Error al obtener datos del usuario para chatbot: {e}")
-        return jsonify({'message': f'Error: {e}'}), 500
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/chatbot/message', methods=['POST'])
 @token_required
@@ -1701,75 +4218,98 @@ def send_chatbot_message(user_id):
             }), 400
             
         user_message = data.get('message', '')
-        conversation_history = data.get('conversation_history', [])
+        # El historial vive en el servidor: el cliente solo envía el id de la sesión (sin él,
+        # o si ya no existe, se abre una nueva y se devuelve su id) y 'conversation_history'
+        # ya no se usa
+        session_id = data.get('session_id')
+        # Con "stream": true la respuesta llega como Server-Sent Events
+        stream = data.get('stream', False)
         
         # Validar que el mensaje no esté vacío
-        if not user_message.strip():
+        if not isinstance(user_message, str) or not user_message.strip():
             return jsonify({
                 'error': 'Mensaje inválido',
                 'message': 'El mensaje no puede estar vacío'
             }), 400
-
-        # Obtener datos del usuario con mejor manejo de errores
-        try:
-            user_data = get_chatbot_user_data_internal(user_id)
-            if not user_data:
-                raise Exception('No se pudieron obtener los datos del usuario')
-        except Exception as e:
-            print(f"Error al obtener datos del usuario: {str(e)}")
+        if len(user_message) > CHATBOT_MESSAGE_MAX_CHARS:
             return jsonify({
-                'error': 'Error al obtener datos del usuario',
-                'message': 'No se pudieron obtener los datos necesarios para procesar tu mensaje'
-            }), 500
+                'error': 'Mensaje inválido',
+                'message': f'El mensaje no puede superar {CHATBOT_MESSAGE_MAX_CHARS} caracteres'
+            }), 400
+        if session_id is not None and (not isinstance(session_id, int) or isinstance(session_id, bool)):
+            return jsonify({
+                'error': 'Sesión inválida',
+                'message': 'session_id debe ser un número entero'
+            }), 400
+        if not isinstance(stream, bool):
+            return jsonify({
+                'error': 'Parámetro inválido',
+                'message': 'stream debe ser true o false'
+            }), 400
 
-        # Detectar patrones de comandos especiales con regex mejorados
-        complete_habit_pattern = re.compile(r'(?i)(?:completar|marcar)(?:\s+el)?(?:\s+h[áa]bito)?(?:\s*:)?\s+(.+?)(?:\s+como\s+(?:completado|terminado|hecho))?$')
-        habits_today_pattern = re.compile(r'(?i)(?:qu[ée]|cu[áa]les?)?\s+h[áa]bitos?\s+(?:debo|tengo|hay|para|hoy|pendientes?)')
-        finance_pattern = re.compile(r'(?i)(?:c[óo]mo|qu[ée]|cu[áa]nto)?\s+(?:van|est[áa]n?|tengo|mis|finanzas|gastos|ingresos|balance|dinero)')
-        events_pattern = re.compile(r'(?i)(?:cu[áa]l|qu[ée])?\s+(?:es|son|tengo|hay|mi|mis|pr[óo]ximos?|eventos?|citas?|reuniones?)')
-        progress_pattern = re.compile(r'(?i)(?:c[óo]mo|qu[ée])?\s+(?:ha\s+sido|va|es|mi|progreso|avance|desarrollo|evoluci[óo]n)')
-        
-        # Analizar si el mensaje contiene algún comando especial
-        complete_habit_match = complete_habit_pattern.search(user_message)
+        # Clasificar el mensaje antes de cargar datos: cada intención solo carga
+        # (de forma perezosa) las secciones del contexto que usa
+        intent = classify_intent(user_message)
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'message': 'Error de conexión a la base de datos'}), 500
+        user_data = ChatbotUserContext(user_id, conn=conn)
         
         try:
+            cur = conn.cursor()
+            
+            # Si hay un comando para completar un hábito
+            if intent.name == 'complete_habit':
+                response = handle_complete_habit(cur, user_id, intent.match)
+            
             # Para hábitos del día
-            if habits_today_pattern.search(user_message) and not complete_habit_match:
-                return handle_habits_today(user_data, user_message, conversation_history)
+            elif intent.name == 'habits_today':
+                response = handle_habits_today(user_data)
             
             # Para finanzas
-            elif finance_pattern.search(user_message):
-                return handle_finance_query(user_data, user_message, conversation_history)
+            elif intent.name == 'finance':
+                response = handle_finance_query(user_data)
                 
             # Para eventos próximos
-            elif events_pattern.search(user_message):
-                return handle_events_query(user_data, user_message, conversation_history)
+            elif intent.name == 'events':
+                response = handle_events_query(user_data)
                 
             # Para progreso
-            elif progress_pattern.search(user_message):
-                return handle_progress_query(user_data, user_message, conversation_history)
+            elif intent.name == 'progress':
+                response = handle_progress_query(user_data)
             
-            # Si hay un comando para completar un hábito
-            elif complete_habit_match:
-                return handle_complete_habit(user_id, complete_habit_match, user_message, conversation_history)
+            # Si no es un comando especial y hay un modelo configurado, generar la respuesta
+            elif get_chatbot_backend() is not None:
+                return start_chatbot_generation(conn, cur, user_data, user_id, session_id, user_message, stream)
             
-            # Si no es un comando especial, usar respuesta genérica
-            response = "Entiendo tu mensaje. ¿En qué más puedo ayudarte? Puedes preguntarme sobre tus hábitos, finanzas, eventos o progreso."
+            # Sin modelo, usar respuesta genérica
+            else:
+                response = "Entiendo tu mensaje. ¿En qué más puedo ayudarte? Puedes preguntarme sobre tus hábitos, finanzas, eventos o progreso."
             
-            return jsonify({
+            # Guardar el turno en la sesión y devolver solo los mensajes nuevos
+            session_id, messages = save_chatbot_turn(cur, user_id, session_id, user_message, response)
+            conn.commit()
+            cur.close()
+            
+            payload = {
                 'response': response,
-                'conversation_history': conversation_history + [
-                    {"role": "user", "parts": [user_message]},
-                    {"role": "model", "parts": [response]}
-                ]
-            })
+                'session_id': session_id,
+                'messages': messages
+            }
+            if stream:
+                return chatbot_sse_response(session_id, [('token', response), ('done', payload)])
+            return jsonify(payload)
             
         except Exception as e:
+            conn.rollback()
             print(f"Error al procesar el mensaje: {str(e)}")
             return jsonify({
                 'error': 'Error al procesar el mensaje',
                 'message': 'Ocurrió un error al procesar tu mensaje. Por favor, intenta de nuevo.'
             }), 500
+        finally:
+            user_data.close()
+            release_db_connection(conn)
             
     except Exception as e:
         print(f"Error general en el endpoint del chatbot: {str(e)}")
@@ -1778,8 +4318,116 @@ def send_chatbot_message(user_id):
             'message': 'Ha ocurrido un error inesperado. Por favor, intenta de nuevo más tarde.'
         }), 500
 
+# Función para lanzar la generación de la respuesta a un mensaje libre. El prompt se arma
+# aquí con la conexión de la petición, que se libera al responder; el modelo corre en el
+# pool de generaciones. Con stream la respuesta se transmite por SSE; sin él se responde
+# 202 al momento con session_id y after_seq, y el cliente consulta
+# /api/chatbot/sessions/<id>/messages?after_seq=N hasta que aparece la respuesta.
+def start_chatbot_generation(conn, cur, user_data, user_id, session_id, user_message, stream):
+    if not chatbot_generations.reserve():
+        return jsonify({
+            'error': 'Asistente ocupado',
+            'message': 'Hay demasiadas respuestas en curso. Por favor, intenta de nuevo en unos segundos.'
+        }), 503, {'Retry-After': '2'}
+    
+    try:
+        # La sesión se crea antes de generar para poder anunciar su id de inmediato
+        session = None
+        if session_id is not None:
+            cur.execute('''
+                SELECT summary, summarized_seq, last_seq FROM chatbot_sessions
+                WHERE id = %s AND user_id = %s
+            ''', (session_id, user_id))
+            session = cur.fetchone()
+        if session is None:
+            session_id = create_chatbot_session(cur, user_id)
+            session = ('', 0, 0)
+        summary, summarized_seq, last_seq = session
+        history = load_chatbot_window(cur, session_id, summarized_seq)
+        history.append({'role': 'user', 'parts': [user_message]})
+        prompt = build_chatbot_prompt(user_data, summary)
+        conn.commit()
+        cur.close()
+        
+        generation = ChatbotGeneration(user_id, session_id, user_message, stream)
+        chatbot_generations.start(get_chatbot_backend(), generation, prompt, history)
+    except Exception:
+        chatbot_generations.release()
+        raise
+    
+    if stream:
+        return chatbot_sse_response(session_id, generation.iter_events())
+    return jsonify({
+        'session_id': session_id,
+        'status': 'pending',
+        'after_seq': last_seq
+    }), 202
+
+# Endpoint para recuperar el historial de una sesión por páginas (p. ej. al recargar el chat):
+# ?after_seq=N devuelve solo los mensajes posteriores a N
+@app.route('/api/chatbot/sessions/<int:session_id>/messages', methods=['GET'])
+@token_required
+def get_chatbot_session_messages(user_id, session_id):
+    try:
+        after_seq = request.args.get('after_seq', 0, type=int)
+        
+        conn = get_db_connection()
+        if conn is None:
+            return jsonify({'message': 'Error de conexión a la base de datos'}), 500
+        cur = conn.cursor()
+        
+        cur.execute('''
+            SELECT summary, summarized_seq, last_seq FROM chatbot_sessions
+            WHERE id = %s AND user_id = %s
+        ''', (session_id, user_id))
+        session = cur.fetchone()
+        if not session:
+            cur.close()
+            release_db_connection(conn)
+            return jsonify({'error': 'Sesión no encontrada'}), 404
+        
+        summary, summarized_seq, last_seq = session
+        cur.execute('''
+            SELECT seq, role, content FROM chatbot_messages
+            WHERE session_id = %s AND seq > %s
+            ORDER BY seq
+            LIMIT %s
+        ''', (session_id, after_seq, CHATBOT_HISTORY_PAGE_SIZE))
+        messages = [chatbot_message_to_dict(*row) for row in cur.fetchall()]
+        
+        cur.close()
+        release_db_connection(conn)
+        
+        return jsonify({
+            'session_id': session_id,
+            'summary': summary,
+            'summarized_seq': summarized_seq,
+            'last_seq': last_seq,
+            'messages': messages,
+            'has_more': bool(messages) and messages[-1]['seq'] < last_seq
+        })
+    except psycopg2.Error as e:
+        print(f"Error al obtener el historial del chatbot: {e}")
+        return jsonify({'error': 'Error al obtener el historial'}), 500
+
+# Comando para purgar las sesiones inactivas: flask purge-chatbot-sessions
+@app.cli.command('purge-chatbot-sessions')
+@click.option('--days', type=int, default=CHATBOT_SESSION_RETENTION_DAYS,
+              help='Días sin actividad tras los que se elimina una sesión')
+def purge_chatbot_sessions_command(days):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            DELETE FROM chatbot_sessions
+            WHERE updated_at < LOCALTIMESTAMP - %s * interval '1 day'
+        ''', (days,))
+        purged = cur.rowcount
+        conn.commit()
+        cur.close()
+    click.echo(f'Sesiones de conversación purgadas: {purged}')
+
 # Funciones auxiliares para manejar diferentes tipos de consultas
-def handle_habits_today(user_data, user_message, conversation_history):
+def handle_habits_today(user_data):
     try:
         habits_today = [h for h in user_data['habits'] if h['scheduled_today']]
         
@@ -1808,18 +4456,12 @@ def handle_habits_today(user_data, user_message, conversation_history):
         else:
             response = "No tienes hábitos programados para hoy. ¿Te gustaría crear alguno nuevo?"
         
-        return jsonify({
-            'response': response,
-            'conversation_history': conversation_history + [
-                {"role": "user", "parts": [user_message]},
-                {"role": "model", "parts": [response]}
-            ]
-        })
+        return response
     except Exception as e:
         print(f"Error al procesar consulta de hábitos: {str(e)}")
         raise
 
-def handle_finance_query(user_data, user_message, conversation_history):
+def handle_finance_query(user_data):
     try:
         finance_data = user_data['finance']
         transactions = user_data['transactions']
@@ -1849,18 +4491,12 @@ def handle_finance_query(user_data, user_message, conversation_history):
         else:
             response = "No tengo información financiera disponible. ¿Te gustaría comenzar a registrar tus finanzas?"
         
-        return jsonify({
-            'response': response,
-            'conversation_history': conversation_history + [
-                {"role": "user", "parts": [user_message]},
-                {"role": "model", "parts": [response]}
-            ]
-        })
+        return response
     except Exception as e:
         print(f"Error al procesar consulta financiera: {str(e)}")
         raise
 
-def handle_events_query(user_data, user_message, conversation_history):
+def handle_events_query(user_data):
     try:
         events = user_data['events']
         
@@ -1891,18 +4527,12 @@ def handle_events_query(user_data, user_message, conversation_history):
         else:
             response = "No tienes eventos programados para hoy. ¡Tu agenda está libre!"
         
-        return jsonify({
-            'response': response,
-            'conversation_history': conversation_history + [
-                {"role": "user", "parts": [user_message]},
-                {"role": "model", "parts": [response]}
-            ]
-        })
+        return response
     except Exception as e:
         print(f"Error al procesar consulta de eventos: {str(e)}")
         raise
 
-def handle_progress_query(user_data, user_message, conversation_history):
+def handle_progress_query(user_data):
     try:
         habits = user_data['habits']
         goals = user_data.get('finance', {}).get('savings_goals', [])
@@ -1941,88 +4571,160 @@ def handle_progress_query(user_data, user_message, conversation_history):
         if not habits and not goals:
             response = "Aún no tienes suficientes datos para mostrar un análisis de progreso. Comienza creando hábitos o metas de ahorro."
         
-        return jsonify({
-            'response': response,
-            'conversation_history': conversation_history + [
-                {"role": "user", "parts": [user_message]},
-                {"role": "model", "parts": [response]}
-            ]
-        })
+        return response
     except Exception as e:
         print(f"Error al procesar consulta de progreso: {str(e)}")
         raise
 
-def handle_complete_habit(user_id, complete_habit_match, user_message, conversation_history):
+# ===== ÍNDICE DE NOMBRES DE HÁBITOS ===== #
+
+# Confianza mínima para completar un hábito sin preguntar, y ventaja mínima sobre el segundo
+# candidato; por debajo de HABIT_MATCH_MIN_CANDIDATE un hábito no se ofrece como opción
+HABIT_MATCH_MIN_CONFIDENCE = 0.5
+HABIT_MATCH_MIN_MARGIN = 0.15
+HABIT_MATCH_MIN_CANDIDATE = 0.3
+
+# Función para obtener los trigramas de un texto ya normalizado (como pg_trgm: cada palabra
+# con dos espacios delante y uno detrás)
+def text_trigrams(folded):
+    trigrams = set()
+    for word in re.findall(r'\w+', folded):
+        padded = f'  {word} '
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(trigrams)
+
+# Función para puntuar de 0 a 1 cuánto se parece un nombre buscado a un nombre indexado:
+# media entre la similitud de trigramas (Dice) y la proporción de la búsqueda contenida en
+# el nombre, para que "agua" encuentre "Beber 2 litros de agua" pese a la diferencia de largo
+def habit_name_similarity(query_folded, query_trigrams, name_folded, name_trigrams):
+    if query_folded == name_folded:
+        return 1.0
+    if not query_trigrams or not name_trigrams:
+        return 0.0
+    shared = len(query_trigrams & name_trigrams)
+    dice = 2 * shared / (len(query_trigrams) + len(name_trigrams))
+    containment = shared / len(query_trigrams)
+    return min(0.99, (dice + containment) / 2)
+
+HabitNameEntry = namedtuple('HabitNameEntry', ['id', 'name', 'folded', 'trigrams'])
+
+# Índice en memoria de los nombres de los hábitos activos de cada usuario (sin acentos, en
+# minúsculas y por trigramas). Se carga con una consulta la primera vez que se busca, se
+# invalida al crear, editar, archivar o eliminar un hábito y caduca tras
+# HABIT_NAME_INDEX_TTL segundos para recoger cambios hechos en otros procesos.
+class HabitNameIndex:
+    def __init__(self, ttl, max_users):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._users = OrderedDict()  # user_id -> (caduca, [HabitNameEntry])
+        self._lock = threading.Lock()
+
+    def _entries(self, cur, user_id):
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached and cached[0] > time.monotonic():
+                self._users.move_to_end(user_id)
+                return cached[1]
+        
+        cur.execute("SELECT id, name FROM habits WHERE user_id = %s AND status = 'active'", (user_id,))
+        entries = []
+        for habit_id, name in cur.fetchall():
+            folded = fold_text(name).strip()
+            entries.append(HabitNameEntry(habit_id, name, folded, text_trigrams(folded)))
+        
+        with self._lock:
+            self._users[user_id] = (time.monotonic() + self.ttl, entries)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return entries
+
+    # Devuelve los candidatos como [(confianza, id, nombre)] de mayor a menor confianza
+    def search(self, cur, user_id, query, limit=5):
+        query_folded = fold_text(query).strip()
+        query_trigrams = text_trigrams(query_folded)
+        candidates = []
+        for entry in self._entries(cur, user_id):
+            score = habit_name_similarity(query_folded, query_trigrams, entry.folded, entry.trigrams)
+            if score >= HABIT_MATCH_MIN_CANDIDATE:
+                candidates.append((round(score, 3), entry.id, entry.name))
+        candidates.sort(key=lambda candidate: -candidate[0])
+        return candidates[:limit]
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+habit_name_index = HabitNameIndex(HABIT_NAME_INDEX_TTL, HABIT_NAME_INDEX_MAX_USERS)
+
+# Función para decidir si el mejor candidato es lo bastante claro para usarlo sin preguntar
+def is_confident_habit_match(candidates):
+    if not candidates or candidates[0][0] < HABIT_MATCH_MIN_CONFIDENCE:
+        return False
+    return len(candidates) == 1 or candidates[0][0] - candidates[1][0] >= HABIT_MATCH_MIN_MARGIN
+
+# Completa el hábito con el cursor de la petición, sin confirmar: el commit lo hace quien
+# llama junto con el turno de la conversación
+def handle_complete_habit(cur, user_id, complete_habit_match):
     try:
         habit_name = complete_habit_match.group(1).strip()
         
-        # Buscar el hábito por nombre
-        conn = get_db_connection()
-        cur = conn.cursor()
+        # Buscar el hábito en el índice de nombres; si el elegido ya no está activo (índice
+        # desactualizado por otro proceso), se recarga el índice y se busca de nuevo
+        habit = None
+        for _ in range(2):
+            candidates = habit_name_index.search(cur, user_id, habit_name)
+            if not is_confident_habit_match(candidates):
+                break
+            cur.execute(
+                "SELECT id, name FROM habits WHERE id = %s AND user_id = %s AND status = 'active'",
+                (candidates[0][1], user_id)
+            )
+            habit = cur.fetchone()
+            if habit:
+                break
+            habit_name_index.invalidate(user_id)
         
-        # Buscar hábitos que coincidan con el nombre
-        cur.execute('''
-            SELECT id, name FROM habits 
-            WHERE user_id = %s AND status = 'active' 
-            AND LOWER(name) LIKE LOWER(%s)
-        ''', (user_id, f"%{habit_name}%"))
-        
-        matching_habits = cur.fetchall()
-        
-        if matching_habits:
-            # Si hay exactamente una coincidencia, completar ese hábito
-            if len(matching_habits) == 1:
-                habit_id = matching_habits[0][0]
-                exact_habit_name = matching_habits[0][1]
-                
-                # Verificar si ya está completado
-                today = date.today()
+        if habit:
+            habit_id, exact_habit_name = habit
+            
+            # Verificar si ya está completado
+            today = date.today()
+            cur.execute('''
+                SELECT COUNT(*) FROM habit_completions 
+                WHERE habit_id = %s AND completion_date = %s
+            ''', (habit_id, today))
+            
+            already_completed = cur.fetchone()[0] > 0
+            
+            if already_completed:
+                # Respuesta si ya está completado
+                model_response = f"El hábito '{exact_habit_name}' ya fue completado hoy. ¡Buen trabajo! 👍"
+            else:
+                # Completar el hábito
                 cur.execute('''
-                    SELECT COUNT(*) FROM habit_completions 
-                    WHERE habit_id = %s AND completion_date = %s
+                    INSERT INTO habit_completions (habit_id, completion_date)
+                    VALUES (%s, %s)
                 ''', (habit_id, today))
                 
-                already_completed = cur.fetchone()[0] > 0
+                # Actualizar racha
+                update_streak_on_completion(cur, habit_id, today)
                 
-                if already_completed:
-                    # Respuesta si ya está completado
-                    model_response = f"El hábito '{exact_habit_name}' ya fue completado hoy. ¡Buen trabajo! 👍"
-                else:
-                    # Completar el hábito
-                    cur.execute('''
-                        INSERT INTO habit_completions (habit_id, user_id, completion_date)
-                        VALUES (%s, %s, %s)
-                    ''', (habit_id, user_id, today))
-                    
-                    # Recalcular racha
-                    recalculate_streak(cur, habit_id)
-                    
-                    conn.commit()
-                    
-                    # Respuesta de confirmación
-                    model_response = f"¡Excelente! He marcado '{exact_habit_name}' como completado. ¡Sigue así! 🎉"
-            else:
-                # Si hay múltiples coincidencias, mostrar opciones
-                model_response = "Encontré varios hábitos que coinciden con ese nombre. ¿A cuál te refieres?\n\n"
-                for i, (_, h_name) in enumerate(matching_habits):
-                    model_response += f"{i+1}. {h_name}\n"
-                model_response += "\nPor favor, sé más específico o usa el nombre exacto para completarlo."
+                bump_resource_version(cur, user_id, RESOURCE_HABITS)
+                
+                # Respuesta de confirmación
+                model_response = f"¡Excelente! He marcado '{exact_habit_name}' como completado. ¡Sigue así! 🎉"
+        elif candidates:
+            # Si hay varias coincidencias parecidas, mostrar las opciones por relevancia
+            model_response = "Encontré varios hábitos que coinciden con ese nombre. ¿A cuál te refieres?\n\n"
+            for i, (_, _, h_name) in enumerate(candidates):
+                model_response += f"{i+1}. {h_name}\n"
+            model_response += "\nPor favor, sé más específico o usa el nombre exacto para completarlo."
         else:
             # Si no hay coincidencias
             model_response = f"No encontré ningún hábito activo que coincida con '{habit_name}'. ¿Está escrito correctamente?"
         
-        # Cerrar conexión
-        cur.close()
-        conn.close()
-        
-        # Devolver la respuesta
-        return jsonify({
-            'response': model_response,
-            'conversation_history': conversation_history + [
-                {"role": "user", "parts": [user_message]},
-                {"role": "model", "parts": [model_response]}
-            ]
-        })
+        return model_response
     except Exception as e:
         print(f"Error al procesar comando de completar hábito: {str(e)}")
         raise
@@ -2099,7 +4801,197 @@ def format_user_data_for_chatbot(user_data):
         print(f"Error formateando datos de usuario para chatbot: {e}")
         return f"Error al formatear datos: {e}"
 
-# Función interna para obtener datos del usuario para el chatbot sin usar la respuesta JSON
+# Consultas del contexto del chatbot por sección. Las secciones que solo se muestran
+# (usuario, hábitos, transacciones y finanzas con sus metas) devuelven JSON ya formateado
+# por la base de datos; los eventos del día llegan con tipos nativos para expandir las
+# series recurrentes, y cada serie trae sus excepciones del día como JSON.
+CHATBOT_HABIT_ROWS_SQL = '''
+    SELECT h.id, h.name, h.frequency, h.current_streak, h.status,
+           to_char(h.start_time, 'HH24:MI') AS start_time,
+           to_char(h.end_time, 'HH24:MI') AS end_time,
+           json_build_object('name', c.name, 'color', c.color) AS category,
+           EXISTS (
+               SELECT 1 FROM habit_completions hc
+               WHERE hc.habit_id = h.id AND hc.completion_date = %(today)s
+           ) AS completed_today,
+           h.days_of_week, h.days_of_month, h.days_of_week_mask, h.days_of_month_mask,
+           to_char(%(today)s::date + h.start_time, 'YYYY-MM-DD"T"HH24:MI:SS') AS block_start,
+           to_char(%(today)s::date + h.end_time, 'YYYY-MM-DD"T"HH24:MI:SS') AS block_end,
+           row_number() OVER (ORDER BY h.created_at DESC) AS position
+    FROM habits h
+    JOIN habit_categories c ON h.category_id = c.id
+    WHERE h.user_id = %(user_id)s AND h.status = 'active'
+'''
+
+CHATBOT_TRANSACTION_ROWS_SQL = '''
+    SELECT t.id, t.amount::float AS amount, t.description, t.type,
+           COALESCE(to_char(t.date, 'YYYY-MM-DD HH24:MI:SS'), '') AS date,
+           c.name AS category_name, c.color AS category_color,
+           row_number() OVER (ORDER BY t.date DESC) AS position
+    FROM transactions t
+    JOIN categories c ON t.category_id = c.id
+    WHERE t.user_id = %(user_id)s
+    ORDER BY t.date DESC
+    LIMIT 10
+'''
+
+CHATBOT_DAY_EVENTS_SQL = '''
+    SELECT e.id, e.title, e.description, e.category_id, e.start_datetime,
+           e.end_datetime, e.location, e.is_all_day, e.google_event_id,
+           c.name AS category_name, c.color AS category_color, e.recurrence_rule,
+           CASE WHEN e.recurrence_rule IS NOT NULL THEN (
+               SELECT json_agg(json_build_object(
+                   'occurrence_start', x.occurrence_start, 'is_cancelled', x.is_cancelled,
+                   'title', x.title, 'description', x.description,
+                   'start_datetime', x.start_datetime, 'end_datetime', x.end_datetime,
+                   'location', x.location
+               ))::text
+               FROM event_exceptions x
+               WHERE x.event_id = e.id
+               AND (
+                   x.occurrence_start BETWEEN %(day_start)s - (e.end_datetime - e.start_datetime) AND %(day_end)s
+                   OR (NOT x.is_cancelled AND tsrange(x.start_datetime, x.end_datetime, '[]')
+                       && tsrange(%(day_start)s, %(day_end)s, '[]'))
+               )
+           ) END AS exceptions,
+           row_number() OVER (ORDER BY e.start_datetime, e.id) AS position
+    FROM events e
+    JOIN event_categories c ON e.category_id = c.id
+    WHERE e.user_id = %(user_id)s
+    AND ''' + EVENT_SPAN_SQL + ''' && tsrange(%(day_start)s, %(day_end)s, '[]')
+    AND e.status = 'active'
+'''
+
+# Expresiones JSON de cada sección (las de hábitos y transacciones leen sus CTE)
+CHATBOT_SECTION_JSON_SQL = {
+    'user': "(SELECT json_build_object('name', name, 'email', email) FROM users WHERE id = %(user_id)s)",
+    'habits': "(SELECT COALESCE(json_agg(habit_rows ORDER BY position), '[]') FROM habit_rows)",
+    'transactions': "(SELECT COALESCE(json_agg(transaction_rows ORDER BY position), '[]') FROM transaction_rows)",
+    'finance': '''json_build_object(
+        'income', (SELECT COALESCE(SUM(total) FILTER (WHERE type = 'ingreso'), 0)::float
+                   FROM ledger_monthly_rollups WHERE user_id = %(user_id)s AND month = %(month)s),
+        'expenses', (SELECT COALESCE(SUM(total) FILTER (WHERE type = 'gasto'), 0)::float
+                     FROM ledger_monthly_rollups WHERE user_id = %(user_id)s AND month = %(month)s),
+        'savings_goals', (SELECT COALESCE(json_agg(json_build_object(
+                              'id', g.id, 'name', g.name,
+                              'target_amount', g.target_amount::float,
+                              'current_amount', g.current_amount::float,
+                              'target_date', to_char(g.target_date, 'YYYY-MM-DD')
+                          ) ORDER BY g.id), '[]')
+                          FROM savings_goals g WHERE g.user_id = %(user_id)s)
+    )'''
+}
+
+CHATBOT_EVENT_COLUMNS = '''d.id, d.title, d.description, d.category_id, d.start_datetime, d.end_datetime,
+           d.location, d.is_all_day, d.google_event_id, d.category_name, d.category_color,
+           d.recurrence_rule, d.exceptions'''
+
+# Consulta de una sola sección (para la carga perezosa por intención)
+CHATBOT_SECTION_SQL = {
+    'user': f"SELECT {CHATBOT_SECTION_JSON_SQL['user']}::text",
+    'habits': f"WITH habit_rows AS ({CHATBOT_HABIT_ROWS_SQL}) SELECT {CHATBOT_SECTION_JSON_SQL['habits']}::text",
+    'transactions': f"WITH transaction_rows AS ({CHATBOT_TRANSACTION_ROWS_SQL}) "
+                    f"SELECT {CHATBOT_SECTION_JSON_SQL['transactions']}::text",
+    'finance': f"SELECT {CHATBOT_SECTION_JSON_SQL['finance']}::text",
+    'events': f"WITH day_events AS ({CHATBOT_DAY_EVENTS_SQL}) "
+              f"SELECT {CHATBOT_EVENT_COLUMNS} FROM day_events d ORDER BY d.position"
+}
+
+# Consulta única con el contexto completo: las secciones JSON llegan en un solo objeto
+# en la primera fila y las filas son los eventos del día
+CHATBOT_CONTEXT_SQL = f'''
+    WITH habit_rows AS ({CHATBOT_HABIT_ROWS_SQL}),
+    transaction_rows AS ({CHATBOT_TRANSACTION_ROWS_SQL}),
+    context AS (
+        SELECT json_build_object(
+            {", ".join(f"'{name}', {sql}" for name, sql in CHATBOT_SECTION_JSON_SQL.items())}
+        )::text AS payload
+    ),
+    day_events AS ({CHATBOT_DAY_EVENTS_SQL})
+    SELECT CASE WHEN d.position IS NULL OR d.position = 1 THEN context.payload END,
+           {CHATBOT_EVENT_COLUMNS}
+    FROM context
+    LEFT JOIN day_events d ON true
+    ORDER BY d.position
+'''
+
+# Función para convertir las excepciones en JSON de una serie al formato de
+# load_event_exceptions ({occurrence_start: fila})
+def event_exceptions_from_json(event_id, exceptions_json):
+    exceptions = {}
+    for x in json.loads(exceptions_json):
+        occurrence_start = datetime.fromisoformat(x['occurrence_start'])
+        exceptions[occurrence_start] = (
+            event_id, occurrence_start, x['is_cancelled'], x['title'], x['description'],
+            datetime.fromisoformat(x['start_datetime']) if x['start_datetime'] else None,
+            datetime.fromisoformat(x['end_datetime']) if x['end_datetime'] else None,
+            x['location']
+        )
+    return exceptions
+
+# Función para completar los hábitos de la sección JSON con su programación de hoy.
+# Devuelve (hábitos, bloques de calendario de los que tienen horario y tocan hoy), con
+# las horas de los bloques ya formateadas por la consulta.
+def chatbot_habits_from_json(habit_rows, today):
+    habits = []
+    habit_blocks = []
+    for h in habit_rows:
+        del h['position']
+        schedule = compile_habit_schedule(h['frequency'], h.pop('days_of_week'), h.pop('days_of_month'),
+                                          h.pop('days_of_week_mask'), h.pop('days_of_month_mask'))
+        block_start, block_end = h.pop('block_start'), h.pop('block_end')
+        h['scheduled_today'] = schedule.is_scheduled(today)
+        habits.append(h)
+        if h['scheduled_today'] and block_start and block_end:
+            habit_blocks.append({
+                'id': f"habit_{h['id']}",
+                'title': h['name'],
+                'description': f"Hábito: {h['name']}",
+                'start_datetime': block_start,
+                'end_datetime': block_end,
+                'location': '',
+                'is_all_day': False,
+                'google_event_id': None,
+                'category': {
+                    'name': 'Hábitos',
+                    'color': 'green'
+                },
+                'is_habit': True,
+                'completed': h['completed_today']
+            })
+    return habits, habit_blocks
+
+# Función para convertir las filas de eventos del día (columnas de CHATBOT_EVENT_COLUMNS)
+# en la lista del contexto, con las series expandidas y los bloques de hábitos intercalados
+def chatbot_events_from_rows(rows, habit_blocks, day_start, day_end):
+    event_rows = [tuple(row[:12]) for row in rows if row[0] is not None]
+    exceptions = {row[0]: event_exceptions_from_json(row[0], row[12]) for row in rows if row[12]}
+    events = [event_row_to_dict(e) for e in merge_event_occurrences(event_rows, exceptions, day_start, day_end)]
+    events.extend(habit_blocks)
+    events.sort(key=itemgetter('start_datetime'))
+    return events
+
+# Función para convertir la sección de finanzas al formato del contexto
+def chatbot_finance_from_json(finance):
+    return {
+        'current_month_income': finance['income'],
+        'current_month_expenses': finance['expenses'],
+        'balance': finance['income'] - finance['expenses'],
+        'savings_goals': finance['savings_goals']
+    }
+
+# Función para los parámetros de las consultas del contexto del chatbot
+def chatbot_context_params(user_id, today):
+    return {
+        'user_id': user_id,
+        'today': today,
+        'month': date(today.year, today.month, 1),
+        'day_start': datetime.combine(today, datetime.min.time()),
+        'day_end': datetime.combine(today, datetime.max.time())
+    }
+
+# Función interna para obtener datos del usuario para el chatbot sin usar la respuesta JSON.
+# Todo el contexto sale de una sola consulta, sin importar cuántos hábitos o eventos haya.
 def get_chatbot_user_data_internal(user_id, conn=None, cur=None):
     close_conn = False
     if conn is None:
@@ -2109,177 +5001,338 @@ def get_chatbot_user_data_internal(user_id, conn=None, cur=None):
             raise Exception('Error de conexión a la base de datos')
         cur = conn.cursor()
     try:
-        # Obtener información básica del usuario
-        cur.execute('SELECT name, email FROM users WHERE id = %s', (user_id,))
-        user = cur.fetchone()
-        if not user:
-            raise Exception('Usuario no encontrado')
-        user_info = {
-            'name': user[0],
-            'email': user[1]
-        }
-        # Obtener hábitos del usuario
-        cur.execute('''
-            SELECT h.id, h.name, h.frequency, h.days_of_week, h.days_of_month, \
-                   h.current_streak, h.status, h.start_time, h.end_time,\
-                   c.name as category_name, c.color as category_color\
-            FROM habits h\
-            JOIN habit_categories c ON h.category_id = c.id\
-            WHERE h.user_id = %s AND h.status = 'active'\
-        ''', (user_id,))
-        habits = []
-        today = date.today()
-        for h in cur.fetchall():
-            habit_frequency = h[2]
-            habit_days_of_week = h[3]
-            habit_days_of_month = h[4]
-            scheduled_today = is_habit_scheduled_for_date(habit_frequency, habit_days_of_week, habit_days_of_month, today)
-            cur.execute('''
-                SELECT COUNT(*) FROM habit_completions \
-                WHERE habit_id = %s AND completion_date = %s\
-            ''', (h[0], today))
-            completed_today = cur.fetchone()[0] > 0
-            habits.append({
-                'id': h[0],
-                'name': h[1],
-                'frequency': h[2],
-                'current_streak': h[5],
-                'status': h[6],
-                'start_time': h[7].strftime('%H:%M') if h[7] else None,
-                'end_time': h[8].strftime('%H:%M') if h[8] else None,
-                'category': {
-                    'name': h[9],
-                    'color': h[10]
-                },
-                'scheduled_today': scheduled_today,
-                'completed_today': completed_today
-            })
-        # Obtener transacciones recientes
-        cur.execute('''
-            SELECT t.id, t.amount, t.description, t.type, t.date, c.name as category_name, c.color as category_color\
-            FROM transactions t\
-            JOIN categories c ON t.category_id = c.id\
-            WHERE t.user_id = %s\
-            ORDER BY t.date DESC\
-            LIMIT 10\
-        ''', (user_id,))
-        transactions = []
-        for t in cur.fetchall():
-            transactions.append({
-                'id': t[0],
-                'amount': float(t[1]),
-                'description': t[2],
-                'type': t[3],
-                'date': t[4].strftime('%Y-%m-%d %H:%M:%S') if t[4] else "",
-                'category_name': t[5],
-                'category_color': t[6]
-            })
-        # Obtener resumen financiero
         today = date.today()
-        first_day_current_month = date(today.year, today.month, 1)
-        cur.execute('''
-            SELECT \
-                COALESCE(SUM(CASE WHEN type = 'ingreso' THEN amount ELSE 0 END), 0) as income,\
-                COALESCE(SUM(CASE WHEN type = 'gasto' THEN amount ELSE 0 END), 0) as expenses\
-            FROM transactions \
-            WHERE user_id = %s AND date >= %s\
-        ''', (user_id, first_day_current_month))
-        financial_summary = cur.fetchone() or (0, 0)
-        current_month_income = float(financial_summary[0])
-        current_month_expenses = float(financial_summary[1])
-        # Obtener metas de ahorro
-        cur.execute('''
-            SELECT id, name, target_amount, current_amount, target_date\
-            FROM savings_goals\
-            WHERE user_id = %s\
-        ''', (user_id,))
-        savings_goals = []
-        for goal in cur.fetchall():
-            savings_goals.append({
-                'id': goal[0],
-                'name': goal[1],
-                'target_amount': float(goal[2]),
-                'current_amount': float(goal[3]),
-                'target_date': goal[4].strftime('%Y-%m-%d') if goal[4] else None
-            })
-        # Obtener eventos del día actual
-        day_start = datetime.combine(today, datetime.min.time())
-        day_end = datetime.combine(today, datetime.max.time())
-        cur.execute('''
-            SELECT e.id, e.title, e.description, e.start_datetime, e.end_datetime, \
-                   e.location, e.is_all_day, c.name as category_name, c.color as category_color\
-            FROM events e\
-            JOIN event_categories c ON e.category_id = c.id\
-            WHERE e.user_id = %s \
-            AND (\
-                (e.start_datetime BETWEEN %s AND %s) OR \
-                (e.end_datetime BETWEEN %s AND %s) OR\
-                (e.start_datetime <= %s AND e.end_datetime >= %s)\
-            )\
-            AND e.status = 'active'\
-            ORDER BY e.start_datetime\
-        ''', (user_id, day_start, day_end, day_start, day_end, day_start, day_end))
-        events = []
-        for e in cur.fetchall():
-            start_dt = e[3].strftime('%Y-%m-%dT%H:%M:%S') if e[3] else ""
-            end_dt = e[4].strftime('%Y-%m-%dT%H:%M:%S') if e[4] else ""
-            events.append({
-                'id': e[0],
-                'title': e[1],
-                'description': e[2],
-                'start_datetime': start_dt,
-                'end_datetime': end_dt,
-                'location': e[5],
-                'is_all_day': e[6],
-                'category': {
-                    'name': e[7],
-                    'color': e[8]
-                }
-            })
-        for h in habits:
-            if h['scheduled_today'] and h['start_time'] and h['end_time']:
-                try:
-                    start_time = datetime.strptime(h['start_time'], '%H:%M').time()
-                    end_time = datetime.strptime(h['end_time'], '%H:%M').time()
-                    habit_start = datetime.combine(today, start_time)
-                    habit_end = datetime.combine(today, end_time)
-                    events.append({
-                        'id': f"habit_{h['id']}",
-                        'title': h['name'],
-                        'description': f"Hábito: {h['name']}",
-                        'start_datetime': habit_start.strftime('%Y-%m-%dT%H:%M:%S'),
-                        'end_datetime': habit_end.strftime('%Y-%m-%dT%H:%M:%S'),
-                        'location': '',
-                        'is_all_day': False,
-                        'google_event_id': None,
-                        'category': {
-                            'name': 'Hábitos',
-                            'color': 'green'
-                        },
-                        'is_habit': True,
-                        'completed': h['completed_today']
-                    })
-                except Exception:
-                    pass
-        events.sort(key=lambda x: x['start_datetime'] if x['start_datetime'] else '')
-        result = {
-            'user': user_info,
+        params = chatbot_context_params(user_id, today)
+        cur.execute(CHATBOT_CONTEXT_SQL, params)
+        rows = cur.fetchall()
+        context = json.loads(rows[0][0])
+        if not context['user']:
+            raise Exception('Usuario no encontrado')
+        
+        habits, habit_blocks = chatbot_habits_from_json(context['habits'], today)
+        for t in context['transactions']:
+            del t['position']
+        
+        return {
+            'user': context['user'],
             'habits': habits,
-            'transactions': transactions,
-            'finance': {
-                'current_month_income': current_month_income,
-                'current_month_expenses': current_month_expenses,
-                'balance': current_month_income - current_month_expenses,
-                'savings_goals': savings_goals
-            },
-            'events': events
+            'transactions': context['transactions'],
+            'finance': chatbot_finance_from_json(context['finance']),
+            'events': chatbot_events_from_rows([row[1:] for row in rows], habit_blocks,
+                                               params['day_start'], params['day_end'])
         }
-        return result
     finally:
         if close_conn and conn:
             if 'cur' in locals() and cur:
                 cur.close()
-            conn.close()
+            release_db_connection(conn)
+
+# Contexto del usuario para un mensaje del chatbot que carga cada sección (user, habits,
+# transactions, finance, events) la primera vez que se accede a ella y la memoriza durante
+# la petición. Se usa como el diccionario de get_chatbot_user_data_internal, así que cada
+# intención solo paga por los datos que lee; la conexión se pide al primer acceso, salvo
+# que se pase la de la petición (conn), que entonces se usa y no se devuelve al pool.
+class ChatbotUserContext:
+    def __init__(self, user_id, today=None, conn=None):
+        self.user_id = user_id
+        self.today = today or date.today()
+        self.params = chatbot_context_params(user_id, self.today)
+        self._sections = {}
+        self._habit_blocks = []
+        self._conn = conn
+        self._owns_conn = conn is None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._conn is not None and self._owns_conn:
+            release_db_connection(self._conn)
+        self._conn = None
+
+    def __getitem__(self, name):
+        if name not in self._sections:
+            if name not in CHATBOT_SECTION_SQL:
+                raise KeyError(name)
+            self._sections[name] = self._load(name)
+        return self._sections[name]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def loaded_sections(self):
+        return tuple(self._sections)
+
+    def _load(self, name):
+        if self._conn is None:
+            self._conn = get_db_connection()
+            if self._conn is None:
+                raise Exception('Error de conexión a la base de datos')
+        if name == 'events':
+            # Los bloques de hábitos del día forman parte de los eventos
+            self['habits']
+        
+        cur = self._conn.cursor()
+        try:
+            cur.execute(CHATBOT_SECTION_SQL[name], self.params)
+            if name == 'events':
+                return chatbot_events_from_rows(cur.fetchall(), self._habit_blocks,
+                                                self.params['day_start'], self.params['day_end'])
+            data = json.loads(cur.fetchone()[0])
+        finally:
+            cur.close()
+        
+        if name == 'user' and not data:
+            raise Exception('Usuario no encontrado')
+        if name == 'habits':
+            habits, self._habit_blocks = chatbot_habits_from_json(data, self.today)
+            return habits
+        if name == 'transactions':
+            for t in data:
+                del t['position']
+        if name == 'finance':
+            return chatbot_finance_from_json(data)
+        return data
+
+# ===== MIGRACIONES DE ESQUEMA ===== #
+
+# Las migraciones son archivos NNNN_descripcion.sql en migrations/, que se aplican
+# una sola vez y en orden (solo hacia adelante). Las ya aplicadas se registran en
+# schema_migrations. Instalación nueva: ejecutar schema.sql y después las migraciones.
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATIONS_LOCK_ID = 727001  # pg_advisory_lock para que dos procesos no migren a la vez
+
+# Función para aplicar las migraciones pendientes; devuelve las versiones aplicadas
+def apply_migrations(conn):
+    cur = conn.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version VARCHAR(255) PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    
+    cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATIONS_LOCK_ID,))
+    try:
+        cur.execute('SELECT version FROM schema_migrations')
+        applied = {row[0] for row in cur.fetchall()}
+        conn.commit()
+        
+        applied_now = []
+        for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+            if not filename.endswith('.sql'):
+                continue
+            version = filename[:-len('.sql')]
+            if version in applied:
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, filename), encoding='utf-8') as f:
+                sql = f.read()
+            try:
+                # Cada migración se aplica en su propia transacción
+                cur.execute(sql)
+                cur.execute('INSERT INTO schema_migrations (version) VALUES (%s)', (version,))
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                raise
+            applied_now.append(version)
+        return applied_now
+    finally:
+        cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK_ID,))
+        conn.commit()
+        cur.close()
+
+# Comando para aplicar las migraciones pendientes:
+#     flask --app app migrate
+@app.cli.command('migrate')
+def migrate_command():
+    with db_connection() as conn:
+        applied = apply_migrations(conn)
+    if applied:
+        for version in applied:
+            click.echo(f'Migración aplicada: {version}')
+    else:
+        click.echo('No hay migraciones pendientes')
+
+# ===== VERIFICACIÓN DE PLANES DE CONSULTA ===== #
+
+# Consultas más frecuentes de app.py con la tabla que debe leerse mediante un índice.
+# Son las mismas constantes que ejecutan los endpoints; los parámetros se rellenan con
+# un usuario/hábito del conjunto de datos sembrado y el día de hoy, y el cuarto campo
+# (una función de hoy) sustituye los que dependen de la llamada, como los rangos reales.
+HOT_QUERIES = [
+    ('get_recent_transactions', 'transactions', RECENT_TRANSACTIONS_SQL, None),
+    ('get_transactions_with_details', 'transactions',
+     TRANSACTIONS_WITH_DETAILS_SQL + TRANSACTIONS_PAGE_SQL, None),
+    ('get_transactions_with_details (cursor)', 'transactions',
+     TRANSACTIONS_WITH_DETAILS_SQL + TRANSACTIONS_AFTER_CURSOR_SQL + TRANSACTIONS_PAGE_SQL, None),
+    ('get_finance_summary', 'ledger_monthly_rollups', FINANCE_SUMMARY_SQL, None),
+    ('get_finance_summary (categorías)', 'categories', FINANCE_SUMMARY_SQL, None),
+    ('get_finance_summary (metas)', 'savings_goals', FINANCE_SUMMARY_SQL, None),
+    ('get_categories', 'categories', CATEGORIES_SQL, None),
+    ('load_habit_states', 'habits', HABIT_STATES_SQL, None),
+    ('load_habit_states (completaciones del día)', 'habit_completions',
+     HABIT_COMPLETIONS_IN_RANGE_SQL, None),
+    ('load_habit_states (completaciones de la semana)', 'habit_completions',
+     HABIT_COMPLETIONS_IN_RANGE_SQL, lambda today: {'date_from': today - timedelta(days=6)}),
+    ('load_habit_states (completaciones del calendario)', 'habit_completions',
+     HABIT_COMPLETIONS_IN_RANGE_SQL,
+     lambda today: {'date_from': today - timedelta(days=MAX_CALENDAR_RANGE_DAYS)}),
+    ('iter_completion_dates_desc', 'habit_completions', COMPLETION_DATES_DESC_SQL,
+     lambda today: {'limit': 32}),
+    ('iter_completion_dates_desc (páginas siguientes)', 'habit_completions', COMPLETION_DATES_BEFORE_SQL,
+     lambda today: {'before': today - timedelta(days=32), 'limit': 64}),
+    ('get_events', 'events', EVENTS_SQL + EVENTS_ORDER_SQL, None),
+    ('sync_events', 'events', SYNC_EVENTS_SQL, lambda today: {'limit': SYNC_PAGE_SIZE + 1}),
+    ('sync_events (inicial)', 'events', SYNC_EVENTS_SQL,
+     lambda today: {'since': datetime.min, 'since_id': 0, 'include_deleted': False,
+                    'limit': SYNC_PAGE_SIZE + 1}),
+    ('fetch_events_overlapping', 'events', EVENTS_OVERLAPPING_SQL, None),
+    ('fetch_events_overlapping (calendario)', 'events', EVENTS_OVERLAPPING_SQL,
+     lambda today: {'range_start': datetime.combine(today - timedelta(days=MAX_CALENDAR_RANGE_DAYS),
+                                                    datetime.min.time())}),
+    ('get_chatbot_user_data_internal (eventos)', 'events', CHATBOT_CONTEXT_SQL, None),
+    ('get_chatbot_user_data_internal (hábitos)', 'habits', CHATBOT_CONTEXT_SQL, None),
+    ('get_chatbot_user_data_internal (completaciones)', 'habit_completions', CHATBOT_CONTEXT_SQL, None),
+    ('get_chatbot_user_data_internal (transacciones)', 'transactions', CHATBOT_CONTEXT_SQL, None),
+    ('get_chatbot_user_data_internal (finanzas)', 'ledger_monthly_rollups', CHATBOT_CONTEXT_SQL, None),
+    ('ChatbotContext events', 'events', CHATBOT_SECTION_SQL['events'], None),
+]
+
+# Función para sembrar un conjunto de datos sintético (dentro de la transacción actual)
+# con suficientes filas para que el planificador prefiera los índices
+def seed_query_plan_dataset(cur, users=200, rows_per_user=100):
+    cur.execute('''
+        INSERT INTO users (name, email, password)
+        SELECT 'plan-check ' || n, 'plan-check-' || n || '@example.invalid', 'x'
+        FROM generate_series(1, %s) n
+        RETURNING id
+    ''', (users,))
+    user_ids = [row[0] for row in cur.fetchall()]
+    cur.execute('''
+        INSERT INTO categories (user_id, name, budget, color)
+        SELECT u, name, 100, 'green'
+        FROM unnest(%s) u, unnest(ARRAY['Comida', 'Transporte', 'Entretenimiento', 'Ahorro']) name
+    ''', (user_ids,))
+    cur.execute('''
+        INSERT INTO transactions (user_id, category_id, amount, description, type, date)
+        SELECT c.user_id, c.id, 10, 'plan-check',
+               CASE WHEN n %% 5 = 0 THEN 'ingreso' ELSE 'gasto' END,
+               CURRENT_DATE - n
+        FROM categories c
+        JOIN unnest(%s) u ON c.user_id = u,
+        generate_series(1, %s / 4) n
+    ''', (user_ids, rows_per_user))
+    cur.execute('''
+        INSERT INTO ledger_monthly_rollups (user_id, category_id, month, type, total, tx_count)
+        SELECT user_id, category_id, date_trunc('month', date)::date, type, SUM(amount), COUNT(*)
+        FROM transactions
+        WHERE user_id = ANY(%s)
+        GROUP BY user_id, category_id, date_trunc('month', date)::date, type
+    ''', (user_ids,))
+    cur.execute('''
+        INSERT INTO savings_goals (user_id, name, target_amount)
+        SELECT u, 'plan-check ' || n, 1000
+        FROM unnest(%s) u, generate_series(1, 3) n
+    ''', (user_ids,))
+    cur.execute('''
+        INSERT INTO habits (user_id, name, category_id, frequency, start_date, status)
+        SELECT u, 'plan-check ' || n, (SELECT MIN(id) FROM habit_categories), 'daily', CURRENT_DATE - 365,
+               CASE WHEN n %% 4 = 0 THEN 'archived' ELSE 'active' END
+        FROM unnest(%s) u, generate_series(1, 12) n
+        RETURNING id
+    ''', (user_ids,))
+    habit_ids = [row[0] for row in cur.fetchall()]
+    cur.execute('''
+        INSERT INTO habit_completions (habit_id, completion_date)
+        SELECT h, CURRENT_DATE - n
+        FROM unnest(%s) h, generate_series(0, 60) n
+    ''', (habit_ids,))
+    cur.execute('''
+        INSERT INTO events (user_id, title, category_id, start_datetime, end_datetime)
+        SELECT u, 'plan-check ' || n, (SELECT MIN(id) FROM event_categories),
+               CURRENT_DATE - n + TIME '09:00', CURRENT_DATE - n + TIME '10:00'
+        FROM unnest(%s) u, generate_series(1, %s) n
+    ''', (user_ids, rows_per_user))
+    for table in ('users', 'categories', 'transactions', 'ledger_monthly_rollups',
+                  'savings_goals', 'habits', 'habit_completions', 'events'):
+        cur.execute(f'ANALYZE {table}')
+    return user_ids[len(user_ids) // 2], habit_ids[len(habit_ids) // 2]
+
+# Función para saber cómo se lee una tabla en un plan EXPLAIN (FORMAT JSON):
+# devuelve la lista de (tipo de nodo, índice) de los nodos que la recorren
+def plan_scans_for_relation(plan, relation):
+    scans = []
+    if plan.get('Relation Name') == relation:
+        scans.append((plan['Node Type'], plan.get('Index Name')))
+    for child in plan.get('Plans', []):
+        scans.extend(plan_scans_for_relation(child, relation))
+    return scans
+
+# Función que ejecuta EXPLAIN sobre cada consulta de HOT_QUERIES con datos sembrados
+# y devuelve [(nombre, tabla, ok, recorridos)]. Todo se deshace al terminar.
+def check_hot_query_plans(conn):
+    cur = conn.cursor()
+    results = []
+    try:
+        user_id, habit_id = seed_query_plan_dataset(cur)
+        today = date.today()
+        month = date(today.year, today.month, 1)
+        day_start = datetime.combine(today, datetime.min.time())
+        day_end = datetime.combine(today, datetime.max.time())
+        params = dict(chatbot_context_params(user_id, today), **{
+            'habit_id': habit_id,
+            'habit_ids': [habit_id],
+            'status': 'active',
+            'date_from': today,
+            'date_to': today,
+            'before': today,
+            'month_start': month,
+            'last_month_start': (month - timedelta(days=1)).replace(day=1),
+            'balance_until': None,
+            'after_date': day_start,
+            'after_id': 2147483647,
+            'range_start': day_start,
+            'range_end': day_end,
+            'since': day_start,
+            'since_id': 0,
+            'include_deleted': True,
+            'limit': 11
+        })
+        for name, relation, query, call_params in HOT_QUERIES:
+            query_params = dict(params, **call_params(today)) if call_params else params
+            cur.execute('EXPLAIN (FORMAT JSON) ' + query, query_params)
+            plan = cur.fetchone()[0][0]['Plan']
+            scans = plan_scans_for_relation(plan, relation)
+            uses_index = bool(scans) and all(node_type != 'Seq Scan' for node_type, _ in scans)
+            results.append((name, relation, uses_index, scans))
+        return results
+    finally:
+        conn.rollback()
+        cur.close()
+
+# Comando para comprobar que las consultas frecuentes usan índices:
+#     flask --app app check-query-plans
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    with db_connection() as conn:
+        results = check_hot_query_plans(conn)
+    failures = 0
+    for name, relation, uses_index, scans in results:
+        detail = ', '.join(f'{node_type} ({index_name})' if index_name else node_type
+                           for node_type, index_name in scans)
+        click.echo(f"{'OK   ' if uses_index else 'FALLA'} {name} [{relation}]: {detail}")
+        if not uses_index:
+            failures += 1
+    if failures:
+        raise click.ClickException(f'{failures} consultas no usan índice')
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
@@ -0,0 +1,29 @@
+-- Pone al día las bases de datos creadas con versiones anteriores de schema.sql:
+-- programación compilada de hábitos, estado incremental de rachas y resúmenes
+-- mensuales de transacciones. En instalaciones nuevas no cambia nada.
+
+ALTER TABLE habits ADD COLUMN IF NOT EXISTS days_of_week_mask SMALLINT;
+ALTER TABLE habits ADD COLUMN IF NOT EXISTS days_of_month_mask INTEGER;
+ALTER TABLE habits ADD COLUMN IF NOT EXISTS streak_start_date DATE;
+ALTER TABLE habits ADD COLUMN IF NOT EXISTS last_completion_date DATE;
+
+CREATE TABLE IF NOT EXISTS ledger_monthly_rollups (
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    category_id INTEGER NOT NULL, -- 0 para transacciones sin categoría
+    month DATE NOT NULL, -- primer día del mes
+    type VARCHAR(20) NOT NULL, -- 'ingreso' o 'gasto'
+    total DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    tx_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, category_id, month, type)
+);
+
+-- Rellenar los resúmenes con las transacciones existentes: el resumen financiero y el
+-- chatbot solo leen de esta tabla. En una tabla recién creada no hay conflictos; si ya
+-- tenía filas, se conservan (para repararlas: flask rebuild-ledger-rollups).
+INSERT INTO ledger_monthly_rollups (user_id, category_id, month, type, total, tx_count)
+SELECT user_id, COALESCE(category_id, 0), date_trunc('month', date)::date, type,
+       SUM(amount), COUNT(*)
+FROM transactions
+WHERE user_id IS NOT NULL
+GROUP BY user_id, COALESCE(category_id, 0), date_trunc('month', date)::date, type
+ON CONFLICT (user_id, category_id, month, type) DO NOTHING;
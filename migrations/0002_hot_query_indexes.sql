@@ -0,0 +1,29 @@
+-- Índices compuestos para las consultas más frecuentes de app.py
+
+-- Transacciones de un usuario ordenadas por fecha (recientes, listado paginado, chatbot)
+CREATE INDEX IF NOT EXISTS idx_transactions_user_date
+    ON transactions (user_id, date DESC, id DESC);
+
+-- Categorías financieras y metas de ahorro de un usuario
+CREATE INDEX IF NOT EXISTS idx_categories_user
+    ON categories (user_id);
+CREATE INDEX IF NOT EXISTS idx_savings_goals_user
+    ON savings_goals (user_id);
+
+-- Hábitos de un usuario por estado, ordenados por fecha de creación
+CREATE INDEX IF NOT EXISTS idx_habits_user_status_created
+    ON habits (user_id, status, created_at DESC);
+
+-- Eventos de un usuario ordenados por inicio (GET /api/events)
+CREATE INDEX IF NOT EXISTS idx_events_user_start
+    ON events (user_id, start_datetime);
+
+-- Índice de rangos para buscar eventos que se solapan con un intervalo:
+-- user_id = X AND tsrange(start_datetime, end_datetime, '[]') && tsrange(desde, hasta, '[]')
+-- Un rango exige inicio <= fin, así que primero se corrigen las filas invertidas
+UPDATE events SET end_datetime = start_datetime WHERE end_datetime < start_datetime;
+ALTER TABLE events ADD CONSTRAINT events_end_after_start CHECK (end_datetime >= start_datetime);
+
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+CREATE INDEX IF NOT EXISTS idx_events_user_period
+    ON events USING GIST (user_id, tsrange(start_datetime, end_datetime, '[]'));
@@ -0,0 +1,28 @@
+-- Eventos recurrentes: una fila por serie con su regla (subconjunto de RRULE),
+-- excepciones por ocurrencia y un índice de rangos sobre el periodo completo de la serie
+
+ALTER TABLE events ADD COLUMN IF NOT EXISTS recurrence_rule VARCHAR(255); -- p. ej. 'FREQ=WEEKLY;BYDAY=MO,WE'
+ALTER TABLE events ADD COLUMN IF NOT EXISTS recurrence_end TIMESTAMP; -- fin de la última ocurrencia, NULL si la serie no termina
+
+-- Ocurrencias canceladas o modificadas de una serie, identificadas por su inicio original
+CREATE TABLE IF NOT EXISTS event_exceptions (
+    event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+    occurrence_start TIMESTAMP NOT NULL,
+    is_cancelled BOOLEAN NOT NULL DEFAULT false,
+    title VARCHAR(255),
+    description TEXT,
+    start_datetime TIMESTAMP,
+    end_datetime TIMESTAMP,
+    location VARCHAR(255),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (event_id, occurrence_start),
+    CHECK (is_cancelled OR (start_datetime IS NOT NULL AND end_datetime IS NOT NULL
+                            AND end_datetime >= start_datetime))
+);
+
+-- El periodo indexado de una serie va de su primer inicio al fin de su última
+-- ocurrencia (sin límite superior si no termina); el de un evento simple, de inicio a fin
+DROP INDEX IF EXISTS idx_events_user_period;
+CREATE INDEX IF NOT EXISTS idx_events_user_span
+    ON events USING GIST (user_id, tsrange(start_datetime,
+        CASE WHEN recurrence_rule IS NULL THEN end_datetime ELSE recurrence_end END, '[]'));
@@ -0,0 +1,17 @@
+-- Un evento externo (Google Calendar, ICS importado) se identifica por (user_id, google_event_id),
+-- que es la clave de upsert de la importación masiva
+
+-- Si hay duplicados, se conserva el identificador externo solo en el evento más reciente
+UPDATE events e
+SET google_event_id = NULL
+WHERE e.google_event_id IS NOT NULL
+AND EXISTS (
+    SELECT 1 FROM events newer
+    WHERE newer.user_id = e.user_id
+    AND newer.google_event_id = e.google_event_id
+    AND newer.id > e.id
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_events_user_external_id
+    ON events (user_id, google_event_id)
+    WHERE google_event_id IS NOT NULL;
@@ -0,0 +1,5 @@
+-- Sincronización incremental de eventos: los clientes piden los cambios posteriores a su
+-- token, que apunta a (updated_at, id). Los eventos eliminados quedan como marcas
+-- (status = 'deleted') hasta que se purgan.
+CREATE INDEX IF NOT EXISTS idx_events_user_updated
+    ON events (user_id, updated_at, id);
@@ -0,0 +1,8 @@
+-- Versión por usuario y recurso ('finance', 'habits', 'events') que incrementan los
+-- endpoints de escritura; las lecturas derivan de ella su ETag
+CREATE TABLE IF NOT EXISTS resource_versions (
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    resource VARCHAR(32) NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, resource)
+);
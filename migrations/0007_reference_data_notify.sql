@@ -0,0 +1,18 @@
+-- Aviso por NOTIFY cuando cambian las tablas globales de catálogo, para que los procesos
+-- con REFERENCE_DATA_LISTEN activo recarguen su registro de datos de referencia
+CREATE OR REPLACE FUNCTION notify_reference_data_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('reference_data', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS habit_categories_reference_data ON habit_categories;
+CREATE TRIGGER habit_categories_reference_data
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON habit_categories
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_change();
+
+DROP TRIGGER IF EXISTS event_categories_reference_data ON event_categories;
+CREATE TRIGGER event_categories_reference_data
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON event_categories
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_reference_data_change();
@@ -0,0 +1,24 @@
+-- Sesiones de conversación del chatbot guardadas en el servidor: el cliente solo envía el
+-- mensaje nuevo y el id de sesión. Los mensajes se insertan sin modificarse nunca; los que
+-- salen de la ventana se condensan en chatbot_sessions.summary.
+CREATE TABLE IF NOT EXISTS chatbot_sessions (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    summary TEXT NOT NULL DEFAULT '',
+    summarized_seq INTEGER NOT NULL DEFAULT 0,
+    last_seq INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS chatbot_messages (
+    session_id INTEGER NOT NULL REFERENCES chatbot_sessions(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role VARCHAR(8) NOT NULL CHECK (role IN ('user', 'model')),
+    content TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (session_id, seq)
+);
+
+CREATE INDEX IF NOT EXISTS idx_chatbot_sessions_user_updated
+    ON chatbot_sessions (user_id, updated_at);
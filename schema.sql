@@ -1,4 +1,14 @@
+-- Instalación desde cero: ejecutar este script y después aplicar las migraciones
+-- de migrations/ con `flask --app app migrate` (índices y cambios posteriores).
+-- Bases de datos existentes: solo aplicar las migraciones.
+
 -- Eliminar tablas en orden correcto para evitar errores de restricciones
+DROP TABLE IF EXISTS schema_migrations;
+DROP TABLE IF EXISTS resource_versions;
+DROP TABLE IF EXISTS chatbot_messages;
+DROP TABLE IF EXISTS chatbot_sessions;
+DROP TABLE IF EXISTS ledger_monthly_rollups;
+DROP TABLE IF EXISTS event_exceptions;
 DROP TABLE IF EXISTS habit_completions;
 DROP TABLE IF EXISTS habits;
 DROP TABLE IF EXISTS habit_categories;
@@ -37,6 +47,46 @@ CREATE TABLE transactions (
     date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Crear tabla de resúmenes mensuales de transacciones (mantenida por la API en cada escritura)
+CREATE TABLE ledger_monthly_rollups (
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    category_id INTEGER NOT NULL, -- 0 para transacciones sin categoría
+    month DATE NOT NULL, -- primer día del mes
+    type VARCHAR(20) NOT NULL, -- 'ingreso' o 'gasto'
+    total DECIMAL(14, 2) NOT NULL DEFAULT 0,
+    tx_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, category_id, month, type)
+);
+
+-- Versión por usuario y recurso ('finance', 'habits', 'events') para los ETag de las lecturas
+CREATE TABLE resource_versions (
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    resource VARCHAR(32) NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, resource)
+);
+
+-- Sesiones de conversación del chatbot: resumen de los mensajes que salieron de la ventana
+CREATE TABLE chatbot_sessions (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    summary TEXT NOT NULL DEFAULT '',
+    summarized_seq INTEGER NOT NULL DEFAULT 0,
+    last_seq INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Mensajes de cada sesión, solo se insertan (numerados por seq dentro de la sesión)
+CREATE TABLE chatbot_messages (
+    session_id INTEGER NOT NULL REFERENCES chatbot_sessions(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role VARCHAR(8) NOT NULL CHECK (role IN ('user', 'model')),
+    content TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (session_id, seq)
+);
+
 -- Crear tabla de metas de ahorro
 CREATE TABLE savings_goals (
     id SERIAL PRIMARY KEY,
@@ -64,11 +114,15 @@ CREATE TABLE habits (
     frequency VARCHAR(20) NOT NULL, -- 'daily', 'weekly', 'monthly'
     days_of_week VARCHAR(50), -- 'Mon,Wed,Fri' o NULL
     days_of_month VARCHAR(100), -- '1,15,30' o NULL
+    days_of_week_mask SMALLINT, -- days_of_week compilado: bit 0 = lunes ... bit 6 = domingo
+    days_of_month_mask INTEGER, -- days_of_month compilado: bit 0 = día 1 ... bit 30 = día 31
     start_date DATE NOT NULL,
     end_date DATE, -- NULL si es continuo
     start_time TIME DEFAULT '00:00:00', -- hora de inicio
     end_time TIME DEFAULT '23:59:59', -- hora de fin
     current_streak INTEGER DEFAULT 0,
+    streak_start_date DATE, -- primera fecha de la racha actual
+    last_completion_date DATE, -- completación más reciente (para actualizar la racha sin releer el historial)
     status VARCHAR(20) DEFAULT 'active', -- 'active', 'archived'
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
@@ -102,11 +156,29 @@ CREATE TABLE events (
     location VARCHAR(255),
     is_all_day BOOLEAN DEFAULT false,
     google_event_id VARCHAR(255), -- ID en Google Calendar
-    status VARCHAR(50) DEFAULT 'active', -- 'active', 'cancelled'
+    status VARCHAR(50) DEFAULT 'active', -- 'active', 'cancelled', 'deleted' (marca para la sincronización)
+    recurrence_rule VARCHAR(255), -- Subconjunto de RRULE, p. ej. 'FREQ=WEEKLY;BYDAY=MO,WE'
+    recurrence_end TIMESTAMP, -- Fin de la última ocurrencia, NULL si la serie no termina
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Ocurrencias canceladas o modificadas de eventos recurrentes
+CREATE TABLE event_exceptions (
+    event_id INTEGER NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+    occurrence_start TIMESTAMP NOT NULL, -- Inicio original de la ocurrencia
+    is_cancelled BOOLEAN NOT NULL DEFAULT false,
+    title VARCHAR(255),
+    description TEXT,
+    start_datetime TIMESTAMP,
+    end_datetime TIMESTAMP,
+    location VARCHAR(255),
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (event_id, occurrence_start),
+    CHECK (is_cancelled OR (start_datetime IS NOT NULL AND end_datetime IS NOT NULL
+                            AND end_datetime >= start_datetime))
+);
+
 -- Categorías financieras predefinidas exactamente como en la imagen con los montos exactos
 INSERT INTO categories (name, budget, color) VALUES 
 ('Comida', 500, 'green'),         -- $500 como en la imagen
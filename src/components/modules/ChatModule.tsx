@@ -183,6 +183,8 @@ const ChatModule = () => {
   const [messages, setMessages] = useState<Message[]>([]);
   const [inputMessage, setInputMessage] = useState("");
   const [isLoading, setIsLoading] = useState(false);
+  // Sesión de conversación del servidor (el historial se guarda allí)
+  const [sessionId, setSessionId] = useState<number | null>(null);
   const scrollAreaRef = useRef<HTMLDivElement>(null);
   
   // Estados para datos del usuario
@@ -199,6 +201,27 @@ const ChatModule = () => {
   // Función para obtener el token desde localStorage
   const getToken = () => localStorage.getItem("token");
   
+  // Obtener la respuesta final de /api/chatbot/message: si el servidor la está generando
+  // (202), consultar los mensajes nuevos de la sesión hasta que aparezca la del asistente
+  const resolveChatReply = async (data: any, status: number, token: string | null) => {
+    setSessionId(data.session_id);
+    if (status !== 202) return data.response as string;
+    
+    for (let attempt = 0; attempt < 90; attempt++) {
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+      const history = await axios.get(
+        API_CONFIG.getApiUrl(`/api/chatbot/sessions/${data.session_id}/messages`),
+        {
+          params: { after_seq: data.after_seq },
+          headers: { Authorization: `Bearer ${token}` }
+        }
+      );
+      const reply = history.data.messages?.find((msg: any) => msg.role === "model");
+      if (reply) return reply.parts[0] as string;
+    }
+    throw new Error("El asistente tardó demasiado en responder");
+  };
+  
   // Lista de acciones rápidas sugeridas
   const [quickActions, setQuickActions] = useState<QuickAction[]>([
     { id: "habits", text: "¿Qué hábitos debo completar hoy?", icon: <PlusCircle className="h-4 w-4" /> },
@@ -455,19 +478,13 @@ ${userContext}
     try {
       const token = getToken();
       
-      // Crear una versión de conversation_history para la API
-      const messageHistory = messages.map(msg => ({
-        role: msg.role,
-        parts: msg.parts
-      }));
-      
       try {
         // Intentar enviar el mensaje al backend
         const response = await axios.post(
           API_CONFIG.getApiUrl('/api/chatbot/message'),
           {
             message: inputMessage,
-            conversation_history: messageHistory
+            session_id: sessionId
           },
           {
             headers: {
@@ -478,10 +495,11 @@ ${userContext}
         );
         
         // Procesar la respuesta del backend
-        if (response.data && response.data.response) {
+        const reply = response.data ? await resolveChatReply(response.data, response.status, token) : null;
+        if (reply) {
           const modelResponse = {
             role: "model" as const,
-            parts: [response.data.response]
+            parts: [reply]
           };
           
           setMessages((prev) => [...prev, modelResponse]);
@@ -583,7 +601,7 @@ ${userContext}
         // Preparar los datos para la API incluyendo el nuevo mensaje
         const requestData = {
           message: action.text,
-          conversation_history: [...messages, userMessage]
+          session_id: sessionId
         };
         
         const response = await axios.post(API_CONFIG.getApiUrl('/api/chatbot/message'), requestData, {
@@ -593,10 +611,11 @@ ${userContext}
           }
         });
         
-        if (response.status === 200 && response.data && response.data.response) {
+        const reply = response.data ? await resolveChatReply(response.data, response.status, token) : null;
+        if (reply) {
           const modelMessage: Message = {
             role: "model",
-            parts: [response.data.response]
+            parts: [reply]
           };
           setMessages(prev => [...prev, modelMessage]);
         } else {